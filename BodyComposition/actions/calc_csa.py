@@ -17,6 +17,8 @@ class CalcCSA(PipelineAction):
         # io to pipeline
         self.io_inputs = [mask]
         self.io_outputs = ['tmp/tissue_values', 'tmp/tissue_meta']
+        self.io_compact = [mask] # queried as labelmap only
+        self.io_sliced = ['tmp/tissue_values'] # restricted to slices of exported levels, if set by pipeline
         self.input_mask_name = mask
 
         # load labels as constants
@@ -39,12 +41,16 @@ class CalcCSA(PipelineAction):
         logging.info(f' spacing: {spacing}')
 
         # RAS+ format: 2 = -1 = inferior to superior, starting w 0
-        # create empty output array
-        res_csa_np = np.zeros(shape=(input_mask.shape[-1], len(self.LBL_TISSUE)), dtype=np.uint32)
-
-        # loop through tissue labels, run vectorized operation
-        for i, key in enumerate(self.LBL_TISSUE):
-            res_csa_np[:, i] = np.round(np.sum(input_mask.data_np == key, axis=(0, 1)) * pix_area)
+        # voxels per slice and tissue label from compact labels (no dense boolean masks), to areas
+        res_csa_np = np.round(input_mask.labelmap.label_slice_counts(list(self.LBL_TISSUE), axis=2) * pix_area).astype(np.uint32)
+
+        # restricted to slices of exported levels: other slices are 0
+        if 'tmp/slices' in self.io_inputs:
+            slices = memory['tmp/slices']
+            if slices.size != res_csa_np.shape[0]:
+                raise ValueError(f'Slices of levels ({slices.size}) do not match slices of mask ({res_csa_np.shape[0]}).')
+            res_csa_np[~slices] = 0
+            logging.info(f' restricted to {np.count_nonzero(slices)} slices of exported levels')
 
         # save data to pipeline
         memory['tmp/tissue_values'] = res_csa_np
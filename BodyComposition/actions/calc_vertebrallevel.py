@@ -3,7 +3,6 @@ import logging
 from BodyComposition.pipeline import PipelineAction
 from time import time
 import numpy as np
-from scipy.ndimage import center_of_mass
 
 # action class
 class CalcVertebralLevel(PipelineAction):
@@ -16,13 +15,15 @@ class CalcVertebralLevel(PipelineAction):
         self.input_mask_name = mask
         self.io_inputs = [mask]
         self.io_outputs = ['tmp/vertebrae_values', 'tmp/vertebrae_meta']
+        self.io_compact = [mask] # queried as labelmap only
 
         # configs
         self.config_vertebrae = pipeline.config['vertebrae']
 
 
     # max counts per slive, with and without window
-    def get_max_counts(self, data: np.array, index: int, window_size: int, min_voxels: int = 0, deprioritize_labels: list = []):
+    # counts: voxels per slice (rows) and value (columns), values: sorted values of columns, including 0
+    def get_max_counts(self, counts: np.array, values: np.array, index: int, window_size: int, min_voxels: int = 0, deprioritize_labels: list = []):
 
         # limit window size to data size
         if index-window_size < 0:
@@ -30,17 +31,14 @@ class CalcVertebralLevel(PipelineAction):
         else:
             helper_start = index-window_size
 
-        if index+window_size+1 > data.shape[2]:
-            helper_end = data.shape[2]
+        if index+window_size+1 > counts.shape[0]:
+            helper_end = counts.shape[0]
         else:
             helper_end = index+window_size+1
 
-        # select window 
-        indices = range(helper_start, helper_end)
-        data_window = data[:, :, indices]
-
-        # count values
-        values, counts = np.unique(data_window, return_counts=True)
+        # count values in window, values not present are dropped
+        counts = counts[helper_start:helper_end].sum(axis=0)
+        values, counts = values[counts > 0], counts[counts > 0]
 
         # ignore 0s as maximums, but keep them if nothing else is there 
         counts[values == 0] = 0
@@ -93,13 +91,17 @@ class CalcVertebralLevel(PipelineAction):
         res_labels_np = np.zeros(shape=(input_mask.shape[-1], 4), dtype=np.uint16) 
         res_labels_np[:, 0] = range(input_mask.shape[-1]) # column 0: slice
 
-        # load vertrebrae as numpy
+        # voxels per slice and vertebra from compact labels (no dense volume), column 0: background
         time_start_i = time()
+        labelmap = input_mask.labelmap
+        counts_labels = labelmap.slice_counts(axis=2)
+        counts_all = np.column_stack([input_mask.shape[0] * input_mask.shape[1] - counts_labels.sum(axis=1), counts_labels])
+        values_all = np.concatenate([[0], labelmap.labels]).astype(labelmap.dtype)
         labels_all = res_labels_np[:, 1] # column 1: dominating vertebrae
 
         # STEP 1: find value with max counts without using windows
         for z in range(input_mask.shape[2]):
-            labels_all[z] = self.get_max_counts(input_mask.data_np, z, 0, self.config_vertebrae['min_voxels_per_vertebra'], self.config_vertebrae['deprioritize_labels'])
+            labels_all[z] = self.get_max_counts(counts_all, values_all, z, 0, self.config_vertebrae['min_voxels_per_vertebra'], self.config_vertebrae['deprioritize_labels'])
         logging.info(f' computed dominating vertebrae levels ({time() - time_start_i:.1f}s)')
 
         # vertebrae between first and last defined level to subarray
@@ -107,7 +109,7 @@ class CalcVertebralLevel(PipelineAction):
         if helper_localizer.size == 0:
             raise ValueError(f' No vertebrae found in {self.input_mask_name}. A common cause is, that the image is not properly aligned or oriented.')
         labels_vertebrae = labels_all[helper_localizer[0]:helper_localizer[-1]+1]
-        data_vertebrae = input_mask.data_np[:, :, helper_localizer[0]:helper_localizer[-1]+1]
+        counts_vertebrae = counts_all[helper_localizer[0]:helper_localizer[-1]+1]
 
         # STEP 2: fill undefined levels between first and last defined level
         if self.config_vertebrae['fill_undefined_levels']:
@@ -117,7 +119,7 @@ class CalcVertebralLevel(PipelineAction):
 
             while helper_unlabeled.size > 0:
                 for z in helper_unlabeled:
-                    labels_vertebrae[z] = self.get_max_counts(data_vertebrae, z, helper_windowsize, self.config_vertebrae['min_voxels_per_vertebra'], self.config_vertebrae['deprioritize_labels'])
+                    labels_vertebrae[z] = self.get_max_counts(counts_vertebrae, values_all, z, helper_windowsize, self.config_vertebrae['min_voxels_per_vertebra'], self.config_vertebrae['deprioritize_labels'])
                 helper_unlabeled = np.where(labels_vertebrae == 0)[0]
                 helper_windowsize += 1
             
@@ -146,7 +148,7 @@ class CalcVertebralLevel(PipelineAction):
 
                     # loop through range and find max counts
                     for z2 in range(helper_start, helper_end):
-                        labels_vertebrae[z2] = self.get_max_counts(data_vertebrae, z2, helper_windowsize, self.config_vertebrae['min_voxels_per_vertebra'], self.config_vertebrae['deprioritize_labels'])
+                        labels_vertebrae[z2] = self.get_max_counts(counts_vertebrae, values_all, z2, helper_windowsize, self.config_vertebrae['min_voxels_per_vertebra'], self.config_vertebrae['deprioritize_labels'])
 
                 helper_notmonotonical = self.get_not_monotonical(labels_vertebrae)
                 helper_windowsize += 1
@@ -165,12 +167,11 @@ class CalcVertebralLevel(PipelineAction):
         labels_all = res_labels_np[:, 2] # column 2: vertebrae center
 
         # select all identified vertrebrae
-        vertebrae = np.unique(input_mask.data_np)
-        vertebrae = vertebrae[vertebrae != 0]
+        vertebrae = labelmap.labels
 
         # loop through all vertrebrae, find median of voxel distribution in cranio-caudal direction
-        for vertebra in vertebrae:
-            helper_counts = np.sum(input_mask.data_np == vertebra, axis=(0, 1))
+        for i, vertebra in enumerate(vertebrae):
+            helper_counts = counts_labels[:, i]
             helper_cumsum = np.cumsum(helper_counts)
             helper_total = np.sum(helper_counts)
             helper_index = np.where(helper_cumsum >= helper_total/2)[0][0]
@@ -192,10 +193,10 @@ class CalcVertebralLevel(PipelineAction):
         # vertebrae = np.unique(input_mask.data_np)
         # vertebrae = vertebrae[vertebrae != 0]
 
-        # loop through all vertrebrae, find center of mass in cranio-caudal direction
+        # loop through all vertrebrae, find center of mass in cranio-caudal direction (as scipy.ndimage.center_of_mass)
         if self.config_vertebrae['center_of_mass']:
-            for vertebra in vertebrae:
-                _, _, helper_index = center_of_mass(input_mask.data_np == vertebra)
+            for i, vertebra in enumerate(vertebrae):
+                helper_index = np.sum(np.arange(counts_labels.shape[0]) * counts_labels[:, i]) / np.sum(counts_labels[:, i])
                 helper_index = int(round(helper_index))
                 # skip if not dominating vertebrae
                 if res_labels_np[helper_index,1] != vertebra:
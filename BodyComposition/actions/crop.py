@@ -1,9 +1,7 @@
 # general libraries
 from BodyComposition.pipeline import PipelineAction
-from BodyComposition.utils.nifti import NiftiDataContainer
 from time import time
 import logging
-import numpy as np
 from math import ceil
 
 # class
@@ -17,6 +15,7 @@ class CreateBoundingBox(PipelineAction):
         self.input_label_name = label
         self.io_inputs = [label]
         self.io_outputs = [label]
+        self.io_compact = [label] # queried as labelmap only
 
         # load task specific parameters
         if task not in self.config['crop']:
@@ -45,19 +44,15 @@ class CreateBoundingBox(PipelineAction):
         margin = [ceil(float(self.task_config['margin'][i]) / spacing[i//2]) for i in range(6)]
         logging.info(f' margins: {self.task_config["margin"]}mm -> {margin}vx')
 
-        # create bounding box for cropping
-        label_roi = np.isin(input_label.data_np, self.task_config['roi']) # only roi
+        # bounding box of roi from compact labels (no dense mask), [min, max) per axis, None if roi not present
+        bbox_roi = input_label.labelmap.bbox(self.task_config['roi'])
 
         # create bounding box
         bbox = []
         for dim in range(3):
-            # adapt axis to current dim
-            imask = np.any(label_roi, axis=tuple(i for i in range(3) if i != dim))
-            iindex = np.where(imask)[0]
-
-            # get min and max
-            imin = iindex[0] - margin[dim*2] if iindex.size > 0 else 0
-            imax = iindex[-1] + margin[dim*2+1] if iindex.size > 0 else shape[dim]
+            # get min and max (first and last voxel of roi)
+            imin = bbox_roi[dim*2] - margin[dim*2] if bbox_roi is not None else 0
+            imax = bbox_roi[dim*2+1] - 1 + margin[dim*2+1] if bbox_roi is not None else shape[dim]
 
             # check bounds
             imin = max(imin, 0) if self.task_config['axes'][dim*2] else 0
@@ -107,10 +102,8 @@ class ApplyBoundingBox(PipelineAction):
             self.output_name = self.input_name
         elif self.output_name not in memory:
             output_path = memory['workspace']/self.output_name.format(caseid=memory['id'])
-            output = memory[self.output_name] = NiftiDataContainer(output_path)
-            output.meta = memory[self.input_name].meta
-            output.data_np = memory[self.input_name].data_np
-            logging.info(f' copied container: {memory[self.input_name]} -> {output}')
+            output = memory[self.output_name] = memory[self.input_name].derive(output_path) # copy-on-write
+            logging.info(f' derived container: {memory[self.input_name]} -> {output}')
 
         # apply bounding box, log
         memory[self.output_name].bbox = memory['bbox']
@@ -6,6 +6,72 @@ import pandas as pd
 from pathlib import Path
 import numpy as np
 from typing import Union
+from BodyComposition.utils.results_store import open_store, valid_stores, write_csv, append_csv
+
+
+# results of a case: structured array, one row per slice (superior -> inferior)
+# vertebrae columns keep the internal labels (-1 = None), mapped to level names only at export
+COLUMNS_VERTEBRAE = ['Level', 'Center', 'Centroid']
+COLUMNS_WO_AGGREGATION = ['Slice', 'Center', 'Level', 'Centroid', 'Tag']
+
+# column types of exports in results stores: metadata (DataExport, add_metadata), results by dtype (see results_types)
+COLUMNS_METADATA = {'case_id': 'text', 'case_timestamp': 'int', 'pat_id': 'text', 'pat_prefix': 'text', 'pat_suffix': 'text',
+                    'pat_sex': 'text', 'pat_size': 'float', 'pat_weight': 'float', 'scan_date': 'text', 'scan_slicethickness': 'float'}
+
+def level_lut(labels: dict, n: int) -> np.ndarray:
+    """Lookup array internal label -> level name (undefined labels are kept), index -1 = None."""
+    lut = np.empty(n + 1, dtype=object)
+    lut[:n] = np.arange(n)
+    for key, value in labels.items():
+        lut[key] = value
+    lut[-1] = None
+    return lut
+
+def results_to_df(results: np.ndarray, labels: dict) -> pd.DataFrame:
+    """Transform results (structured array) to pandas dataframe, map vertebrae labels to level names."""
+    columns = {}
+    for name in results.dtype.names:
+        values = results[name]
+        if name in COLUMNS_VERTEBRAE:
+            n = max(max(labels) + 1, int(values.max()) + 1 if values.size else 0)
+            columns[name] = level_lut(labels, n)[values]
+        elif name == 'Slice' and (values < 0).any():
+            columns[name] = np.where(values < 0, None, values)
+        elif name == 'Slice':
+            columns[name] = values.astype(np.uint16) # slice indices, as tmp/vertebrae_values
+        else:
+            columns[name] = values
+        # aggregated columns w/ None: dtype inferred as by pandas (e.g. numbers and None -> float)
+        if name in COLUMNS_VERTEBRAE + ['Slice'] and (values < 0).any():
+            columns[name] = pd.Series(columns[name].tolist())
+    return pd.DataFrame(columns)
+
+def results_types(dtype: np.dtype) -> dict:
+    """Column types of exported results (structured array, see DataCombine): levels as names and Tag as text."""
+    types = {}
+    for name in dtype.names:
+        if name in COLUMNS_VERTEBRAE or dtype[name].kind == 'O':
+            types[name] = 'text'
+        else:
+            types[name] = 'int' if dtype[name].kind in 'iub' else 'float'
+    return types
+
+def _sum_groups(values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # compensated (kahan) summation of sorted groups (rows), vectorized over groups and columns, identical to pandas groupby sum/mean
+    # csa values are multiples of 0.01, plain summation changes the result of rounding at ties
+    sums = np.zeros((starts.size,) + values.shape[1:])
+    compensation = np.zeros_like(sums)
+    for i in range(int(counts.max(initial=0))):
+        active = counts > i
+        y = values[starts[active] + i] - compensation[active]
+        t = sums[active] + y
+        compensation[active] = t - sums[active] - y
+        sums[active] = t
+    return sums
+
+def _sort_key(value):
+    # order of groups as pandas: numbers first, then strings
+    return (0, value, '') if isinstance(value, (int, float, np.integer)) else (1, 0, str(value))
 
 
 # action class
@@ -25,6 +91,11 @@ class DataCombine(PipelineAction):
         self.LBL_VERTEBRALBODIES = pipeline.config['LBL_VERTEBRALBODIES']
         self.LBL_TISSUE = pipeline.config['LBL_TISSUE']
 
+        # columns of results
+        self.names_tissue = ["CSA_" + col for col in self.LBL_TISSUE.values()]
+        self.dtype = np.dtype([('Slice', np.int64)] + [(col, np.int32) for col in COLUMNS_VERTEBRAE] + [('Tag', object)]
+                              + [(col, np.float64) for col in self.names_tissue])
+
 
     def __call__(self, memory):
         """Combine, filter, aggregate and exporting data."""
@@ -41,27 +112,21 @@ class DataCombine(PipelineAction):
         elif not np.allclose(tissue_meta[2], vertebrae_meta[2]):
             raise ValueError(f'Spacings of tissue and vertebrae masks do not match:\n{tissue_meta[2]} vs \n{vertebrae_meta[2]}')
 
-        # transform labels numpy to pandas
-        vertebrae_df = pd.DataFrame(memory['tmp/vertebrae_values'], columns=["Slice", "Level", "Center", "Centroid"])
-        vertebrae_df["Tag"] = None
-           
-        # transform csa numpy to pandas
-        names_columns = ["CSA_" + col for col in self.LBL_TISSUE.values()]
-        tissue_df = pd.DataFrame(memory['tmp/tissue_values'], columns=names_columns)
-        tissue_df = tissue_df / 100 # adapt csa values (transform mm2 to cm2)
-
-        # concatenate, reverse order of rows
-        results_df = pd.concat([vertebrae_df, tissue_df], axis=1)
-        results_df = results_df.iloc[::-1].reset_index(drop=True)
-
-        # replace labels with real levels
-        dict_vertebrae = self.LBL_VERTEBRALBODIES
-        results_df['Level'] = results_df['Level'].replace(dict_vertebrae)
-        results_df['Center'] = results_df['Center'].replace(dict_vertebrae)
-        results_df['Centroid'] = results_df['Centroid'].replace(dict_vertebrae)
+        # reverse order of rows (superior -> inferior)
+        vertebrae_np = memory['tmp/vertebrae_values'][::-1]
+        tissue_np = memory['tmp/tissue_values'][::-1]
+
+        # combine labels and csa, adapt csa values (transform mm2 to cm2)
+        results = np.empty(vertebrae_np.shape[0], dtype=self.dtype)
+        results['Slice'] = vertebrae_np[:, 0]
+        for i, col in enumerate(COLUMNS_VERTEBRAE, start=1):
+            results[col] = vertebrae_np[:, i]
+        results['Tag'] = None
+        for i, col in enumerate(self.names_tissue):
+            results[col] = tissue_np[:, i] / 100
 
         # save to memory
-        memory['tmp/bodycomposition'] = results_df
+        memory['tmp/bodycomposition'] = results
         logging.info(f' saved to memory:tmp/bodycomposition ({time()-time_start:.2f}s)')
 
 
@@ -110,6 +175,12 @@ class DataSubset(PipelineAction):
 
             if not all(x in valid_levels for x in level):
                 raise ValueError(f'Argument `level` includes undefined structures.')
+
+            # levels as internal labels
+            labels = {value: key for key, value in pipeline.config['LBL_VERTEBRALBODIES'].items()}
+            self.level_labels = np.array([labels[x] for x in level])
+            if ref != 'Tag':
+                self.io_levels = {ref: [int(x) for x in self.level_labels]} # rows of these levels only
         else:
             logging.info(f' subset: not defined = all data, including undefinied levels.')
         
@@ -122,21 +193,26 @@ class DataSubset(PipelineAction):
         super().__call__(memory)
         time_start = time()
 
-        # load df
-        output_df = memory[self.input_df_name]
+        # load results
+        output_np = memory[self.input_df_name]
 
-        if not isinstance(output_df, pd.DataFrame):
-            raise ValueError(f'Input must be a pandas dataframe.')
-        elif output_df.empty:
+        if not isinstance(output_np, np.ndarray) or output_np.dtype.names is None:
+            raise ValueError(f'Input must be a structured numpy array (see DataCombine).')
+        elif output_np.size == 0:
             logging.info(f' skipped: no data')
         elif not self.ref:
             logging.info(f' skipped: inactive')
         else:
-            output_df = output_df[output_df[self.ref].isin(self.level)]
+            if self.ref == 'Tag':
+                levels = set(self.level)
+                mask = np.fromiter((x in levels for x in output_np['Tag']), dtype=bool, count=output_np.size)
+            else:
+                mask = np.isin(output_np[self.ref], self.level_labels)
+            output_np = output_np[mask]
             logging.info(f' subset: finished ({time()-time_start:.2f}s)')
         
         # save to memory
-        memory[self.output_df_name] = output_df
+        memory[self.output_df_name] = output_np
         logging.info(f' output: memory:{self.output_df_name} ({time()-time_start:.2f}s)')
 
 
@@ -190,50 +266,100 @@ class DataAggregate(PipelineAction):
         self.ref = ref
         self.tag_mapping = tag_mapping
         self.method = method
+        self.LBL_VERTEBRALBODIES = pipeline.config['LBL_VERTEBRALBODIES']
+        self.labels = {value: key for key, value in self.LBL_VERTEBRALBODIES.items()}
+
+    def groups(self, input_np: np.ndarray):
+        """Group id of each row (-1 = None, not aggregated), groups sorted by their (level) name."""
+        values = input_np[self.ref]
+        if self.ref == 'Tag':
+            keys = sorted({x for x in values if x is not None}, key=_sort_key)
+            ids = {key: i for i, key in enumerate(keys)}
+            return np.fromiter((ids.get(x, -1) if x is not None else -1 for x in values), dtype=np.int64, count=values.size), len(keys)
+        keys = np.unique(values[values >= 0])
+        keys = sorted(keys.tolist(), key=lambda x: _sort_key(self.LBL_VERTEBRALBODIES.get(x, x)))
+        lut = np.full(max(keys, default=0) + 2, -1, dtype=np.int64) # index -1 = None
+        lut[keys] = np.arange(len(keys))
+        return lut[values], len(keys)
+
+    def aggregate(self, input_np: np.ndarray, group_ids: np.ndarray, n_groups: int = 1):
+        """Aggregate measurements by groups (sorted rows, reduceat), columns w/o aggregation: single value or None."""
+        if n_groups == 0:
+            return input_np[:0]
+        order = np.argsort(group_ids, kind='stable')
+        order = order[group_ids[order] >= 0]
+        sorted_np = input_np[order]
+        starts = np.searchsorted(group_ids[order], np.arange(n_groups))
+        counts = np.diff(np.append(starts, order.size))
+
+        output_np = np.empty(n_groups, dtype=input_np.dtype)
+        for col in COLUMNS_WO_AGGREGATION:
+            values = sorted_np[col]
+            if col == 'Tag':
+                output_np[col] = [values[s] if len({x for x in values[s:s+n] if x is not None}) == 1 else None
+                                  for s, n in zip(starts, counts)]
+            else:
+                lo = np.minimum.reduceat(np.where(values >= 0, values, np.iinfo(values.dtype).max), starts)
+                hi = np.maximum.reduceat(values, starts)
+                output_np[col] = np.where((lo == hi) & (hi >= 0), values[starts], -1)
+
+        # measurements, all columns at once
+        columns = [col for col in input_np.dtype.names if col not in COLUMNS_WO_AGGREGATION]
+        values = np.column_stack([sorted_np[col] for col in columns])
+        if self.method == 'median':
+            results = np.array([np.median(values[s:s+n], axis=0) for s, n in zip(starts, counts)])
+        else:
+            # without groups: pairwise summation per column (as pandas)
+            sums = _sum_groups(values, starts, counts) if self.ref else np.array([[sorted_np[col].sum() for col in columns]])
+            results = sums / counts[:, None] if self.method == 'mean' else sums
+        for i, col in enumerate(columns):
+            output_np[col] = results[:, i]
+        return output_np
 
     def __call__(self, memory):
         """Do."""
         super().__call__(memory)
         time_start = time()
 
-        # load df
-        input_df = memory[self.input_df_name]
+        # load results
+        input_np = memory[self.input_df_name]
     
         # checks 
-        if not isinstance(input_df, pd.DataFrame):
-            raise ValueError(f' input must be a pandas dataframe.')
-        elif input_df.empty:
-            output_df = input_df
+        if not isinstance(input_np, np.ndarray) or input_np.dtype.names is None:
+            raise ValueError(f' input must be a structured numpy array (see DataCombine).')
+        elif input_np.size == 0:
+            output_np = input_np
             logging.info(f' skipped: no data')
         elif not self.method:
-            output_df = input_df
+            output_np = input_np
             logging.info(f' skipped: inactive')
-        else:
 
-            # only aggregate measurements
-            col_wo_aggregation = ['Slice', 'Center', 'Level', 'Centroid', 'Tag']
-            def single_or_none(x):
-                return x.iloc[0] if x.nunique() == 1 else None
-            agg_dict = {col: single_or_none if col in col_wo_aggregation else self.method for col in input_df.columns}
-
-            # without grouping -> aggregate complete patient
-            if not self.ref:
-                output_df = input_df.agg(agg_dict).to_frame().T
+        # without grouping -> aggregate complete patient
+        elif not self.ref:
+            output_np = self.aggregate(input_np, np.zeros(input_np.size, dtype=np.int64))
 
-            # with tag_mapping -> aggregate by new tag
-            else:
-                # if activated, create new NewTag
-                if self.tag_mapping:
-                    for key, value in self.tag_mapping.items():
-                        input_df.loc[input_df[self.ref] == key, 'Tag'] = value
-                # aggregate
-                output_df = input_df.groupby(self.ref).agg(agg_dict).reset_index(drop=True)
+        # with tag_mapping -> aggregate by new tag
+        else:
+            # if activated, create new NewTag
+            if self.tag_mapping:
+                input_np = input_np.copy()
+                for key, value in self.tag_mapping.items():
+                    if self.ref == 'Tag':
+                        mask = np.fromiter((x == key for x in input_np['Tag']), dtype=bool, count=input_np.size)
+                    else:
+                        mask = input_np[self.ref] == self.labels[key]
+                    input_np['Tag'][mask] = value
+            # aggregate
+            output_np = self.aggregate(input_np, *self.groups(input_np))
 
         # round all float columns
-        output_df = output_df.round(2)
+        output_np = output_np.copy()
+        for col in output_np.dtype.names:
+            if output_np.dtype[col].kind == 'f':
+                output_np[col] = np.round(output_np[col], 2)
             
         # save to memory
-        memory[self.output_df_name] = output_df
+        memory[self.output_df_name] = output_np
         logging.info(f' output: memory:{self.output_df_name} ({time()-time_start:.2f}s)')
 
 
@@ -248,7 +374,8 @@ class DataExport(PipelineAction):
                  input: str = 'tmp/bodycomposition',
                  file: str = 'exports/{caseid}_bc_raw.csv',
                  append: bool = False,
-                 add_metadata: bool = False):
+                 add_metadata: bool = False,
+                 store: str = None):
         super().__init__(pipeline)
 
         # io to pipeline
@@ -261,13 +388,25 @@ class DataExport(PipelineAction):
             self.io_outputs = [file]
         else:
             self.io_outputs = []
+            self.io_appends = [file]
             logging.info(f'  appending to {file}, this file will be ignored in reset and io-checks.')
+        self.io_outputs.append('tmp/return')
+
+        # consolidated results store for appended exports, default from config
+        store = store or pipeline.config['export']['store']
+        if store not in valid_stores:
+            raise ValueError(f'Argument `store` must be {valid_stores}.')
+        if append and store != 'csv':
+            logging.info(f'  results store `{store}` instead of appending to csv.')
+        self.store = store if append else 'csv'
 
         if add_metadata:
             self.io_inputs.append('tmp/metadata')
 
-        # save timestamp to action
+        # save timestamp, labels and write setting to action
+        self.write = pipeline.config['export']['write']
         self.timestamp = pipeline.timestamp
+        self.LBL_VERTEBRALBODIES = pipeline.config['LBL_VERTEBRALBODIES']
         self.add_metadata = add_metadata
         self.append = append
 
@@ -277,38 +416,61 @@ class DataExport(PipelineAction):
         super().__call__(memory)
         time_start = time()
 
+        # results to pandas, map vertebrae labels to level names
+        results_df = memory[self.input_df_name]
+        types = dict(COLUMNS_METADATA) # column types in results stores
+        if isinstance(results_df, np.ndarray):
+            types.update(results_types(results_df.dtype))
+            results_df = results_to_df(results_df, self.LBL_VERTEBRALBODIES)
+
         if self.add_metadata:
 
             # save variables
-            n_rows = memory[self.input_df_name].shape[0]
+            n_rows = results_df.shape[0]
             slicethickness = memory.get('slicethickness', None)
 
-            # load metadata
+            # load metadata, scalars are broadcasted to all rows
             patients_df = pd.DataFrame({
-                'case_id': [memory['id']]*n_rows,
-                'case_timestamp': [self.timestamp]*n_rows,
-                'pat_id': [memory['tmp/metadata']['pat_id']]*n_rows,
-                'pat_prefix': [memory['tmp/metadata']['pat_prefix']]*n_rows,
-                'pat_suffix': [memory['tmp/metadata']['pat_suffix']]*n_rows,
-                'pat_sex': [memory['tmp/metadata']['pat_sex']]*n_rows,
-                'pat_size': [memory['tmp/metadata']['pat_size']]*n_rows,
-                'pat_weight': [memory['tmp/metadata']['pat_weight']]*n_rows,
-                'scan_date': [memory['tmp/metadata']['scan_date']]*n_rows,
-                'scan_slicethickness': [slicethickness]*n_rows
-                })
+                'case_id': memory['id'],
+                'case_timestamp': self.timestamp,
+                'pat_id': memory['tmp/metadata']['pat_id'],
+                'pat_prefix': memory['tmp/metadata']['pat_prefix'],
+                'pat_suffix': memory['tmp/metadata']['pat_suffix'],
+                'pat_sex': memory['tmp/metadata']['pat_sex'],
+                'pat_size': memory['tmp/metadata']['pat_size'],
+                'pat_weight': memory['tmp/metadata']['pat_weight'],
+                'scan_date': memory['tmp/metadata']['scan_date'],
+                'scan_slicethickness': slicethickness
+                }, index=pd.RangeIndex(n_rows))
             
             # concatenate
-            results_df = pd.concat([patients_df, memory[self.input_df_name]], axis=1)
-        
-        else:
-            results_df = memory[self.input_df_name]
+            results_df = pd.concat([patients_df, results_df], axis=1)
 
         # export to file
         path_output = Path(memory['workspace'], self.output_df_name.format(caseid=memory['id']))
-        path_output.parent.mkdir(parents=True, exist_ok=True)
-        if not path_output.exists() or not self.append:
-            results_df.to_csv(path_output, index=False)
+        if not self.write:
+            logging.info(f' export to file disabled (export/write)')
+        elif not self.writes(self.output_df_name):
+            logging.info(f' export to file pruned, not a requested output (run/outputs)')
+        elif self.store != 'csv':
+            # atomic per-case commit, rows of case are replaced when re-run
+            store = open_store(self.store, path_output)
+            if 'case_id' not in results_df.columns:
+                results_df = pd.concat([pd.DataFrame({'case_id': [memory['id']]*results_df.shape[0]}), results_df.reset_index(drop=True)], axis=1)
+            store.write(memory['id'], results_df, types)
+            path_output = store.path
+        elif not self.append:
+            write_csv(path_output, results_df)
         else:
-            results_df.to_csv(path_output, mode='a', header=False, index=False)
-
-        logging.info(f' output: file:{path_output} ({time()-time_start:.2f}s)')
+            # idempotent if resumed: rows written by an interrupted attempt are not appended again
+            journal = memory.get('tmp/journal', None)
+            interrupted = journal is not None and journal.interrupted(self.output_df_name)
+            if journal is not None:
+                journal.intent(self.output_df_name)
+            if not append_csv(path_output, results_df, memory['id'], interrupted=interrupted):
+                logging.info(f' rows of case already appended by interrupted run, skipping')
+
+        # return exported data (last export of pipeline)
+        memory['tmp/return'] = results_df
+        written = self.write and self.writes(self.output_df_name)
+        logging.info(f' output: {f"file:{path_output}" if written else "memory:tmp/return"} ({time()-time_start:.2f}s)')
@@ -68,6 +68,6 @@ class MasksStanfordSpine(PipelineAction):
         logging.info(f' output: memory:{output_mask} ({time()-time_start:.2f}s)')
 
          # save mask if active
-        if self.config['vertebrae']['save_mask']:
-            output_mask.save_to_file()
+        if self.config['vertebrae']['save_mask'] and self.writes(self.output_mask_name):
+            output_mask.save_to_file(writer=self.writer)
             logging.info(f'  file saved')
@@ -3,7 +3,9 @@ import logging
 from BodyComposition.pipeline import PipelineAction
 from BodyComposition.utils.nifti import NiftiDataContainer
 from time import time
-from BodyComposition.utils.masks import filter_hu, remove_small_objects, filter_keep_largest, fill_holes
+from BodyComposition.utils.masks import filter_hu, remove_small_objects, filter_keep_largest, fill_holes, \
+    filter_keep_largest_fill_holes_slabs, slab_bounds, selection_bounds
+from nibabel.orientations import io_orientation
 from scipy.ndimage import median_filter as ndi_median_filter
 import numpy as np
 
@@ -71,8 +73,8 @@ class MasksTotalSegmentatorSpine(PipelineAction):
         logging.info(f' output: memory:{output_mask} ({time()-time_start:.2f}s)')
 
          # save mask if active
-        if self.config['vertebrae']['save_mask']:
-            output_mask.save_to_file()
+        if self.config['vertebrae']['save_mask'] and self.writes(self.output_mask_name):
+            output_mask.save_to_file(writer=self.writer)
             logging.info(f'  file saved')
 
 
@@ -88,6 +90,7 @@ class MasksTotalSegmentatorTissue(PipelineAction):
         self.output_mask_name = 'masks/{caseid}_tseg-tissue.nii.gz'
         self.io_inputs = [image, self.input_label_tissue_name]
         self.io_outputs = [self.output_mask_name]
+        self.io_sliced = [self.output_mask_name] # restricted to slices of exported levels, if set by pipeline
 
         # input
         self.input_image_name = image
@@ -137,21 +140,112 @@ class MasksTotalSegmentatorTissue(PipelineAction):
         output_np = input_label_tissue.data_np
         output_mask.meta = input_label_tissue.meta
         
+        # inputs: image for HU filters, iliopsoas label
+        hu_filter = any([self.config_tissue[tissue]['filter_hu'] for tissue in ['imat', 'sm', 'vat', 'sat']])
+        image_np, spacing = None, None
+        if hu_filter:
+            input_image = memory[self.input_image_name]
+            image_np, spacing = input_image.data_np, input_image.spacing
+            logging.debug(f'  HU filter(s) active, loaded image')
+        iliopsoas_np = memory[self.input_label_iliopsoas_name].data_np if self.iliopsoas else None
+        slab_slices = self.config_tissue.get('slab_slices', None)
+        slab_slices = None if str(slab_slices) in ('None', '') else int(slab_slices)
+
+        # slices of exported levels (canonical, inferior -> superior) to slices of label (axis 2), if along axis 2
+        selected = None
+        if 'tmp/slices' in self.io_inputs:
+            slices = memory['tmp/slices']
+            ornt = io_orientation(input_label_tissue.affine)
+            if int(ornt[2, 0]) == 2 and slices.size == output_np.shape[2]:
+                selected = slices[::-1] if ornt[2, 1] < 0 else slices
+                logging.info(f' restricted to {np.count_nonzero(selected)} slices of exported levels')
+            else:
+                logging.info(f' slices of exported levels not along axis 2 of label, full volume')
+
+        # full volume, or overlapping windows along z (slabs, slices of exported levels): halo of median and 3D small
+        # object filters, results written in place
+        if selected is not None:
+            bounds = selection_bounds(selected, slab_slices)
+        elif slab_slices is not None:
+            bounds = slab_bounds(output_np.shape[2], slab_slices)
+        else:
+            bounds = None
+        if bounds is None:
+            self._filter(output_np, image_np, iliopsoas_np, spacing)
+        else:
+            nz = output_np.shape[2]
+            halo = self._halo(spacing) if hu_filter else 0
+            logging.info(f' processing {len(bounds)} slabs of up to {max([z1 - z0 for z0, z1 in bounds], default=0)} slices, halo {halo} slices')
+            pending = [] # processed slabs, written when no further window reads their original labels
+            for i, (z0, z1) in enumerate(bounds):
+                w0, w1 = max(z0 - halo, 0), min(z1 + halo, nz)
+                window_np = output_np[:, :, w0:w1].copy()
+                self._filter(window_np,
+                             image_np[:, :, w0:w1] if image_np is not None else None,
+                             iliopsoas_np[:, :, w0:w1] if iliopsoas_np is not None else None,
+                             spacing)
+                pending.append((z0, z1, window_np[:, :, z0 - w0:z1 - w0]))
+                w0_next = max(bounds[i + 1][0] - halo, 0) if i + 1 < len(bounds) else nz
+                while pending and pending[0][1] <= w0_next:
+                    z0_done, z1_done, done_np = pending.pop(0)
+                    output_np[:, :, z0_done:z1_done] = done_np
+                del window_np
+
+        # remove extremities, ignore everything but bodytrunk
+        if self.bodytrunk:
+            input_label_bodytrunk = memory[self.input_label_bodytrunk_name]
+            if slab_slices is None:
+                tmp_mask = (input_label_bodytrunk.data_np==self.LBL_BODYTRUNK) # 1=bodytrunk, remove other labels
+                filter_keep_largest(tmp_mask)
+                fill_holes(tmp_mask)
+                output_np[np.logical_not(tmp_mask)] = 0
+            else:
+                bodytrunk_np = input_label_bodytrunk.data_np
+                bounds = slab_bounds(bodytrunk_np.shape[2], slab_slices)
+                slabs = filter_keep_largest_fill_holes_slabs(lambda z0, z1: bodytrunk_np[:, :, z0:z1]==self.LBL_BODYTRUNK,
+                                                             bodytrunk_np.shape, bounds)
+                for (z0, z1), tmp_mask in zip(bounds, slabs):
+                    output_np[:, :, z0:z1][np.logical_not(tmp_mask)] = 0
+            logging.info(f" removed extremities")
+
+        # slices not of exported levels: empty
+        if selected is not None:
+            output_np[:, :, ~selected] = 0
+
+        # logging
+        output_mask.data_np = output_np
+        logging.info(f' output: memory:{output_mask} ({time()-time_start:.2f}s)')
+
+        # save mask if active
+        if self.config_tissue['save_mask'] and self.writes(self.output_mask_name):
+            output_mask.save_to_file(writer=self.writer)
+            logging.info(f'  file saved')
+
+    def _halo(self, spacing) -> int:
+        """Slices around slabs, so that the HU filters give the results of the full volume: half the median kernel, and
+        per 3D small object filter the minimum size in voxels (components reaching further are larger and kept). SM is
+        filtered after IMAT was relabeled, VAT and SAT do not depend on other filters."""
+        pix_vol = spacing[0] * spacing[1] * spacing[2]
+        halo = {}
+        for tissue, size in [('imat', 'filter_size'), ('sm', 'filter_hu_size'), ('vat', 'filter_hu_size'), ('sat', 'filter_hu_size')]:
+            config = self.config_tissue[tissue]
+            active = config['filter_hu'] and config[size] and config[f'{size}_version'] == '3D' and config[f'{size}_3D'] > 0
+            halo[tissue] = int(np.ceil(config[f'{size}_3D'] / pix_vol)) if active else 0
+        halo_median = int(self.config_tissue['hu_denoise']['filter_median_kernel'][2]) // 2 \
+                      if self.config_tissue['hu_denoise']['filter_median'] else 0
+        return halo_median + max(halo['imat'] + halo['sm'], halo['vat'], halo['sat'])
+
+    def _filter(self, output_np, image_np, iliopsoas_np, spacing):
+        """Iliopsoas label and HU filters, in place on labels of the full volume or of a slab (with halo)."""
         # iliopsoas
         if self.iliopsoas:
-            input_label_iliopsoas = memory[self.input_label_iliopsoas_name]
-            tmp_np = np.isin(input_label_iliopsoas.data_np, self.LBL_PSOAS)
+            tmp_np = np.isin(iliopsoas_np, self.LBL_PSOAS)
             output_np[tmp_np] = self.LBL_TISSUE_R['PSOAS']
             logging.info(f' added new label for PSOAS (={self.LBL_TISSUE_R["PSOAS"]})')
 
         # if any HU-based filter active:
         if any([self.config_tissue[tissue]['filter_hu'] for tissue in ['imat', 'sm', 'vat', 'sat']]):
             
-            # load image np
-            input_image = memory[self.input_image_name]
-            image_np = input_image.data_np
-            logging.debug(f'  HU filter(s) active, loaded image')
-
             # denoising: clip outliers
             if self.config_tissue['hu_denoise']['filter_outliers']:
                 hu_range = self.config_tissue['hu_denoise']['filter_outliers_range']
@@ -170,7 +264,7 @@ class MasksTotalSegmentatorTissue(PipelineAction):
             mask_tmp = filter_hu(image_np, self.config_tissue['imat']['filter_hu_range'])
             if self.config_tissue['imat']['filter_size']:
                 remove_small_objects(mask_np = mask_tmp,
-                                     image_zooms=input_image.spacing,
+                                     image_zooms=spacing,
                                      limit_size_version=self.config_tissue['imat']['filter_size_version'],
                                      limit_size_2D=self.config_tissue['imat']['filter_size_2D'],
                                      limit_size_3D=self.config_tissue['imat']['filter_size_3D'])
@@ -188,7 +282,7 @@ class MasksTotalSegmentatorTissue(PipelineAction):
             mask_tmp_not = np.isin(output_np, [self.LBL_TISSUE_R['SM'], self.LBL_TISSUE_R['PSOAS']]) & np.logical_not(mask_tmp)
             if self.config_tissue['sm']['filter_hu_size']:
                 remove_small_objects(mask_np = mask_tmp_not,
-                                     image_zooms=input_image.spacing,
+                                     image_zooms=spacing,
                                      limit_size_version=self.config_tissue['sm']['filter_hu_size_version'],
                                      limit_size_2D=self.config_tissue['sm']['filter_hu_size_2D'],
                                      limit_size_3D=self.config_tissue['sm']['filter_hu_size_3D'])
@@ -203,7 +297,7 @@ class MasksTotalSegmentatorTissue(PipelineAction):
             mask_tmp_not = np.isin(output_np, self.LBL_TISSUE_R['VAT']) & np.logical_not(mask_tmp)
             if self.config_tissue['vat']['filter_hu_size']:
                 remove_small_objects(mask_np = mask_tmp_not,
-                                     image_zooms=input_image.spacing,
+                                     image_zooms=spacing,
                                      limit_size_version=self.config_tissue['vat']['filter_hu_size_version'],
                                      limit_size_2D=self.config_tissue['vat']['filter_hu_size_2D'],
                                      limit_size_3D=self.config_tissue['vat']['filter_hu_size_3D'])
@@ -218,28 +312,9 @@ class MasksTotalSegmentatorTissue(PipelineAction):
             mask_tmp_not = np.isin(output_np, self.LBL_TISSUE_R['SAT']) & np.logical_not(mask_tmp)
             if self.config_tissue['sat']['filter_hu_size']:
                 remove_small_objects(mask_np = mask_tmp_not,
-                                     image_zooms=input_image.spacing,
+                                     image_zooms=spacing,
                                      limit_size_version=self.config_tissue['sat']['filter_hu_size_version'],
                                      limit_size_2D=self.config_tissue['sat']['filter_hu_size_2D'],
                                      limit_size_3D=self.config_tissue['sat']['filter_hu_size_3D'])
             output_np[mask_tmp_not] = 0
             logging.info(f"  negative filter -> SAT")
-
-
-        # remove extremities, ignore everything but bodytrunk
-        if self.bodytrunk:
-            input_label_bodytrunk = memory[self.input_label_bodytrunk_name]
-            tmp_mask = (input_label_bodytrunk.data_np==self.LBL_BODYTRUNK) # 1=bodytrunk, remove other labels
-            filter_keep_largest(tmp_mask)
-            fill_holes(tmp_mask)
-            output_np[np.logical_not(tmp_mask)] = 0
-            logging.info(f" removed extremities")
-
-        # logging
-        output_mask.data_np = output_np
-        logging.info(f' output: memory:{output_mask} ({time()-time_start:.2f}s)')
-
-        # save mask if active
-        if self.config_tissue['save_mask']:
-            output_mask.save_to_file()
-            logging.info(f'  file saved')
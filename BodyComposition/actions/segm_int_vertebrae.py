@@ -7,6 +7,7 @@ from time import time
 import logging
 import contextlib
 from BodyComposition.utils.logging import LoggingWriter, log_gpu_usage
+from BodyComposition.utils.cache import LabelCache
 
 # action class
 class SegmIntVertebrae(PipelineAction):
@@ -38,6 +39,14 @@ class SegmIntVertebrae(PipelineAction):
         else:
             raise ValueError(f'unknown model: {model}')
 
+        # models are loaded in the worker process, if supervised
+        if not self.load_models:
+            return
+
+        # content-addressed label cache, model definition as part of the key
+        self.cache = LabelCache.from_config(self.config)
+        self.cache_model = {'model': 'nnunetv2', 'version': LabelCache.version('nnunetv2'), 'path': str(model_path), 'folds': model_folds}
+
         # redirect stdout and stderr to logging
         sl = LoggingWriter(logging.DEBUG)
         with contextlib.redirect_stdout(sl), contextlib.redirect_stderr(sl):
@@ -76,11 +85,18 @@ class SegmIntVertebrae(PipelineAction):
         # check if segmentation already available
         if output_label.exists() and self.config['run']['skip']:
             logging.info(f' output: {output_label} available, skipping')
-        else:
-            # load input container, log
-            input_image = memory[self.input_image_name]
-            logging.info(f' input: {input_image}')
+            return
+
+        # load input container, log
+        input_image = memory[self.input_image_name]
+        logging.info(f' input: {input_image}')
 
+        # check if segmentation available in label cache
+        cache_key = self.cache.key(input_image, self.cache_model) if self.cache is not None else None
+        if cache_key is not None and self.cache.restore(cache_key, output_label, input_image):
+            logging.info(f' output: restored from {self.cache} ({time() - time_start:.2f}s)')
+
+        else:
             # load metadata from input image
             output_label.meta = input_image.meta
 
@@ -100,13 +116,18 @@ class SegmIntVertebrae(PipelineAction):
                 log_gpu_usage()
 
             # revert transpose, save segmentation
-            output_label.data_np = tmp_segm.transpose((2, 1, 0))
+            output_label.set_data(tmp_segm.transpose((2, 1, 0)), copy=False)
 
             # logging
             logging.info(f' finished segmentation ({time() - time_start:.2f}s)')
             logging.info(f' output: memory:{output_label.path}')
 
-            # saving
-            if self.config['segmentation']['save_label']:
-                output_label.save_to_file()
-                logging.info(f' saved file')
+            # add to label cache
+            if self.cache is not None:
+                self.cache.put(cache_key, output_label)
+                logging.info(f' added to {self.cache}')
+
+        # saving
+        if self.config['segmentation']['save_label'] and self.writes(self.output_label_name):
+            output_label.save_to_file(writer=self.writer)
+            logging.info(f' saved file')
@@ -7,11 +7,7 @@ from time import time
 import logging
 import contextlib
 from BodyComposition.utils.logging import LoggingWriter, log_gpu_usage
-
-# library nnUNet
-sl = LoggingWriter(logging.DEBUG)
-with contextlib.redirect_stdout(sl), contextlib.redirect_stderr(sl):
-    from nnunet.inference.predict import predict_from_folder
+from BodyComposition.utils.cache import LabelCache
 
 # other
 import sys
@@ -19,7 +15,6 @@ import tempfile
 from pathlib import Path
 import multiprocessing
 from nibabel import load as nib_load, save as nib_save
-from totalsegmentator.alignment import as_closest_canonical, undo_canonical
 
 # action class
 class SegmStanfordSpine(PipelineAction):
@@ -45,6 +40,20 @@ class SegmStanfordSpine(PipelineAction):
         self.model_path = str(pipeline.config['paths']['weights']['stanford-spine'])
         self.device = pipeline.device
 
+        # load nnUNetv1 and reorientation, imported only if used
+        if not self.load_models:
+            return
+        sl = LoggingWriter(logging.DEBUG)
+        with contextlib.redirect_stdout(sl), contextlib.redirect_stderr(sl):
+            from nnunet.inference.predict import predict_from_folder
+        from totalsegmentator.alignment import as_closest_canonical
+        self.predict_from_folder = predict_from_folder
+        self.as_closest_canonical = as_closest_canonical
+
+        # content-addressed label cache, model definition as part of the key
+        self.cache = LabelCache.from_config(self.config)
+        self.cache_model = {'model': 'nnunetv1', 'version': LabelCache.version('nnunet'), 'path': self.model_path, 'folds': [0], 'checkpoint': 'model_best'}
+
 
     def __call__(self, memory):
         """Segment case."""
@@ -58,11 +67,18 @@ class SegmStanfordSpine(PipelineAction):
         # check if segmentation already available
         if output_label.exists() and self.config['run']['skip']:
             logging.info(f' output: {output_label} available, skipping')
+            return
+
+        # load input container, log
+        input_image = memory[self.input_image_name]
+        logging.info(f' input: {input_image}')
+
+        # check if segmentation available in label cache
+        cache_key = self.cache.key(input_image, self.cache_model) if self.cache is not None else None
+        if cache_key is not None and self.cache.restore(cache_key, output_label, input_image):
+            logging.info(f' output: restored from {self.cache} ({time() - time_start:.2f}s)')
+
         else:
-            # load input container, log
-            input_image = memory[self.input_image_name]
-            logging.info(f' input: {input_image}')
-        
             # do segmentation
             logging.info(f' running segmentation using nnUNetv1|StanfordSpinev2')
 
@@ -73,7 +89,7 @@ class SegmStanfordSpine(PipelineAction):
 
                 # load, reorientate & save image temporarily
                 input_image_nib = input_image.data_nib
-                nib_save(as_closest_canonical(input_image_nib), tmp_dir / "s01_0000.nii.gz")
+                nib_save(self.as_closest_canonical(input_image_nib), tmp_dir / "s01_0000.nii.gz")
 
                 # redirect stdout and stderr from nnunet to logging
                 sl = LoggingWriter(logging.DEBUG)
@@ -85,15 +101,15 @@ class SegmStanfordSpine(PipelineAction):
                         multiprocessing.set_start_method('fork', force=True)
                         logging.warning(f'multiprocessing method temporarily forced to `fork` to avoid pickle error @arm64.')
 
-                    predict_from_folder(model=self.model_path,
-                                        input_folder=str(tmp_dir), output_folder=str(tmp_dir),
-                                        folds=[0],
-                                        save_npz=False, num_threads_preprocessing=1, num_threads_nifti_save=1,
-                                        lowres_segmentations=None,
-                                        part_id=0, num_parts=1, tta=False, mixed_precision=True,
-                                        overwrite_existing=True, mode="fastest", overwrite_all_in_gpu=True if self.device.type=='cuda' else False,
-                                        step_size=0.5, checkpoint_name="model_best",
-                                        segmentation_export_kwargs=None, disable_postprocessing=False)
+                    self.predict_from_folder(model=self.model_path,
+                                             input_folder=str(tmp_dir), output_folder=str(tmp_dir),
+                                             folds=[0],
+                                             save_npz=False, num_threads_preprocessing=1, num_threads_nifti_save=1,
+                                             lowres_segmentations=None,
+                                             part_id=0, num_parts=1, tta=False, mixed_precision=True,
+                                             overwrite_existing=True, mode="fastest", overwrite_all_in_gpu=True if self.device.type=='cuda' else False,
+                                             step_size=0.5, checkpoint_name="model_best",
+                                             segmentation_export_kwargs=None, disable_postprocessing=False)
                     log_gpu_usage()
 
                     # back to spawn to avoid speed loss if nnUNetv2 is used later
@@ -107,7 +123,12 @@ class SegmStanfordSpine(PipelineAction):
             logging.info(f' finished segmentation ({time() - time_start:.2f}s)')
             logging.info(f'  output: memory{output_label.path}')
 
-            # saving
-            if self.config['segmentation']['save_label']:
-                output_label.save_to_file()
-                logging.info(f'  file saved')
\ No newline at end of file
+            # add to label cache
+            if self.cache is not None:
+                self.cache.put(cache_key, output_label)
+                logging.info(f'  added to {self.cache}')
+
+        # saving
+        if self.config['segmentation']['save_label'] and self.writes(self.output_label_name):
+            output_label.save_to_file(writer=self.writer)
+            logging.info(f'  file saved')
@@ -4,10 +4,9 @@ from BodyComposition.utils.nifti import NiftiDataContainer
 from time import time
 import logging
 
-# specific libraries
-from totalsegmentator.python_api import totalsegmentator
-from totalsegmentator.config import setup_nnunet, setup_totalseg
+# specific libraries, totalsegmentator imported when actions are initialized
 from BodyComposition.utils.logging import LoggingWriter, log_gpu_usage
+from BodyComposition.utils.cache import LabelCache
 import contextlib
 import os
 
@@ -25,6 +24,9 @@ class SegmTotalSegmentatorConfig(PipelineAction):
             os.environ["TOTALSEG_HOME_DIR"] = path_tseg_config
         if path_tseg_weights not in ('None', ''):
             os.environ["TOTALSEG_WEIGHTS_PATH"] = path_tseg_weights
+        if not self.load_models:
+            return
+        from totalsegmentator.config import setup_nnunet, setup_totalseg
         setup_nnunet()
         setup_totalseg()
 
@@ -92,6 +94,21 @@ class SegmTotalSegmentator(PipelineAction):
         if self.task_config['license_nc']:
             self.licenses.append('totalsegmentator_nc')
 
+        # load totalsegmentator, imported only if used
+        if not self.load_models:
+            return
+        from totalsegmentator.python_api import totalsegmentator
+        self.totalsegmentator = totalsegmentator
+
+        # content-addressed label cache, model definition as part of the key
+        self.cache = LabelCache.from_config(self.config)
+        self.cache_model = {'model': 'totalsegmentator',
+                            'version': LabelCache.version('TotalSegmentator'),
+                            'weights': str(self.config['paths']['weights']['totalsegmentator']),
+                            'task': self.task_config['task'],
+                            'fast': self.task_config['fast'],
+                            'roi_subset': self.task_config['roi_subset']}
+
 
     def __call__(self, memory):
         """Segment case."""
@@ -105,16 +122,23 @@ class SegmTotalSegmentator(PipelineAction):
         # check if segmentation already available
         if output_label.exists() and self.config['run']['skip']:
             logging.info(f' output: {output_label} available, skipping')
-        else:
-            # load input container, log
-            input_image = memory[self.input_image_name]
-            logging.info(f' input: {input_image}')
+            return
+
+        # load input container, log
+        input_image = memory[self.input_image_name]
+        logging.info(f' input: {input_image}')
 
+        # check if segmentation available in label cache
+        cache_key = self.cache.key(input_image, self.cache_model) if self.cache is not None else None
+        if cache_key is not None and self.cache.restore(cache_key, output_label, input_image):
+            logging.info(f' output: restored from {self.cache} ({time() - time_start:.2f}s)')
+
+        else:
             # do segmentation, redirect stdout and stderr to logging
             logging.info(f' running segmentation using totalsegmentator')
             sl = LoggingWriter(logging.DEBUG)
             with contextlib.redirect_stdout(sl), contextlib.redirect_stderr(sl):
-                output_label.data_nib = totalsegmentator(input=input_image.data_nib,
+                output_label.data_nib = self.totalsegmentator(input=input_image.data_nib,
                                                          output=None,
                                                          ml=True,
                                                          nr_thr_resamp=1,
@@ -145,7 +169,12 @@ class SegmTotalSegmentator(PipelineAction):
             logging.info(f' finished segmentation ({time() - time_start:.2f}s)')
             logging.info(f' output: memory:{output_label.path}')
 
-            # saving
-            if self.config['segmentation']['save_label']:
-                output_label.save_to_file()
-                logging.info(f' saved file')
\ No newline at end of file
+            # add to label cache
+            if self.cache is not None:
+                self.cache.put(cache_key, output_label)
+                logging.info(f' added to {self.cache}')
+
+        # saving
+        if self.config['segmentation']['save_label'] and self.writes(self.output_label_name):
+            output_label.save_to_file(writer=self.writer)
+            logging.info(f' saved file')
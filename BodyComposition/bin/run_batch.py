@@ -2,8 +2,9 @@
 import argparse
 import ast
 import os
+import signal
+import sys
 from pathlib import Path
-from BodyComposition.python_api import bodycomposition
 
 # helper functions
 def looks_like_dict(s):
@@ -32,6 +33,12 @@ def main():
                         help='Path to configuration file (*.yaml), or dictionary. Can be used to update the default configuration.')
     parser.add_argument('--method', '-m', type=str, default='BodyCompositionFast',
                         help='Name of pipeline method to be run.')
+    parser.add_argument('--watch', '-w', action='store_true',
+                        help='Watch input directory, process new files as they arrive until interrupted (see `watch` in config).')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Process only shard `i/n` of the cases (e.g., `0/4`), assigned by hash of the case id.')
+    parser.add_argument('--queue', '-q', type=str, default=None,
+                        help='Path to shared work queue directory, cases are claimed one by one by all nodes using the same queue.')
     args = parser.parse_args()
 
     # transform config
@@ -44,11 +51,28 @@ def main():
     else:
         config = None
 
-    # run pipeline
+    # watch mode: run until interrupted (SIGINT, SIGTERM)
+    if args.watch:
+        from BodyComposition.python_api import bodycomposition_watch
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for _ in bodycomposition_watch(input = Path(args.input),
+                                           input_filter = args.filter,
+                                           config = config,
+                                           method = args.method):
+                pass
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # run pipeline, api imported after parsing to keep `--help` fast
+    from BodyComposition.python_api import bodycomposition
     bodycomposition(input = Path(args.input),
                     input_filter = args.filter,
                     config = config,
-                    method = args.method)
+                    method = args.method,
+                    shard = args.shard,
+                    queue = args.queue)
             
 if __name__ == "__main__":
     main() # parser is in main to be available when using pyproject.toml entrypoint
@@ -3,34 +3,44 @@ from time import time
 from typing import Dict, List, Tuple
 from pathlib import Path
 from BodyComposition.utils.nifti import NiftiDataContainer
-from BodyComposition.pipeline_registry import pipeline_registry
+from BodyComposition.pipeline_registry import get_pipeline
+from BodyComposition.utils.profiling import ActionProfiler
+from BodyComposition.utils.supervisor import CaseSupervisor
+from BodyComposition.utils.journal import CaseJournal, pipeline_fingerprint
+from BodyComposition.utils.admission import MemoryModel, MemoryAdmission
+from BodyComposition.utils.writer import BackgroundWriter
+from BodyComposition.utils.codecs import NiftiCodec
+from contextlib import nullcontext
 import traceback
-import signal
 from tqdm import tqdm
 import sys
 import tempfile
-import torch
 import multiprocessing
+import numpy as np
 import os
 
-# timeout handler
-def timeout_handler(signum, frame):
-    raise TimeoutError()
-signal.signal(signal.SIGALRM, timeout_handler)
-
-# underlying processor
+# underlying processor: in supervised worker process if timeout is set, otherwise in current process
+# cases start when admitted by the memory budget of the node, if set
 def _run_case(pipeline, memory):
     try:
-        signal.alarm(pipeline.config['run']['timeout'])
-        output = pipeline(memory)
-        signal.alarm(0)
-        return output
+        with pipeline.admit(memory):
+            return _run_admitted(pipeline, memory)
     except TimeoutError:
-        logging.warning(f"TIMEOUT CASE {memory['id']}\n")
+        logging.warning(f"TIMEOUT CASE {memory['id']} in action {memory.get('tmp/timeout')}\n")
     except Exception as e:
         logging.error(f"ERROR CASE {memory['id']}:\n {e}\n {traceback.format_exc()}\n")
+    finally:
+        memory['tmp/index'].release_shared(copy=False)
     return None
 
+def _run_admitted(pipeline, memory):
+    if pipeline.supervisor is not None:
+        # in-memory input is handed to the worker in shared memory (zero-copy) instead of being pickled
+        if memory['tmp/index'].loaded:
+            memory['tmp/index'].share()
+        return pipeline.supervisor(memory)
+    return pipeline(memory)
+
 # run pipeline on single file
 def run_file(pipeline, input_file, workspace=None):
     logging.info(f"STARTING PIPELINE:\n")
@@ -44,17 +54,37 @@ def run_file(pipeline, input_file, workspace=None):
     logging.info("FINISHED PIPELINE.")
     return output
 
-# run pipeline on batch of files
-def run_batch(pipeline, input_datalist):
+# run pipeline on in-memory images (caseid, Nifti1Image), yield (caseid, output, timings) after each case
+def iter_images(pipeline, input_images, workspace):
     logging.info(f"STARTING PIPELINE:\n")
-    output = None
-    for caseid, input_file, workspace in tqdm(input_datalist, total=len(input_datalist),
+    for caseid, input_file in input_images:
+        memory = {'id': caseid,
+                  'workspace': workspace,
+                  'tmp/index': NiftiDataContainer(Path(workspace)/f'images/{caseid}.nii.gz'),}
+        memory['tmp/index'].data_nib = input_file
+        timer = time()
+        output = _run_case(pipeline, memory)
+        yield caseid, output, {'total_s': time() - timer, 'actions': memory.get('tmp/timings', []), 'timeout': memory.get('tmp/timeout')}
+    logging.info("FINISHED PIPELINE.")
+
+# run pipeline on batch of files, yield (caseid, output, timings) after each case
+def iter_batch(pipeline, input_datalist, progress: bool = True):
+    logging.info(f"STARTING PIPELINE:\n")
+    for caseid, input_file, workspace in tqdm(input_datalist, total=len(input_datalist), disable=not progress,
                                                desc="Processing", unit="case", position=0, leave=True, file=sys.stdout, ncols=80):
         memory = {'id': caseid,
                   'workspace': workspace,
                   'tmp/index': NiftiDataContainer(input_file),}
+        timer = time()
         output = _run_case(pipeline, memory)
+        yield caseid, output, {'total_s': time() - timer, 'actions': memory.get('tmp/timings', []), 'timeout': memory.get('tmp/timeout')}
     logging.info("FINISHED PIPELINE.")
+
+# run pipeline on batch of files
+def run_batch(pipeline, input_datalist):
+    output = None
+    for _, output, _ in iter_batch(pipeline, input_datalist):
+        pass
     return output
 
 
@@ -65,8 +95,15 @@ class PipelineAction():
     def __init__(self, pipeline, task=None):
         logging.info(f' initialize {self.__class__.__name__}{f"/{task}" if task else ""}')
         self.config = pipeline.config
+        self.writer = getattr(pipeline, 'writer', None) # background saving of files, if active
+        self.load_models = getattr(pipeline, 'load_models', True) # False: only declared (io, licenses), cases run in worker process
         self.io_inputs = []
         self.io_outputs = []
+        self.io_compact = [] # inputs queried as labelmap only (per slice counts, bounding boxes), can be held compactly
+        self.io_appends = [] # files appended by all cases (e.g. exports/all.csv), not in io_outputs: ignored in reset and io-checks
+        self.io_pruned = set() # file outputs not contributing to the requested outputs of the pipeline, not written
+        self.io_sliced = [] # outputs that can be computed on the slices of exported levels only (input `tmp/slices`)
+        self.io_levels = None # outputs are subsets of rows by levels {ref: labels}, e.g. DataSubset by `Level`
         pass
 
     def __call__(self, memory, task=None) -> Dict:
@@ -75,49 +112,228 @@ class PipelineAction():
     def __repr__(self):
         return self.__class__.__name__
 
+    def writes(self, output: str) -> bool:
+        """Whether the file of `output` (io_outputs, io_appends) is written, False if pruned by requested outputs."""
+        return output not in self.io_pruned
+
 
 
 class PipelineBuilder():
     """Pipeline class"""
 
-    def __init__(self, method: str, config: Dict, timestamp: int):
-        """Initialize pipeline."""
+    def __init__(self, method: str, config: Dict, timestamp: int, outputs: List[str] = None):
+        """Initialize pipeline. `outputs`: requested final outputs (default: config `run/outputs`), other actions and
+        file writes are pruned."""
         logging.info(f'BUILDING PIPELINE {method.upper()}:')
-        
+
+        # requested outputs to config, e.g. for the worker process and fingerprint
+        if outputs is not None:
+            config = {**config, 'run': {**config['run'], 'outputs': list(outputs)}}
+
         # save main parameters as attributes
         self.method = method
         self.config = config
         self.timestamp = timestamp
 
-        # set device
-        if torch.cuda.is_available():
-            torch.set_num_threads(1)
-            torch.set_num_interop_threads(1)
-            self.device = torch.device('cuda')
-            os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID" 
-            logging.info(f'device set to cuda: using {torch.cuda.get_device_name()}.')
+        # supervised worker process per case if timeout is set: the worker builds the pipeline with models, this process
+        # only declares the actions (io, licenses, names), models are not loaded here
+        timeout = config['run']['timeout']
+        supervised = str(timeout) not in ('None', '', '0')
+        self.load_models = not supervised
+
+        # set device, torch imported only when a pipeline is built (with models)
+        if supervised:
+            self.device = None
+            logging.info(f'device set in supervised worker process')
         else:
-            torch.set_num_threads(multiprocessing.cpu_count())
-            self.device = torch.device('cpu')
-            logging.info(f'CUDA not available, using cpu w/ {torch.get_num_threads()} threads')
+            import torch
+            if torch.cuda.is_available():
+                torch.set_num_threads(1)
+                torch.set_num_interop_threads(1)
+                self.device = torch.device('cuda')
+                os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID" 
+                logging.info(f'device set to cuda: using {torch.cuda.get_device_name()}.')
+            else:
+                torch.set_num_threads(multiprocessing.cpu_count())
+                self.device = torch.device('cpu')
+                logging.info(f'CUDA not available, using cpu w/ {torch.get_num_threads()} threads')
 
-        # check if method is valid
-        if method not in pipeline_registry:
-            raise ValueError(f'Undefined pipeline method: {method}')
+        # writer for labels and masks (background threads, if write_workers > 0), compressed by codec, available to actions
+        self.writer = BackgroundWriter(workers=int(config['run']['write_workers']),
+                                       max_pending=int(config['run']['write_pending']),
+                                       codec=NiftiCodec.from_config(config))
+
+        # check if method is valid, import pipeline definition
+        pipeline_definition = get_pipeline(method)
 
         # function factory: load actions, use list of functions
         logging.info(f'initalizing pipeline actions:')
-        self.actions = pipeline_registry[method](pipeline=self)
+        self.actions = pipeline_definition(pipeline=self)
 
         # check if all actions are valid
         for action in self.actions:
             if not isinstance(action, PipelineAction):
                 raise TypeError(f'Invalid PipelineAction: {action}')
 
+        # prune actions and file writes not contributing to the requested outputs
+        outputs = config['run'].get('outputs', None)
+        if str(outputs) not in ('None', ''):
+            self.pruned = self._prune(list(outputs))
+        else:
+            self.pruned = None
+
+        # restrict actions to the slices of exported levels, if only subsets of levels are exported
+        if config['run'].get('target_levels', False):
+            self.levels, self.levels_index = self._target_levels()
+        else:
+            self.levels, self.levels_index = None, None
+        self.names = [self._name(action) for action in self.actions]
+
+        # profiler for actions, optional
+        if config['profiling']['active']:
+            self.profiler = ActionProfiler(str(config['profiling']['file']).format(method=method, timestamp=timestamp))
+        else:
+            self.profiler = None
+
+        # journal of completed actions per case, to resume interrupted cases
+        if config['run']['resume']:
+            self.journal_file = CaseJournal.file
+            self.fingerprint = pipeline_fingerprint(method, self.actions, config)
+        else:
+            self.journal_file = None
+
+        # release volumes after their last use: keys per action, after which the containers are cleared
+        if config['run']['release_memory']:
+            keep = set(config['run']['release_keep'] or [])
+            last_use = {}
+            for index, action in enumerate(self.actions):
+                for key in [*action.io_inputs, *action.io_outputs]:
+                    last_use[key] = index
+            self.release = [[key for key, index_last in last_use.items() if index_last == index and key not in keep]
+                            for index in range(len(self.actions))]
+        else:
+            self.release = None
+
+        # compact label volumes after an action, if all subsequent actions using them only query them compactly
+        if config['run']['compact_labels']:
+            uses = {}
+            for index, action in enumerate(self.actions):
+                for key in {*action.io_inputs, *action.io_outputs}:
+                    uses.setdefault(key, []).append(index)
+            self.compact = [[key for key, indices in uses.items()
+                             if index in indices and indices[-1] > index
+                             and all(key in self.actions[later].io_compact for later in indices if later > index)]
+                            for index in range(len(self.actions))]
+        else:
+            self.compact = None
+
+        # memory model: estimated peak per case, calibrated by measured peaks; admission of cases by memory budget of node
+        budget = config['run']['memory_budget_gb']
+        if str(budget) not in ('None', ''):
+            self.memory_model = MemoryModel(config['run']['memory_model'], self.names)
+            self.admission = MemoryAdmission(budget)
+            logging.info(f'  memory budget: {budget} GB per node, {self.memory_model}')
+        else:
+            self.memory_model, self.admission = None, None
+
+        # supervised worker process per case if timeout is set, started with the first case
+        if supervised:
+            self.supervisor = CaseSupervisor(self, timeout=float(timeout))
+        else:
+            self.supervisor = None
+
         # log
         logging.info(f'building completed.\n')
         
 
+    @staticmethod
+    def _name(action) -> str:
+        return f'{action}/{action.task}' if getattr(action, 'task', None) else f'{action}'
+
+    def _prune(self, outputs: List[str]) -> Dict[str, List[str]]:
+        """
+        Keep actions contributing to the requested outputs, following io_inputs/io_outputs backwards: an action is kept
+        if it produces a key required later, its inputs are then required. Actions without outputs (e.g. configuration)
+        are kept. Files of kept actions that are not requested are not written (`io_pruned`).
+        returns: names of pruned actions and pruned file writes
+        """
+        available = {key for action in self.actions for key in [*action.io_outputs, *action.io_appends]}
+        missing = [output for output in outputs if output not in available]
+        if missing:
+            raise ValueError(f'Requested outputs not produced by pipeline {self.method}: {missing}')
+
+        # backwards: required keys, kept actions
+        required = set(outputs)
+        kept, pruned_actions = [], []
+        for action in reversed(self.actions):
+            produced = {*action.io_outputs, *action.io_appends}
+            if produced and not produced & required:
+                pruned_actions.insert(0, self._name(action))
+                continue
+            required.update(action.io_inputs)
+            kept.insert(0, action)
+        self.actions = kept
+
+        # files of kept actions, not requested
+        pruned_writes = []
+        for action in self.actions:
+            files = [key for key in action.io_outputs if not key.startswith('tmp/')] + action.io_appends
+            action.io_pruned = {key for key in files if key not in outputs}
+            pruned_writes.extend(key for key in files if key not in outputs and key not in pruned_writes)
+        logging.info(f'  requested outputs: {outputs}')
+        logging.info(f'  pruned actions: {pruned_actions or None}')
+        logging.info(f'  pruned writes: {pruned_writes or None}')
+        return {'actions': pruned_actions, 'writes': pruned_writes}
+
+    def _target_levels(self) -> Tuple[Dict[str, List[int]], int]:
+        """
+        Levels of the exported rows, if all data derived from restrictable outputs (io_sliced) after the vertebral levels
+        (`tmp/vertebrae_values`) reach exports only as subsets of levels (io_levels), and are neither written to files
+        nor returned. Actions are then restricted to the slices of these levels (input `tmp/slices`).
+        returns: levels {ref: labels} and index of action producing the vertebral levels, or None, None
+        """
+        index = next((i for i, action in enumerate(self.actions) if 'tmp/vertebrae_values' in action.io_outputs), None)
+        if index is None:
+            return None, None
+
+        # follow keys derived from restricted outputs, until subset by levels
+        derived, levels, sliced = set(), {}, []
+        for action in self.actions[index + 1:]:
+            inputs = derived.intersection(action.io_inputs)
+            if inputs and action.io_levels:
+                for ref, labels in action.io_levels.items():
+                    levels[ref] = sorted({*levels.get(ref, []), *labels})
+                derived.difference_update(action.io_outputs)
+                continue
+            outputs = set(action.io_outputs + action.io_appends) if inputs else set()
+            if action.io_sliced:
+                sliced.append(action)
+                outputs.update(action.io_sliced)
+            files = [key for key in outputs if not key.startswith('tmp/') and action.writes(key)]
+            if files or (inputs and not outputs):
+                logging.info(f'  levels: not restricted, {self._name(action)} writes or uses all slices ({files or sorted(inputs)})')
+                return None, None
+            derived.update(outputs)
+        if 'tmp/return' in derived or not levels or not sliced:
+            return None, None
+
+        # restricted actions use slices of levels
+        for action in sliced:
+            action.io_inputs.append('tmp/slices')
+        logging.info(f'  levels: {", ".join(self._name(action) for action in sliced)} restricted to slices of {levels}')
+        return levels, index
+
+    @staticmethod
+    def _slices(memory, levels: Dict[str, List[int]]):
+        """Slices (canonical, inferior -> superior) of levels, from vertebral levels per slice."""
+        values = memory['tmp/vertebrae_values']
+        columns = {'Level': 1, 'Center': 2, 'Centroid': 3}
+        slices = np.zeros(values.shape[0], dtype=bool)
+        for ref, labels in levels.items():
+            slices[values[np.isin(values[:, columns[ref]], labels), 0]] = True
+        logging.debug(f' slices of levels {levels}: {np.count_nonzero(slices)} of {slices.size}')
+        return slices
+
     def get_io(self) -> Tuple[List, List]:
         """
         get input and output files for built pipeline
@@ -128,11 +344,19 @@ class PipelineBuilder():
         io_outputs_set = set()
         for action in self.actions:
             io_inputs.extend(input for input in action.io_inputs if input not in io_outputs_set and not input.startswith('tmp/'))
-            new_outputs = [output for output in action.io_outputs if not output.startswith('tmp/')]
+            new_outputs = [output for output in action.io_outputs if not output.startswith('tmp/') and action.writes(output)]
             io_outputs.extend(new_outputs)
-            io_outputs_set.update(new_outputs)
+            io_outputs_set.update(action.io_outputs) # produced, written or not
         return io_inputs, io_outputs
     
+    def get_appends(self) -> List[Tuple[str, str]]:
+        """
+        get files appended by all cases (e.g. exports/all.csv) and their results store, if written
+        returns: list of (file, store)
+        """
+        return [(file, getattr(action, 'store', 'csv')) for action in self.actions for file in action.io_appends
+                if action.writes(file) and getattr(action, 'write', True)]
+    
     def get_licenses(self) -> List[str]:
         """
         get licenses for built pipeline
@@ -144,13 +368,81 @@ class PipelineBuilder():
                 licenses.extend(action.licenses)
         return list(set(licenses))
 
+    def admit(self, memory):
+        """Context manager: waits until the case fits into the memory budget of the node, if set."""
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.admit(memory['id'], self.memory_model.estimate(memory['tmp/index']))
+
+    @staticmethod
+    def _release(memory, keys):
+        """Clear data of containers not used by subsequent actions, paths and metadata are kept."""
+        for key in keys:
+            container = memory.get(key)
+            if isinstance(container, NiftiDataContainer) and container.nbytes:
+                logging.debug(f' released {key} ({container.nbytes / 1024**2:.1f} MB)')
+                container.clear()
+
+    @staticmethod
+    def _compact(memory, keys):
+        """Hold label volumes compactly, that are only queried by subsequent actions."""
+        for key in keys:
+            container = memory.get(key)
+            if isinstance(container, NiftiDataContainer) and container._data_np is not None:
+                nbytes = container.nbytes
+                if container.compact():
+                    logging.debug(f' compacted {key} ({nbytes / 1024**2:.1f} MB -> {container.nbytes / 1024**2:.1f} MB)')
+
+    def close(self):
+        """Stop the supervised worker process, if any, and the background writer."""
+        if self.supervisor is not None:
+            self.supervisor.close()
+        if self.writer is not None:
+            self.writer.close()
 
-    def __call__(self, memory):
+    def __call__(self, memory, on_action=None):
+        """Run all actions on memory of a case, `on_action(name)` is called before each action. Returns `tmp/return`."""
         logging.info(f"PROCESSING CASE {memory['id']}:")
         logging.info(f"workspace: {memory['workspace']}")
         timer = time()
-        for action in self.actions:
-            action(memory)
+        timings = memory['tmp/timings'] = []
+        names = self.names
+
+        # restore memory of completed actions from journal
+        journal, start = None, 0
+        if self.journal_file is not None:
+            journal = memory['tmp/journal'] = CaseJournal(Path(memory['workspace'], self.journal_file.format(caseid=memory['id'])), self.fingerprint)
+            start = journal.resume(memory, names)
+
+        try:
+            for index in range(start, len(self.actions)):
+                action, name = self.actions[index], names[index]
+                if on_action is not None:
+                    on_action(name)
+                timer_action = time()
+                with self.profiler.record(action, memory) if self.profiler else nullcontext(), \
+                     self.memory_model.measure(name, memory) if self.memory_model else nullcontext():
+                    action(memory)
+                timings.append((name, time() - timer_action))
+                if index == self.levels_index:
+                    memory['tmp/slices'] = self._slices(memory, self.levels)
+                if self.compact is not None:
+                    self._compact(memory, self.compact[index])
+                if self.release is not None:
+                    self._release(memory, self.release[index])
+                if journal is not None:
+                    journal.commit(name, memory)
+            if self.writer is not None:
+                self.writer.flush() # files of case saved, errors raised
+            if journal is not None:
+                journal.remove()
+            if self.memory_model is not None:
+                self.memory_model.calibrate(memory)
+        finally:
+            if self.writer is not None:
+                self.writer.flush(raise_errors=False)
+            if self.profiler:
+                self.profiler.flush(memory)
         logging.info(f"FINISHED CASE {memory['id']} ({time() - timer:.1f}s)\n")
         return memory.get('tmp/return', None)
 
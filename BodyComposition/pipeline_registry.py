@@ -3,19 +3,27 @@
 # The pipeline build is used to process each case
 # different executers can be used to process the pipeline
 
-# pipeline definitions import
-from BodyComposition.pipelines.bodycomposition import BodyComposition, BodyCompositionFast
-from BodyComposition.pipelines.totalsegmentator import SarcopeniaTotalSegmentator, SarcopeniaTotalSegmentatorFast
-from BodyComposition.pipelines.stanford import SarcopeniaStanford
-
-# add other pipelines to import here
+# pipeline definitions are registered as import paths (`module:function`), imported only if selected
+# callables can be registered directly, e.g. `pipeline_registry['MyPipeline'] = MyPipeline`
+from importlib import import_module
 
 # dictionary of pipeline definitions
 pipeline_registry = {
-    'BodyComposition': BodyComposition,
-    'BodyCompositionFast': BodyCompositionFast,
-    'SarcopeniaTotalSegmentator': SarcopeniaTotalSegmentator,
-    'SarcopeniaTotalSegmentatorFast': SarcopeniaTotalSegmentatorFast,
-    'SarcopeniaStanford': SarcopeniaStanford,
+    'BodyComposition': 'BodyComposition.pipelines.bodycomposition:BodyComposition',
+    'BodyCompositionFast': 'BodyComposition.pipelines.bodycomposition:BodyCompositionFast',
+    'SarcopeniaTotalSegmentator': 'BodyComposition.pipelines.totalsegmentator:SarcopeniaTotalSegmentator',
+    'SarcopeniaTotalSegmentatorFast': 'BodyComposition.pipelines.totalsegmentator:SarcopeniaTotalSegmentatorFast',
+    'SarcopeniaStanford': 'BodyComposition.pipelines.stanford:SarcopeniaStanford',
     # add new pipelines here
-}
\ No newline at end of file
+}
+
+
+def get_pipeline(method: str):
+    """Return pipeline definition of method, import if registered as import path."""
+    if method not in pipeline_registry:
+        raise ValueError(f'Undefined pipeline method: {method}')
+    pipeline_definition = pipeline_registry[method]
+    if isinstance(pipeline_definition, str):
+        module, function = pipeline_definition.split(':')
+        pipeline_definition = getattr(import_module(module), function)
+    return pipeline_definition
\ No newline at end of file
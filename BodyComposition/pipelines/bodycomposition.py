@@ -62,11 +62,13 @@ def BodyCompositionFast(pipeline):
         # segmentation area
         SegmTotalSegmentator(pipeline, image='tmp/index', task='tissue', fast=True),
 
+        # vertebral levels first: postprocessing and calculations restricted to the slices of exported levels, if possible
+        CalcVertebralLevel(pipeline, mask='labels/{caseid}_int-vertebrae.nii.gz'),
+
         # postprocessing TotalSegmentator masks
         MasksTotalSegmentatorTissue(pipeline, image='tmp/index', iliopsoas=False, bodytrunk=False),
 
         # calculations
-        CalcVertebralLevel(pipeline, mask='labels/{caseid}_int-vertebrae.nii.gz'),
         CalcCSA(pipeline, mask='masks/{caseid}_tseg-tissue.nii.gz'),
 
         # postprocessing and export
@@ -1,46 +1,57 @@
 # general imports
 from nibabel import Nifti1Image
 from pathlib import Path
-from typing import Union
+from typing import Union, Iterator, Iterable, Tuple
 from time import time
+import numpy as np
+import pandas as pd
+from itertools import count
+from collections import deque
+import tempfile
+import threading
 import logging
+import queue
+import sys
+import gc
 import re
 
 # specific imports
 from BodyComposition.utils.config import update_config
-from BodyComposition.utils.logging import init_logging, log_license
-from BodyComposition.pipeline import PipelineBuilder, run_file, run_batch
+from BodyComposition.utils.logging import init_logging, close_logging, log_license
+from BodyComposition.pipeline import PipelineBuilder, run_file, iter_batch, iter_images
 from BodyComposition.utils.datalist import DatalistBuilder
+from BodyComposition.utils.workqueue import WorkQueue, parse_shard
+from BodyComposition.utils.watch import DirectoryWatcher, WatchStatus
 
 
-def bodycomposition(input: Union[str, Path, Nifti1Image],
-                    input_filter: str = r'.*\.nii\.gz$',
-                    workspace: Union[str, Path] = None,
-                    method: str = 'bodycomposition',
-                    config: Union[dict, Path] = None,
-                    ):
-    """python API for body composition analysis.
-    Args:
-        input: Path to  directory / datalist file / NIfTI file, or directly a NIfTI file.
-        input_filter: Regular expression to filter input files.
-        workspace: path to output directory. if none, output will be stored in the same directory as the input.
-        method: pipeline method to be used.
-        config: path to configuration file or dictionary with configuration. Overwrites default configuration.
-    """
+# configuration for in-memory processing: nothing is written to the workspace
+config_memory = {
+    'run': {'skip': False, 'reset': False, 'resume': False},
+    'segmentation': {'save_label': False},
+    'vertebrae': {'save_mask': False},
+    'tissue': {'save_mask': False},
+    'export': {'write': False},
+    'profiling': {'active': False},
+}
+
+
+def _build(input_filter: str, workspace: Union[str, Path], method: str, config: Union[dict, Path], config_override: dict = None):
+    """Load config, logging and workspace, build pipeline. Returns config, pipeline and workspace."""
 
     # generate timestamp
-    timer_pipeline = time()
-    timestamp = int(timer_pipeline)
+    timestamp = int(time())
 
     # simplify input_filter: remove all non-alphanumeric characters
     input_filter_simple = re.sub(r'\W+', '', input_filter)
-    
+
     # load config: general < pipeline specific < input
     config_dict = update_config({}, Path('./config/config.yaml'))
     config_dict = update_config(config_dict, Path('./config/labels.yaml'))
     config_dict = update_config(config_dict, Path('./config') / f'{method}.yaml')
     if config is not None:
         config_dict = update_config(config_dict, config)
+    if config_override is not None:
+        config_dict = update_config(config_dict, config_override)
 
     # load logging, default: level_file=logging.INFO, level_console= logging.WARNING
     path_logging = Path(str(config_dict['paths']['logs']).format(method=method,filter=input_filter_simple,timestamp=timestamp))
@@ -61,41 +72,345 @@ def bodycomposition(input: Union[str, Path, Nifti1Image],
     pipeline = PipelineBuilder(method = method,
                                config = config_dict,
                                timestamp = timestamp)
-    
-    # get input and output files, inputs = requirements, outputs = relevant if overwrite is set
-    io_inputs, io_outputs = pipeline.get_io()
 
     # get licenses and print
     log_license(pipeline.get_licenses())
-    
-    # if input is nifti, single execution and return
-    if isinstance(input, Nifti1Image):
-        if len(io_inputs) != 1 or io_inputs[0] != "tmp/index": 
+    return config_dict, pipeline, workspace
+
+
+def _datalist(pipeline, input: Union[str, Path], input_filter: str, workspace: Path, shard: str = None):
+    """Datalist of cases to be processed, shard (`i/n`), reset and skip as configured."""
+
+    # get input and output files, inputs = requirements, outputs = relevant if overwrite is set
+    io_inputs, io_outputs = pipeline.get_io()
+
+    # iterable tuple (id, file, workspace=output_dir) of inputs according to criteria
+    datalist = DatalistBuilder(input_path = input,
+                               input_filter = input_filter,
+                               workspace = workspace,
+                               io_inputs = io_inputs,
+                               io_outputs = io_outputs,
+                               scan_workers = pipeline.config['run']['scan_workers'],
+                               io_journal = pipeline.journal_file,
+                               io_appends = pipeline.get_appends(),)
+
+    # cases of this shard only, before reset
+    if shard is not None:
+        datalist.shard(*parse_shard(shard))
+
+    # remove all outputs? WARNING: this deletes all files!
+    if pipeline.config['run']['reset']:
+        datalist.reset_outputs()
+
+    # skip completed cases?
+    if pipeline.config['run']['skip']:
+        datalist.skip_completed()
+
+    logging.info(f"final datalist: {len(datalist)} cases\n")
+    return datalist
+
+
+def _prefetch(iterator: Iterator, max_in_flight: int) -> Iterator:
+    """
+    Run iterator in a background thread, at most `max_in_flight` results are buffered until consumed.
+    Exceptions are raised in the consumer. Closing the generator stops after the current case.
+    """
+    results = queue.Queue(maxsize=max_in_flight)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in iterator:
+                if not put(('result', item)):
+                    return
+            put(('done', None))
+        except BaseException as e:
+            put(('error', e))
+
+    thread = threading.Thread(target=producer, name='bodycomposition-producer', daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = results.get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BodyCompositionSession():
+    """
+    Pipeline built once, used for repeated runs (e.g. in a service), avoiding config loading, model initialization and
+    logging setup per call. The timestamp of the session is used for all exports. Use `close()` or a `with` statement to
+    release the models and logging handlers.
+    Args:
+        method: pipeline method to be used.
+        config: path to configuration file or dictionary with configuration. Overwrites default configuration.
+        workspace: path to output directory. if none, output will be stored in the same directory as the input.
+        input_filter: Regular expression to filter input files, default for all runs.
+        in_memory: if True, nothing is written to the workspace (labels, masks, exports, profiles), see `run_images`.
+    """
+
+    def __init__(self,
+                 method: str = 'bodycomposition',
+                 config: Union[dict, Path] = None,
+                 workspace: Union[str, Path] = None,
+                 input_filter: str = r'.*\.nii\.gz$',
+                 in_memory: bool = False):
+        timer_build = time()
+        self.method = method
+        self.input_filter = input_filter
+        self.config, self.pipeline, self.workspace = _build(input_filter, workspace, method, config,
+                                                            config_override=config_memory if in_memory else None)
+        self.time_build = time() - timer_build
+        logging.info(f" session: pipeline {method} built in {self.time_build:.1f}s.\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _check_open(self):
+        if self.pipeline is None:
+            raise RuntimeError('Session is closed.')
+
+    def _check_single_nifti(self):
+        # pipeline must not require any inputs other than the image
+        io_inputs, _ = self.pipeline.get_io()
+        if io_inputs:
             raise ValueError(f'Pipeline requires more than just a single nifti ({io_inputs}). Use an input directory instead.')
+
+    def _iter_cases(self, datalist, queue: Union[str, Path] = None):
+        """Run pipeline on datalist, or on cases claimed from a shared work queue that the datalist is added to."""
+        if queue is None:
+            yield from iter_batch(self.pipeline, datalist)
+            return
+        work = WorkQueue(queue, lease=float(self.config['run']['queue_lease']))
+        work.add(datalist)
+        for caseid, output, timings in iter_batch(self.pipeline, work):
+            work.complete(caseid, success=output is not None)
+            yield caseid, output, timings
+
+    def run(self, input: Union[str, Path, Nifti1Image], input_filter: str = None, shard: str = None, queue: Union[str, Path] = None):
+        """
+        Run pipeline on directory / datalist file / NIfTI file, or directly a NIfTI image.
+        Returns results (last export of the pipeline) of the last case processed.
+        """
+        self._check_open()
+        timer_pipeline = time()
+
+        # if input is nifti, single execution and return
+        if isinstance(input, Nifti1Image):
+            self._check_single_nifti()
+            output = run_file(self.pipeline, input, self.workspace)
+            n_cases = 1
+
+        # elif: input is directory, datalist, path to file
         else:
-            output = run_file(pipeline, input, workspace)
+            datalist = _datalist(self.pipeline, input, input_filter or self.input_filter, self.workspace, shard)
+            output, n_cases = None, 0
+            for _, output, _ in self._iter_cases(datalist, queue):
+                n_cases += 1
 
-    # elif: input is directory, datalist, path to file
-    else:
-        # iterable tuple (id, file, workspace=output_dir) of inputs according to criteria
-        datalist = DatalistBuilder(input_path = input,
-                                   input_filter = input_filter,
-                                   workspace = workspace,
-                                   io_inputs = io_inputs,
-                                   io_outputs = io_outputs,)
-
-        # remove all outputs? WARNING: this deletes all files!
-        if config_dict['run']['reset']:
-            datalist.reset_outputs()
-
-        # skip completed cases?
-        if config_dict['run']['skip']:
-            datalist.skip_completed()
-        
-        logging.info(f"final datalist: {len(datalist)} cases\n")
-
-        # run pipeline
-        output = run_batch(pipeline, datalist)      
-    
-    logging.info(f" completed {len(datalist)} case(s) in {time() - timer_pipeline:.1f}s.\n\n")
-    return output 
+        logging.info(f" completed {n_cases} case(s) in {time() - timer_pipeline:.1f}s.\n\n")
+        return output
+
+    def iter(self, input: Union[str, Path], input_filter: str = None, max_in_flight: int = None,
+             shard: str = None, queue: Union[str, Path] = None) -> Iterator[Tuple[str, pd.DataFrame, dict]]:
+        """Run pipeline on directory / datalist file / NIfTI file, yield results per case (see `bodycomposition_iter`)."""
+        self._check_open()
+        timer_pipeline = time()
+        datalist = _datalist(self.pipeline, input, input_filter or self.input_filter, self.workspace, shard)
+
+        # run pipeline, optionally in background
+        results = self._iter_cases(datalist, queue)
+        if max_in_flight:
+            results = _prefetch(results, max_in_flight)
+        n_cases = 0
+        for result in results:
+            n_cases += 1
+            yield result
+
+        logging.info(f" completed {n_cases} case(s) in {time() - timer_pipeline:.1f}s.\n\n")
+
+    def watch(self, input: Union[str, Path], input_filter: str = None) -> Iterator[Tuple[str, pd.DataFrame, dict]]:
+        """
+        Watch input directory, run pipeline on new files as they are completely written (see `bodycomposition_watch`).
+        Runs until the generator is closed, or interrupted (KeyboardInterrupt).
+        """
+        self._check_open()
+        config_watch = self.config['watch']
+        watcher = DirectoryWatcher(input, input_filter or self.input_filter,
+                                   settle=float(config_watch['settle']),
+                                   poll=float(config_watch['poll']),
+                                   rescan=float(config_watch['rescan']),
+                                   inotify=config_watch['inotify'])
+        status = WatchStatus(str(config_watch['status']).format(method=self.method))
+        ready = deque()
+        try:
+            while True:
+                if not ready:
+                    ready.extend(watcher.wait())
+                path, time_arrival = ready.popleft()
+
+                # single file, as datalist: requirements, skip and reset as configured
+                datalist = _datalist(self.pipeline, path, None, self.workspace)
+                for caseid, output, timings in iter_batch(self.pipeline, datalist, progress=False):
+                    ready.extend(watcher.wait(0))
+                    timings['latency_s'] = time() - time_arrival
+                    timings['queue_depth'] = len(ready) + len(watcher)
+                    status.update(caseid, output is not None, timings['latency_s'], timings['queue_depth'])
+                    yield caseid, output, timings
+        finally:
+            watcher.close()
+
+    def run_images(self, images: Iterable[Union[Nifti1Image, Tuple[np.ndarray, np.ndarray]]], case_ids: Iterable[str] = None) -> pd.DataFrame:
+        """Run pipeline on in-memory images, return combined results (see `bodycomposition_images`)."""
+        self._check_open()
+        self._check_single_nifti()
+        timer_pipeline = time()
+
+        # images as nifti, with case ids
+        def as_nifti(image):
+            if isinstance(image, Nifti1Image):
+                return image
+            data, affine = image
+            return Nifti1Image(np.asanyarray(data), np.asarray(affine, dtype=np.float64))
+        if case_ids is None:
+            case_ids = (f'case_{i:04d}' for i in count())
+        input_images = ((case_id, as_nifti(image)) for case_id, image in zip(case_ids, images))
+
+        # run pipeline, temporary workspace only as placeholder for paths of containers
+        results = []
+        with tempfile.TemporaryDirectory(prefix="tmp_") as path_tmp:
+            for case_id, output, _ in iter_images(self.pipeline, input_images, Path(path_tmp)):
+                if output is None:
+                    continue
+                if 'case_id' not in output.columns:
+                    output = output.assign(case_id=case_id)[['case_id'] + list(output.columns)]
+                results.append(output)
+
+        logging.info(f" completed {len(results)} case(s) in {time() - timer_pipeline:.1f}s.\n\n")
+        return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+    def close(self):
+        """Release pipeline (models, worker process), free cached GPU memory, remove logging handlers."""
+        if self.pipeline is None:
+            return
+        self.pipeline.close()
+        self.pipeline = None
+        gc.collect()
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logging.info(f" session: pipeline {self.method} closed.\n")
+        close_logging()
+
+
+def bodycomposition_iter(input: Union[str, Path],
+                         input_filter: str = r'.*\.nii\.gz$',
+                         workspace: Union[str, Path] = None,
+                         method: str = 'bodycomposition',
+                         config: Union[dict, Path] = None,
+                         max_in_flight: int = None,
+                         shard: str = None,
+                         queue: Union[str, Path] = None,
+                         ) -> Iterator[Tuple[str, pd.DataFrame, dict]]:
+    """python API for body composition analysis, yields results as each case completes.
+    Args:
+        input: Path to directory / datalist file / NIfTI file.
+        input_filter: Regular expression to filter input files.
+        workspace: path to output directory. if none, output will be stored in the same directory as the input.
+        method: pipeline method to be used.
+        config: path to configuration file or dictionary with configuration. Overwrites default configuration.
+        max_in_flight: if set, cases are processed in a background thread, while up to `max_in_flight` results are
+            waiting to be consumed. If None, each case is processed when the next result is requested.
+        shard: process only shard `i/n` of the cases (deterministic hash of case ids), e.g. `0/4` on the first of 4 nodes.
+        queue: path to a shared work queue directory. Cases are added to the queue, and claimed case by case, so multiple
+            nodes or processes can work on the same datalist (see `run/queue_lease`).
+    Yields:
+        (case_id, results_df, timings): results_df = last export of the pipeline (None if failed),
+            timings = {'total_s': seconds, 'actions': [(action, seconds), ...], 'timeout': action running at timeout or None}
+    """
+    with BodyCompositionSession(method, config, workspace, input_filter) as session:
+        yield from session.iter(input, max_in_flight=max_in_flight, shard=shard, queue=queue)
+
+
+def bodycomposition_watch(input: Union[str, Path],
+                          input_filter: str = r'.*\.nii\.gz$',
+                          workspace: Union[str, Path] = None,
+                          method: str = 'bodycomposition',
+                          config: Union[dict, Path] = None,
+                          ) -> Iterator[Tuple[str, pd.DataFrame, dict]]:
+    """python API for continuous body composition analysis of a watched directory.
+    The pipeline is built once, new files are processed as soon as they are completely written (see `watch` in config).
+    Runs until the generator is closed or interrupted.
+    Args:
+        input: Path to directory to be watched, files present at start are processed as well.
+        input_filter: Regular expression to filter input files.
+        workspace: path to output directory. if none, output will be stored in the same directory as the input.
+        method: pipeline method to be used.
+        config: path to configuration file or dictionary with configuration. Overwrites default configuration.
+    Yields:
+        (case_id, results_df, timings): as `bodycomposition_iter`, timings additionally contain `latency_s` (file arrival
+            to result) and `queue_depth` (files waiting or being written).
+    """
+    with BodyCompositionSession(method, config, workspace, input_filter) as session:
+        yield from session.watch(input)
+
+
+def bodycomposition_images(images: Iterable[Union[Nifti1Image, Tuple[np.ndarray, np.ndarray]]],
+                           case_ids: Iterable[str] = None,
+                           method: str = 'bodycomposition',
+                           config: Union[dict, Path] = None,
+                           ) -> pd.DataFrame:
+    """python API for body composition analysis of in-memory images.
+    The pipeline is built once, all images are processed in memory, nothing is written to the workspace.
+    Args:
+        images: sequence or iterator of NIfTI images, or tuples (array, affine).
+        case_ids: case ids of the images, default: `case_0000`, `case_0001`, ...
+        method: pipeline method to be used.
+        config: path to configuration file or dictionary with configuration. Overwrites default configuration.
+    Returns:
+        combined results (last export of the pipeline) of all cases, failed cases are skipped (see log).
+    """
+    with BodyCompositionSession(method, config, in_memory=True) as session:
+        return session.run_images(images, case_ids)
+
+
+def bodycomposition(input: Union[str, Path, Nifti1Image],
+                    input_filter: str = r'.*\.nii\.gz$',
+                    workspace: Union[str, Path] = None,
+                    method: str = 'bodycomposition',
+                    config: Union[dict, Path] = None,
+                    shard: str = None,
+                    queue: Union[str, Path] = None,
+                    ):
+    """python API for body composition analysis.
+    Args:
+        input: Path to  directory / datalist file / NIfTI file, or directly a NIfTI file.
+        input_filter: Regular expression to filter input files.
+        workspace: path to output directory. if none, output will be stored in the same directory as the input.
+        method: pipeline method to be used.
+        config: path to configuration file or dictionary with configuration. Overwrites default configuration.
+        shard: process only shard `i/n` of the cases (see `bodycomposition_iter`).
+        queue: path to a shared work queue directory (see `bodycomposition_iter`).
+    Returns:
+        results (last export of the pipeline) of the last case processed.
+    """
+    with BodyCompositionSession(method, config, workspace, input_filter) as session:
+        return session.run(input, shard=shard, queue=queue)
@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Union
+from time import sleep
+from psutil import Process, pid_exists
+from nibabel import load as nib_load
+from BodyComposition.utils.profiling import _read_peak_rss, _reset_peak_rss
+from BodyComposition.utils.nifti import NiftiDataContainer
+import tempfile
+import logging
+import fcntl
+import json
+import os
+
+
+# initial peak memory per action in bytes per voxel of the input image, above the memory of the process at case start
+# non-ML actions: measured on phantoms (benchmarks/bench_actions.py), segmentations: conservative guesses
+# replaced by calibrated values (measured peaks of completed cases)
+DEFAULT_MULTIPLIERS = {
+    'SegmIntVertebrae': 64,
+    'SegmStanfordSpine': 64,
+    'SegmTotalSegmentator': 64,
+    'MasksTotalSegmentatorTissue': 24,
+    'MasksTotalSegmentatorSpine': 8,
+    'MasksStanfordSpine': 8,
+    'CalcVertebralLevel': 10,
+    'CalcCSA': 4,
+    'default': 8,
+}
+
+
+@contextmanager
+def _locked(path: Path):
+    """Exclusive lock (flock) of a lock file next to path, for read-modify-write by processes of this node."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f'.{path.name}.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _read_json(path: Path) -> Dict:
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _write_json(path: Path, data: Dict):
+    path_tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    path_tmp.write_text(json.dumps(data, indent=2))
+    os.replace(path_tmp, path)
+
+
+class MemoryModel():
+    """
+    Predicts the peak memory of a case from the image header: voxels x largest multiplier of the pipeline's actions.
+    Principles:
+    - multipliers are bytes per voxel of the input image, peak of each action above the memory at case start.
+    - calibration: peaks measured per action (linux, resettable high water mark) update the multipliers of completed
+      cases (moving average, never below the last measurement), stored in a json file shared by processes.
+    """
+
+    def __init__(self, path: Union[str, Path], actions: List[str], smoothing: float = 0.2):
+        self.path = None if str(path) in ('None', '') else Path(path)
+        self.actions = actions
+        self.smoothing = smoothing
+        self.multipliers = {}
+        self._mtime = None
+        self.process = Process()
+
+    def __repr__(self):
+        return f'MemoryModel(path={self.path})'
+
+    def _load(self):
+        """Calibrated multipliers, reloaded if the file was changed (e.g. by other processes)."""
+        if self.path is None:
+            return
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            self.multipliers, self._mtime = _read_json(self.path), mtime
+
+    def multiplier(self, name: str) -> float:
+        return self.multipliers.get(name, DEFAULT_MULTIPLIERS.get(name.split('/')[0], DEFAULT_MULTIPLIERS['default']))
+
+    @staticmethod
+    def voxels(image: Union[str, Path, NiftiDataContainer]) -> int:
+        """Number of voxels from metadata or header only, data are not loaded."""
+        if isinstance(image, NiftiDataContainer):
+            if image._shape is not None:
+                return int(image._shape[0] * image._shape[1] * image._shape[2])
+            image = image.path
+        shape = nib_load(image).header.get_data_shape()
+        return int(shape[0] * shape[1] * shape[2])
+
+    def estimate(self, image: Union[str, Path, NiftiDataContainer]) -> int:
+        """Estimated peak memory of a case in bytes."""
+        self._load()
+        return int(self.voxels(image) * max(self.multiplier(name) for name in self.actions))
+
+    @contextmanager
+    def measure(self, name: str, memory: Dict):
+        """Context manager wrapping an action: peak memory above memory at case start (`tmp/memory_peaks`)."""
+        peaks = memory.get('tmp/memory_peaks')
+        if peaks is None:
+            peaks = memory['tmp/memory_peaks'] = {'start': self.process.memory_info().rss}
+        resettable = _reset_peak_rss()
+        try:
+            yield
+        finally:
+            if resettable:
+                peaks[name] = max(_read_peak_rss() - peaks['start'], 0)
+
+    def calibrate(self, memory: Dict):
+        """Update multipliers with the peaks measured for a completed case."""
+        peaks = {name: peak for name, peak in memory.get('tmp/memory_peaks', {}).items() if name != 'start'}
+        if self.path is None or not peaks:
+            return
+        voxels = self.voxels(memory['tmp/index'])
+        with _locked(self.path):
+            multipliers = _read_json(self.path)
+            for name, peak in peaks.items():
+                measured = peak / voxels
+                previous = multipliers.get(name, self.multiplier(name))
+                multipliers[name] = round(max(measured, (1 - self.smoothing) * previous + self.smoothing * measured), 3)
+            _write_json(self.path, multipliers)
+        self.multipliers, self._mtime = multipliers, self.path.stat().st_mtime
+        logging.info(f' memory: peak {max(peaks.values()) / 1024**2:.0f} MB, multipliers calibrated ({self.path})')
+
+
+class MemoryAdmission():
+    """
+    Admission control of concurrent cases on this node: a case starts only while the sum of the estimated peaks of
+    all running cases (of all processes, ledger file with lock) stays below the budget. A case is always admitted if
+    no other case is running, even if its estimate exceeds the budget. Entries of dead processes are ignored.
+    """
+
+    def __init__(self, budget_gb: float, poll: float = 2, ledger: Union[str, Path] = None):
+        self.budget = int(float(budget_gb) * 1024**3)
+        self.poll = poll
+        self.ledger = Path(ledger) if ledger else Path(tempfile.gettempdir(), f'bodycomposition_memory_{os.getuid()}.json')
+
+    def __repr__(self):
+        return f'MemoryAdmission(budget={self.budget / 1024**3:.1f} GB, ledger={self.ledger})'
+
+    def _running(self) -> Dict:
+        return {key: value for key, value in _read_json(self.ledger).items() if pid_exists(value['pid'])}
+
+    def _try_admit(self, key: str, estimate: int) -> int:
+        """Register case if budget allows, returns memory in use by other cases or -1 if admitted."""
+        with _locked(self.ledger):
+            running = self._running()
+            used = sum(value['bytes'] for value in running.values())
+            if running and used + estimate > self.budget:
+                return used
+            running[key] = {'pid': os.getpid(), 'bytes': estimate}
+            _write_json(self.ledger, running)
+            return -1
+
+    def _release(self, key: str):
+        with _locked(self.ledger):
+            running = self._running()
+            running.pop(key, None)
+            _write_json(self.ledger, running)
+
+    @contextmanager
+    def admit(self, caseid: str, estimate: int):
+        """Wait until the case fits into the budget, hold its reservation while it is running."""
+        key = f'{os.getpid()}:{caseid}'
+        used, logged = self._try_admit(key, estimate), False
+        while used >= 0:
+            if not logged:
+                logging.info(f' memory: waiting for admission of {caseid} ({estimate / 1024**3:.1f} GB), '
+                             f'{used / 1024**3:.1f} of {self.budget / 1024**3:.1f} GB in use')
+                logged = True
+            sleep(self.poll)
+            used = self._try_admit(key, estimate)
+        logging.info(f' memory: admitted {caseid}, estimated peak {estimate / 1024**3:.2f} GB')
+        try:
+            yield
+        finally:
+            self._release(key)
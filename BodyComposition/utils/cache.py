@@ -0,0 +1,121 @@
+from pathlib import Path
+from typing import Dict, Any, Union
+from nibabel import Nifti1Image
+from BodyComposition.utils.nifti import NiftiDataContainer
+from BodyComposition.utils.codecs import NiftiCodec, FORMATS
+import numpy as np
+import importlib.metadata
+import hashlib
+import logging
+import json
+import os
+
+
+class LabelCache():
+    """
+    Content-addressed cache for segmentation labels.
+    Principles:
+    - key = hash of the voxel data and affine of the input image, plus the model definition (task, model folder, folds,
+      version of the package running the model, so labels are not reused after upgrades).
+    - labels are stored as nifti files named by their key, so they can be reused across case ids, workspaces and pipelines.
+    - file modification time is used as last access time, least recently used labels are evicted if the size limit is exceeded.
+    - labels are internal intermediates, stored as gzip (.nii.gz) or zstd (.nii.zst) compressed nifti (`format`).
+    """
+
+    def __init__(self, path: Union[str, Path], max_size_gb: float = None, format: str = 'gzip', codec: NiftiCodec = None):
+        if format not in ('gzip', 'zstd'):
+            raise ValueError(f'Unknown cache format: {format}, options: gzip, zstd')
+        self.path = Path(path)
+        self.max_size = None if max_size_gb is None else int(float(max_size_gb) * 1024**3)
+        self.suffix = FORMATS[format]
+        self.codec = codec or NiftiCodec()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]):
+        """Create cache as defined in config (`cache/path`, `cache/max_size_gb`, `cache/format`, `codec`), None if inactive."""
+        config_cache = config.get('cache', {})
+        if str(config_cache.get('path', None)) in ('None', ''):
+            return None
+        return cls(config_cache['path'], config_cache.get('max_size_gb', None), config_cache.get('format', 'gzip'),
+                   NiftiCodec.from_config(config))
+
+    def __repr__(self):
+        return f'LabelCache(path={self.path})'
+
+    @staticmethod
+    def key(image: NiftiDataContainer, model: Dict[str, Any]) -> str:
+        """Hash voxel data (within bbox, if set) and affine of image, and the model definition."""
+        data = np.ascontiguousarray(image.data_np)
+        tmp_hash = hashlib.blake2b(digest_size=20)
+        tmp_hash.update(f'{data.dtype.str}{data.shape}'.encode())
+        tmp_hash.update(memoryview(data).cast('B'))
+        tmp_hash.update(np.asarray(image.affine, dtype=np.float64).tobytes())
+        tmp_hash.update(json.dumps(model, sort_keys=True, default=str).encode())
+        return tmp_hash.hexdigest()
+
+    @staticmethod
+    def version(package: str) -> str:
+        """Installed version of the package running a model, part of the model definition; None if not installed."""
+        try:
+            return importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            return None
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / f'{key}{self.suffix}'
+
+    def get(self, key: str) -> Nifti1Image:
+        """Return cached label as nibabel image, None if not available. Marks label as recently used."""
+        file = self._file(key)
+        try:
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return self.codec.load(file)
+
+    def restore(self, key: str, label: NiftiDataContainer, image: NiftiDataContainer) -> bool:
+        """Set cached label to container `label` (`data_nib` setter), if available and on the grid of `image` (affine
+        within float32 precision of nifti headers, shape); the affine of `image` is used. Returns False if not available,
+        or not matching (ignored)."""
+        cached = self.get(key)
+        if cached is None:
+            return False
+        if tuple(cached.shape) != tuple(image.shape) or not np.allclose(cached.affine, image.affine, atol=1e-4):
+            logging.warning(f' cached label {key} does not match input image (affine, shape), ignored')
+            return False
+        label.data_nib = Nifti1Image(np.asanyarray(cached.dataobj), image.affine)
+        return True
+
+    def put(self, key: str, label: NiftiDataContainer):
+        """Add label to cache (written to temporary file, then renamed), evict least recently used labels."""
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file_tmp = file.with_name(f'.{key}.{os.getpid()}.tmp{self.suffix}')
+        self.codec.save(label.data_nib, file_tmp)
+        os.replace(file_tmp, file)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used labels until cache size is below limit."""
+        if self.max_size is None:
+            return
+        files = []
+        for subdir in os.scandir(self.path):
+            if subdir.is_dir():
+                files.extend(entry for entry in os.scandir(subdir.path) if entry.is_file() and not entry.name.startswith('.'))
+        files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in files]
+        size = sum(file[1] for file in files)
+        if size <= self.max_size:
+            return
+        n_removed = 0
+        for _, file_size, file_path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+                size -= file_size
+                n_removed += 1
+            except FileNotFoundError:
+                pass # removed by concurrent process
+        logging.info(f'  label cache: evicted {n_removed} label(s), size now {size/1024**3:.1f}GB')
@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pathlib import Path
+from typing import Dict, Any, Union
+from nibabel import Nifti1Image, load as nib_load
+import threading
+import gzip
+import zlib
+import io
+
+
+FORMATS = {'gzip': '.nii.gz', 'zstd': '.nii.zst', 'raw': '.nii'}
+
+
+def nifti_suffix(path: Union[str, Path]) -> str:
+    """Suffix of nifti file, determines the format: .nii.gz (gzip), .nii.zst (zstd) or .nii (uncompressed)."""
+    name = Path(path).name
+    for suffix in FORMATS.values():
+        if name.endswith(suffix):
+            return suffix
+    raise ValueError(f'Unknown nifti format: {name}')
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('Nifti files compressed with zstd (.nii.zst) require zstandard, e.g. `pip install zstandard`.') from e
+    return zstandard
+
+
+def _gzip_member(block: bytes, level: int) -> bytes:
+    """Compress block as complete gzip member (header, deflate stream, crc32 and size)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+class _BlockGzipWriter(io.RawIOBase):
+    """
+    Write-only file object: data are split into blocks, compressed in parallel (zlib releases the GIL) and written in
+    order as members of a multi-member gzip file (RFC 1952), which is read by gzip, nibabel and other tools as usual.
+    """
+
+    def __init__(self, fileobj, level: int, block: int, executor: ThreadPoolExecutor, max_pending: int):
+        self.fileobj = fileobj
+        self.level = level
+        self.block = block
+        self.executor = executor
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.pending = deque() # futures of compressed blocks, in order
+        self.position = 0 # uncompressed bytes written
+        self.members = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """No seeking, except to the current position (used by nibabel)."""
+        if whence == io.SEEK_SET and offset == self.position:
+            return self.position
+        raise io.UnsupportedOperation('Block gzip writer cannot seek.')
+
+    def _submit(self, block: bytes):
+        if len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(_gzip_member, block, self.level))
+        self.members += 1
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        n = len(view)
+        self.position += n
+        offset = 0
+        if self.buffer: # complete buffered block first
+            offset = min(self.block - len(self.buffer), n)
+            self.buffer += view[:offset]
+            if len(self.buffer) < self.block:
+                return n
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while n - offset >= self.block:
+            self._submit(bytes(view[offset:offset + self.block]))
+            offset += self.block
+        self.buffer += view[offset:]
+        return n
+
+    def close(self):
+        """Compress remaining data, write all blocks. The underlying file is not closed."""
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.members: # empty data: single empty member, valid gzip file
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            for future in self.pending: # after errors
+                future.cancel()
+            super().close()
+
+
+class NiftiCodec():
+    """
+    Compression of nifti files, format by suffix of the path: .nii.gz (gzip), .nii.zst (zstd), .nii (uncompressed).
+    Principles:
+    - gzip: zlib `level` (1 fastest ... 9 smallest). With `threads`, blocks of `block_mb` are compressed in parallel
+      and written as multi-member gzip file, compatible with all gzip readers.
+    - zstd: for internal intermediates only (e.g. label cache), not readable by nibabel or other tools directly.
+    - images are serialized by nibabel (header, data), only the compressed stream is replaced.
+    """
+
+    def __init__(self, level: int = 1, threads: int = 0, block_mb: float = 4, zstd_level: int = 3):
+        self.level = int(level)
+        self.threads = int(threads)
+        self.block = int(float(block_mb) * 1024**2)
+        self.zstd_level = int(zstd_level)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]):
+        """Create codec as defined in config (`codec/level`, `codec/threads`, `codec/block_mb`, `codec/zstd_level`)."""
+        config_codec = config.get('codec', {})
+        return cls(level=config_codec.get('level', 1),
+                   threads=config_codec.get('threads', 0),
+                   block_mb=config_codec.get('block_mb', 4),
+                   zstd_level=config_codec.get('zstd_level', 3))
+
+    def __repr__(self):
+        return f'NiftiCodec(level={self.level}, threads={self.threads}, zstd_level={self.zstd_level})'
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Threads compressing gzip blocks, shared by all saves (e.g. of the background writer)."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='bodycomposition-codec')
+            return self._executor
+
+    def save(self, image: Nifti1Image, path: Union[str, Path], suffix: str = None):
+        """Save nibabel image, format by suffix (default: suffix of path)."""
+        suffix = suffix or nifti_suffix(path)
+        zstandard = _import_zstandard() if suffix == '.nii.zst' else None # before creating the file
+        with open(path, 'wb') as f:
+            if suffix == '.nii':
+                stream = f
+            elif suffix == '.nii.zst':
+                compressor = zstandard.ZstdCompressor(level=self.zstd_level, threads=self.threads)
+                stream = compressor.stream_writer(f, closefd=False)
+            elif self.threads > 0:
+                stream = _BlockGzipWriter(f, self.level, self.block, self.executor, max_pending=2 * self.threads)
+            else:
+                stream = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=self.level, mtime=0)
+            try:
+                image.to_file_map(image.make_file_map({'image': stream}))
+            finally:
+                if stream is not f:
+                    stream.close()
+
+    @staticmethod
+    def load(path: Union[str, Path]) -> Nifti1Image:
+        """Load nibabel image, .nii.zst decompressed in memory, other formats loaded by nibabel (lazily)."""
+        if not Path(path).name.endswith('.nii.zst'):
+            return nib_load(path)
+        with open(path, 'rb') as f:
+            data = _import_zstandard().ZstdDecompressor().stream_reader(f).read()
+        return Nifti1Image.from_bytes(data)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -1,9 +1,62 @@
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from BodyComposition.utils.workqueue import shard_of
 import logging
 import json
+import os
 import re
 
+
+def scan_dir(path: Path) -> Dict[str, bool]:
+    """
+    List all entries of a directory using a single os.scandir pass: name and whether it is a regular file.
+    Directories are included, as existence checks of io files accept them (e.g. parquet results, DICOM folders).
+    """
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.is_file() for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+class DirectoryIndex():
+    """
+    Cache of directory listings, used to resolve existence checks by set membership.
+    Each directory is listed once; listings can be prefetched in parallel (e.g. for network filesystems).
+    """
+
+    def __init__(self, workers: int = 0):
+        self.workers = workers
+        self._listings: Dict[Tuple[str, str], Dict[str, bool]] = {}
+
+    def prefetch(self, dirs: Iterable[Tuple[Path, str]]):
+        """List all given (root, subdir) directories that are not cached yet, optionally using a thread pool."""
+        dirs = [d for d in {(str(root), subdir) for root, subdir in dirs} if d not in self._listings]
+        paths = [Path(root, subdir) for root, subdir in dirs]
+        if self.workers > 1 and len(dirs) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                self._listings.update(zip(dirs, executor.map(scan_dir, paths)))
+        else:
+            self._listings.update(zip(dirs, map(scan_dir, paths)))
+
+    def listing(self, root: Path, subdir: str = '.') -> Dict[str, bool]:
+        key = (str(root), subdir)
+        if key not in self._listings:
+            self._listings[key] = scan_dir(Path(root, subdir))
+        return self._listings[key]
+
+    def exists(self, root: Path, file: str) -> bool:
+        """Check if file or directory (relative to root, e.g. `labels/ct_01.nii.gz`) exists, using the cached listing."""
+        subdir, _, name = file.rpartition('/')
+        return name in self.listing(root, subdir or '.')
+
+    def discard(self, root: Path, file: str):
+        """Remove a file from the cached listing, e.g. after deleting it."""
+        subdir, _, name = file.rpartition('/')
+        self._listings.get((str(root), subdir or '.'), {}).pop(name, None)
+
+
 class DatalistBuilder():
     """DatalistBuilder class for loading, filtering and saving data."""
 
@@ -12,7 +65,10 @@ class DatalistBuilder():
                  input_filter: str = None,
                  workspace: Path = None,
                  io_inputs: List[str] = None,
-                 io_outputs: List[str] = None,):
+                 io_outputs: List[str] = None,
+                 scan_workers: int = 0,
+                 io_journal: str = None,
+                 io_appends: List[Tuple[str, str]] = None,):
         """Initialize DatalistBuilder class."""
 
         def stem2(filename: str):
@@ -20,6 +76,9 @@ class DatalistBuilder():
 
         logging.info(f'LOADING DATALIST:')
 
+        # directory listings, each directory is only scanned once
+        self.index = DirectoryIndex(workers=scan_workers)
+
         # check if paths exist
         input_path = Path(input_path)
         if not input_path.exists():
@@ -49,12 +108,14 @@ class DatalistBuilder():
 
             # create absolute paths, check if cases exists
             case_paths = [input_path.parent/file for file in case_paths]
-            case_paths = [file for file in case_paths if file.exists()]
+            self.index.prefetch((file.parent, '.') for file in case_paths)
+            case_paths = [file for file in case_paths if self.index.exists(file.parent, file.name)]
             logging.info(f' {len(case_paths)} files found')
 
         elif input_path.is_dir():
             logging.info(f'input: directory ({input_path}), loading')
-            case_paths = [file for file in input_path.iterdir() if file.is_file() and not file.name.startswith('.')]
+            case_paths = [input_path/name for name, is_file in sorted(self.index.listing(input_path).items())
+                          if is_file and not name.startswith('.')]
             logging.info(f' {len(case_paths)} files found')
 
         elif input_path.is_file():
@@ -65,7 +126,8 @@ class DatalistBuilder():
             raise ValueError(f'Invalid input file or dir: {input_path}.')
         
         # create list of cases: id, input_file, workspace
-        cases = [(stem2(file.name), Path(file), Path(workspace) if workspace else file.parent.parent) for file in case_paths]
+        workspace = Path(workspace) if workspace else None
+        cases = [(stem2(file.name), Path(file), workspace or file.parent.parent) for file in case_paths]
 
         # filter inputs; default: r'.*\.nii\.gz$'
         # on purpose not applied earlier to enable filtering irresepective of the input_path datatype
@@ -74,15 +136,19 @@ class DatalistBuilder():
             cases = [(caseid, file, workspace) for caseid, file, workspace in cases if filter_regex.match(file.name)]
             logging.info(f' using filter `{input_filter}`: {len(cases)} files remaining')
 
-        # filter regarding requirements io_inputs
+        # filter regarding requirements io_inputs, resolved by membership in directory listings
         if io_inputs is not None:
-            cases = [(caseid, file, workspace) for caseid, file, workspace in cases if all((workspace/io_input.format(caseid=caseid)).exists() for io_input in io_inputs)]
+            self._prefetch_io(cases, io_inputs)
+            cases = [(caseid, file, workspace) for caseid, file, workspace in cases if self._exists_all(caseid, workspace, io_inputs)]
             logging.info(f' regarding required inputs: {len(cases)} files remaining')
         
         # save tuple as attribute
         self.cases = cases
         self.io_outputs = io_outputs
         self.io_inputs = io_inputs
+        self.io_journal = io_journal # journal of interrupted cases: removed at reset, case is not completed
+        self.io_appends = io_appends or [] # appended exports (file, store): completed cases by their rows, if no outputs per case
+        self.outputs_reset = False
         logging.info(f'identified {len(cases)} cases for processing')
 
     def __len__(self):
@@ -94,23 +160,62 @@ class DatalistBuilder():
     def __iter__(self):
         return iter(self.cases)
 
+    def _prefetch_io(self, cases: List[Tuple], io_files: List[str]):
+        """List all workspace subdirectories (e.g. labels/, masks/, exports/) referenced by io_files once."""
+        subdirs = {io_file.rpartition('/')[0] or '.' for io_file in io_files}
+        workspaces = {workspace for _, _, workspace in cases}
+        self.index.prefetch((workspace, subdir) for workspace in workspaces for subdir in subdirs)
+
+    def _exists_all(self, caseid: str, workspace: Path, io_files: List[str]) -> bool:
+        return all(self.index.exists(workspace, io_file.format(caseid=caseid)) for io_file in io_files)
+
+    def shard(self, index: int, count: int):
+        """Keep cases of shard `index` out of `count`, by deterministic hash of case id."""
+        self.cases = [case for case in self.cases if shard_of(case[0], count) == index]
+        logging.info(f'shard {index}/{count}: {len(self.cases)} cases remaining')
+
     def reset_outputs(self):
         """Delete existing output files."""
         tmp_cases = set()
+        io_outputs = self.io_outputs + ([self.io_journal] if self.io_journal else [])
+        self._prefetch_io(self.cases, io_outputs)
         for caseid, input_file, workspace in iter(self.cases):
-            for io_output in self.io_outputs:
-                tmp_io_output = workspace/io_output.format(caseid=caseid)
-                if tmp_io_output.exists():
-                    tmp_io_output.unlink()
+            for io_output in io_outputs:
+                tmp_io_output = io_output.format(caseid=caseid)
+                if self.index.exists(workspace, tmp_io_output):
+                    (workspace/tmp_io_output).unlink()
+                    self.index.discard(workspace, tmp_io_output)
                     tmp_cases.add(caseid)
+        self.outputs_reset = True
         logging.info(f'reset outputs: removed existing files for {len(tmp_cases)} case(s): ({", ".join(tmp_cases)})')
 
     def skip_completed(self):
-        """Remove completed cases."""
-        tmp_cases = set()
-        for caseid, input_file, workspace in iter(self.cases):
-            if all((workspace/io_output.format(caseid=caseid)).exists() for io_output in self.io_outputs):
-                tmp_cases.add(caseid)
+        """Remove completed cases, cases with journal (interrupted) are kept. Without output files per case (e.g. only
+        appended exports requested), cases are completed if their rows are present in all appended exports."""
+        self._prefetch_io(self.cases, (self.io_outputs or []) + ([self.io_journal] if self.io_journal else []))
+        if self.io_outputs:
+            completed = lambda caseid, workspace: self._exists_all(caseid, workspace, self.io_outputs)
+        elif self.io_appends and not self.outputs_reset:
+            present = self._appended_cases()
+            completed = lambda caseid, workspace: caseid in present[workspace]
+        else:
+            logging.info(f'skip complete cases: no output files per case{" (reset)" if self.io_appends else ""}, no case skipped')
+            return
+        tmp_cases = {caseid for caseid, input_file, workspace in iter(self.cases) if completed(caseid, workspace)
+                     and not (self.io_journal and self.index.exists(workspace, self.io_journal.format(caseid=caseid)))}
         if tmp_cases:
             self.cases = [case for case in self.cases if case[0] not in tmp_cases]
         logging.info(f'skip complete cases: removed {len(tmp_cases)} case(s) from datalist ({", ".join(tmp_cases)})')
+
+    def _appended_cases(self) -> Dict[Path, Set[str]]:
+        """Case ids present in all appended exports, per workspace. Raises error if cases can not be identified."""
+        from BodyComposition.utils.results_store import appended_cases
+        present = {}
+        for workspace in {workspace for _, _, workspace in self.cases}:
+            for file, store in self.io_appends:
+                cases = appended_cases(store, workspace/file)
+                if cases is None:
+                    raise ValueError(f'Completed cases can not be identified in {workspace/file} (no `case_id` column), '
+                                     f'rows would be appended again: set run/skip to False, or export with add_metadata.')
+                present[workspace] = cases if workspace not in present else present[workspace] & cases
+        return present
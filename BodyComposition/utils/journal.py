@@ -0,0 +1,174 @@
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Any, List, Union
+from BodyComposition.utils.nifti import NiftiDataContainer
+import hashlib
+import logging
+import pickle
+import json
+import os
+
+
+# state of a NiftiDataContainer: restored from file if not modified in memory
+ContainerState = namedtuple('ContainerState', ['path', 'bbox', 'loaded', 'modified'])
+
+# entries exceeding the size limit are not stored, the action that set them is run again
+Oversized = namedtuple('Oversized', ['nbytes'])
+
+# memory entries not journaled: case identity, bookkeeping of the current run
+_EXCLUDED = {'id', 'workspace', 'tmp/journal', 'tmp/timings', 'tmp/profile', 'tmp/timeout', 'tmp/memory_peaks'}
+
+
+def pipeline_fingerprint(method: str, actions: List, config: Dict[str, Any]) -> str:
+    """Hash of pipeline definition (actions, io) and config, excluding run, logging and profiling settings."""
+    config = {key: value for key, value in config.items() if key not in ('run', 'logging_level', 'profiling')}
+    definition = [(f'{action}', getattr(action, 'task', None), action.io_inputs, action.io_outputs) for action in actions]
+    payload = json.dumps([method, definition, config], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class CaseJournal():
+    """
+    Crash-safe journal of the completed actions of a case, sidecar file in the workspace (`journal/{caseid}.pkl`).
+    Principles:
+    - after each completed action, the changed memory entries are appended and the file is replaced atomically.
+    - small outputs (arrays, bounding box, metadata, results) are stored as values, NiftiDataContainers as state
+      (path, bbox): they are restored from file, if saved and not modified in memory afterwards. Entries larger than
+      `max_entry_mb` are not stored.
+    - resuming starts at the first incomplete action, or earlier if a required container can not be restored.
+    - actions with side effects can record an intent before, e.g. exports check for rows written by an interrupted attempt.
+    - the journal is removed when the case is completed (the directory, if empty), and ignored if pipeline or config changed.
+    """
+
+    file = 'journal/{caseid}.pkl'
+
+    def __init__(self, path: Union[str, Path], fingerprint: str, max_entry_mb: float = 16):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.max_entry = int(max_entry_mb * 1024**2)
+        self.actions = [] # completed actions: names
+        self.changes = [] # per completed action: (changed entries, removed keys)
+        self.intents = set() # side effects started by current action
+        self.intents_interrupted = set() # side effects started by interrupted action of previous attempt
+        self._encoded = {} # digests of pickled entries of last commit, to detect changes
+
+    def __repr__(self):
+        return f'CaseJournal(path={self.path})'
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, NiftiDataContainer):
+            return ContainerState(value.path, value.bbox, value.loaded, value.modified)
+        return value
+
+    @staticmethod
+    def _restorable(value) -> bool:
+        if isinstance(value, Oversized):
+            return False
+        elif isinstance(value, ContainerState):
+            return not value.loaded or (not value.modified and value.path.exists())
+        return True
+
+    @staticmethod
+    def _digest(value) -> bytes:
+        return hashlib.blake2b(value, digest_size=16).digest()
+
+    @staticmethod
+    def _restore(state: ContainerState) -> NiftiDataContainer:
+        container = NiftiDataContainer(state.path)
+        if state.bbox is not None:
+            container.bbox = state.bbox
+        return container
+
+    def _save(self):
+        path_tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        try:
+            f = open(path_tmp, 'wb')
+        except FileNotFoundError: # directory created with the first entry, removed by other cases when empty
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(path_tmp, 'wb')
+        with f:
+            pickle.dump({'fingerprint': self.fingerprint,
+                         'actions': self.actions,
+                         'changes': self.changes,
+                         'intents': self.intents}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path_tmp, self.path)
+
+    def resume(self, memory: Dict[str, Any], actions: List[str]) -> int:
+        """Restore memory from journal of previous attempt. Returns index of first action to be run."""
+        if not self.path.exists():
+            return 0
+        try:
+            with open(self.path, 'rb') as f:
+                journal = pickle.load(f)
+        except Exception as e:
+            logging.warning(f' journal: {self.path} not readable ({e}), starting from first action')
+            return 0
+        if journal['fingerprint'] != self.fingerprint or journal['actions'] != actions[:len(journal['actions'])]:
+            logging.info(f' journal: pipeline or config changed, starting from first action')
+            return 0
+
+        # memory after each completed action, and index of last change per entry
+        states, changed_at, state = [], [], {}
+        for changed, removed in journal['changes']:
+            state = {**{key: value for key, value in state.items() if key not in removed}, **changed}
+            states.append(state)
+            changed_at.append({**(changed_at[-1] if changed_at else {}), **{key: len(states) - 1 for key in changed}})
+
+        # resume after last completed action, earlier if containers are not restorable (re-run action that set them)
+        start = len(states)
+        while start > 0:
+            missing = [key for key, value in states[start - 1].items() if not self._restorable(value)]
+            if not missing:
+                break
+            start = min(changed_at[start - 1][key] for key in missing)
+        if start == 0:
+            logging.info(f' journal: no restorable actions, starting from first action')
+            return 0
+
+        # restore memory and journal up to start
+        for key, value in states[start - 1].items():
+            memory[key] = self._restore(value) if isinstance(value, ContainerState) else value
+        self.actions = journal['actions'][:start]
+        self.changes = journal['changes'][:start]
+        self._encoded = {key: self._digest(pickle.dumps(self._encode(value), protocol=pickle.HIGHEST_PROTOCOL))
+                         for key, value in memory.items() if key not in _EXCLUDED}
+        if start == len(states):
+            self.intents_interrupted = set(journal['intents'])
+        logging.info(f' journal: resuming at action {start} ({actions[start] if start < len(actions) else "completed"})')
+        return start
+
+    def intent(self, key: str):
+        """Record side effect (e.g. append to file) before it is started."""
+        self.intents.add(key)
+        self._save()
+
+    def interrupted(self, key: str) -> bool:
+        """True if side effect was started by an interrupted attempt of the current action."""
+        return key in self.intents_interrupted
+
+    def commit(self, action: str, memory: Dict[str, Any]):
+        """Record completed action and changed memory entries."""
+        encoded, changed = {}, {}
+        for key, value in memory.items():
+            if key in _EXCLUDED:
+                continue
+            value = self._encode(value)
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            encoded[key] = self._digest(data)
+            if self._encoded.get(key) != encoded[key]:
+                changed[key] = value if len(data) <= self.max_entry else Oversized(len(data))
+        removed = [key for key in self._encoded if key not in encoded]
+        self._encoded = encoded
+        self.actions.append(action)
+        self.changes.append((changed, removed))
+        self.intents, self.intents_interrupted = set(), set()
+        self._save()
+
+    def remove(self):
+        """Remove journal of completed case, and the journal directory if empty."""
+        self.path.unlink(missing_ok=True)
+        try:
+            self.path.parent.rmdir()
+        except OSError: # not empty: journals of other cases
+            pass
@@ -0,0 +1,160 @@
+from typing import List, Tuple
+import numpy as np
+
+
+class CompactLabelMap():
+    """
+    Compact representation of label volumes (mostly background) in memory: runs of equal labels along one axis.
+    Principles:
+    - runs are stored along the axis of the smallest stride, never span rows (index along the other axes): row, start,
+      length and label per run, background (0) is not stored. Memory is proportional to the number of runs.
+    - queries (voxels per slice and label, bounding boxes) are computed from the runs, the volume is not densified.
+    - reorientation (transposes, flips) only changes the mapping of the axes, as views of dense arrays.
+    - `to_dense` restores the volume, identical to the input. Instances are not changed after creation.
+    """
+
+    def __init__(self, shape: Tuple[int, int, int], dtype, rows: np.ndarray, starts: np.ndarray, lengths: np.ndarray,
+                 values: np.ndarray, axes: Tuple[int, int, int] = (0, 1, 2), flips: Tuple[bool, bool, bool] = (False, False, False)):
+        self._shape = tuple(int(s) for s in shape) # stored layout
+        self.dtype = np.dtype(dtype)
+        self.rows, self.starts, self.lengths, self.values = rows, starts, lengths, values
+        self.axes = tuple(int(a) for a in axes) # output axis i = stored axis axes[i]
+        self.flips = tuple(bool(f) for f in flips) # output axis i reversed
+        self.labels = np.unique(values) # sorted, without background
+        self._counts = {} # cache: voxels per slice and label, per stored axis
+
+    def __repr__(self):
+        return f'CompactLabelMap(shape={self.shape}, labels={len(self.labels)}, runs={self.values.size}, {self.nbytes / 1024**2:.1f} MB)'
+
+    @classmethod
+    def from_dense(cls, data: np.ndarray, chunk: int = 2**24):
+        """Runs of dense label volume, computed in slabs of about `chunk` voxels (temporary memory). Runs are stored along
+        the axis of the smallest stride (any memory layout, e.g. views of reoriented data, without transposed copies)."""
+        if data.ndim != 3:
+            raise ValueError(f'Label volume must be 3D, got shape {data.shape}.')
+
+        # stored layout: axes by increasing stride, positive strides (fortran order for contiguous data)
+        order = [int(axis) for axis in np.argsort([abs(stride) for stride in data.strides], kind='stable')]
+        stored = data.transpose(order)
+        flips_stored = [stride < 0 for stride in stored.strides]
+        stored = stored[tuple(slice(None, None, -1) if flip else slice(None) for flip in flips_stored)]
+        axes = [order.index(axis) for axis in range(3)]
+        flips = [flips_stored[axis] for axis in axes]
+
+        # runs per slab along last stored axis
+        nx, ny, nz = stored.shape
+        start_dtype = np.min_scalar_type(nx)
+        step = max(1, chunk // max(nx * ny, 1))
+        rows, starts, lengths, values = [], [], [], []
+        for z0 in range(0, nz, step):
+            flat = np.asfortranarray(stored[:, :, z0:z0 + step]).ravel(order='F') # view if fortran order
+            if flat.size == 0:
+                continue
+            change = np.empty(flat.size, dtype=bool)
+            change[0] = True
+            np.not_equal(flat[1:], flat[:-1], out=change[1:])
+            change[::nx] = True # new row
+            position = np.flatnonzero(change)
+            length = np.diff(position, append=flat.size)
+            value = flat[position]
+            keep = value != 0
+            position, length, value = position[keep], length[keep], value[keep]
+            rows.append((position // nx + z0 * ny).astype(np.int64))
+            starts.append((position % nx).astype(start_dtype))
+            lengths.append(length.astype(start_dtype)) # runs within rows: length <= nx
+            values.append(value)
+            del change
+        concat = lambda parts, dtype: np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+        rows = concat(rows, np.int64)
+        rows = rows.astype(np.min_scalar_type(max(ny * nz - 1, 0))) # row index fits into smallest dtype
+        return cls(stored.shape, data.dtype, rows, concat(starts, start_dtype), concat(lengths, start_dtype),
+                   concat(values, data.dtype), axes, flips)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return tuple(self._shape[a] for a in self.axes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes + self.starts.nbytes + self.lengths.nbytes + self.values.nbytes
+
+    def _stored_counts(self, axis: int) -> np.ndarray:
+        """Voxels per index along stored axis (rows) and label (columns, as `labels`)."""
+        if axis not in self._counts:
+            n, n_labels = self._shape[axis], len(self.labels)
+            label_index = np.searchsorted(self.labels, self.values)
+            if axis == 0: # runs cover a range of indices: difference of run starts and ends
+                starts = self.starts.astype(np.int64)
+                counts = np.bincount(starts * n_labels + label_index, minlength=(n + 1) * n_labels) \
+                       - np.bincount((starts + self.lengths) * n_labels + label_index, minlength=(n + 1) * n_labels)
+                counts = np.cumsum(counts.reshape(n + 1, n_labels), axis=0)[:n]
+            else:
+                coordinate = self.rows % self._shape[1] if axis == 1 else self.rows // self._shape[1]
+                counts = np.bincount(coordinate.astype(np.int64) * n_labels + label_index, weights=self.lengths,
+                                     minlength=n * n_labels).reshape(n, n_labels)
+            self._counts[axis] = counts.astype(np.int64)
+        return self._counts[axis]
+
+    def slice_counts(self, axis: int = 2) -> np.ndarray:
+        """Voxels per slice along axis (rows) and label (columns, as `labels`), e.g. areas per slice."""
+        counts = self._stored_counts(self.axes[axis])
+        return counts[::-1] if self.flips[axis] else counts
+
+    def label_slice_counts(self, labels: List[int], axis: int = 2) -> np.ndarray:
+        """Voxels per slice along axis (rows) for the given labels (columns), 0 for labels not present."""
+        counts = self.slice_counts(axis)
+        result = np.zeros((counts.shape[0], len(labels)), dtype=np.int64)
+        for i, label in enumerate(labels):
+            index = np.searchsorted(self.labels, label)
+            if index < len(self.labels) and self.labels[index] == label:
+                result[:, i] = counts[:, index]
+        return result
+
+    def bbox(self, labels: List[int] = None) -> List[int]:
+        """Bounding box [min, max) per axis of voxels with the given labels (default: all), None if not present."""
+        if labels is None:
+            select = slice(None)
+        else:
+            select = np.isin(self.values, labels)
+            if not select.any():
+                return None
+        if self.values[select].size == 0:
+            return None
+        rows = self.rows[select].astype(np.int64)
+        starts = self.starts[select].astype(np.int64)
+        stored = [(starts.min(), (starts + self.lengths[select]).max()),
+                  ((rows % self._shape[1]).min(), (rows % self._shape[1]).max() + 1),
+                  ((rows // self._shape[1]).min(), (rows // self._shape[1]).max() + 1)]
+        bbox = []
+        for axis, flip in zip(self.axes, self.flips):
+            low, high = int(stored[axis][0]), int(stored[axis][1])
+            bbox.extend([self._shape[axis] - high, self._shape[axis] - low] if flip else [low, high])
+        return bbox
+
+    def reoriented(self, ornt: np.ndarray):
+        """Label map reoriented as `nibabel.orientations.apply_orientation(data, ornt)`, runs are shared."""
+        axes, flips = [0, 0, 0], [False, False, False]
+        for axis, (axis_new, flip) in enumerate(np.asarray(ornt, dtype=int)):
+            axes[axis_new] = self.axes[axis]
+            flips[axis_new] = self.flips[axis] != (flip == -1)
+        labelmap = CompactLabelMap(self._shape, self.dtype, self.rows, self.starts, self.lengths, self.values, axes, flips)
+        labelmap._counts = self._counts
+        return labelmap
+
+    def to_dense(self, chunk: int = 2**22) -> np.ndarray:
+        """Dense label volume (view in output orientation of array in stored fortran order), runs are filled in batches
+        of about `chunk` voxels (temporary memory)."""
+        data = np.zeros(self._shape, dtype=self.dtype, order='F')
+        flat = data.ravel(order='F') # view
+        lengths = self.lengths.astype(np.int64)
+        positions = self.rows.astype(np.int64) * self._shape[0] + self.starts
+        ends = np.cumsum(lengths)
+        first = 0
+        while first < lengths.size:
+            last = max(int(np.searchsorted(ends, ends[first] - lengths[first] + chunk, side='right')), first + 1)
+            length, offset = lengths[first:last], np.cumsum(lengths[first:last]) - lengths[first:last]
+            index = np.arange(int(length.sum()), dtype=np.int64) + np.repeat(positions[first:last] - offset, length)
+            flat[index] = np.repeat(self.values[first:last], length)
+            first = last
+        data = data.transpose(self.axes)
+        return data[tuple(slice(None, None, -1) if flip else slice(None) for flip in self.flips)]
@@ -1,14 +1,20 @@
 # libraries
 import logging
 import sys
-import torch.cuda as cuda
 from psutil import virtual_memory
 from pathlib import Path
 import yaml
 
-# function to initialze logging handlers (file and console)
+# handlers added by init_logging, replaced when called again; settings of last call
+_handlers = []
+_settings = {}
+
+# function to initialze logging handlers (file and console), idempotent: previous handlers are replaced
 def init_logging(file: str = None, level_file: int = logging.INFO, level_console: int = logging.WARNING):
 
+    # remove handlers of previous call
+    close_logging()
+
     # create dir if not existing
     Path(file).parent.mkdir(parents=True, exist_ok=True)
 
@@ -24,6 +30,21 @@ def init_logging(file: str = None, level_file: int = logging.INFO, level_console
     logger.setLevel(logging.DEBUG) # record everything
     logger.addHandler(stream_handler)
     logger.addHandler(file_handler)
+    _handlers.extend([stream_handler, file_handler])
+    _settings.update(file=file, level_file=level_file, level_console=level_console)
+
+# function to get settings of init_logging, e.g. to initialize logging in worker processes
+def logging_settings():
+    return dict(_settings)
+
+# function to remove and close handlers added by init_logging
+def close_logging():
+    logger = logging.getLogger()
+    while _handlers:
+        handler = _handlers.pop()
+        logger.removeHandler(handler)
+        handler.close()
+    _settings.clear()
 
 # class to redirect logging to a file
 class LoggingWriter:
@@ -42,7 +63,9 @@ def log_gpu_usage(device=None):
     memory_info = virtual_memory()
     msg = ' usage:'
     msg += f' RAM {round(memory_info.used/(1024**3),1)}/{round(memory_info.total/(1024**3),1)}GB'
-    if cuda.is_available():
+    torch = sys.modules.get('torch') # not imported = no gpu in use
+    if torch is not None and torch.cuda.is_available():
+        cuda = torch.cuda
         msg += f' | VRAM {round(cuda.max_memory_allocated(device)/(1024**3),1)}/{round(cuda.max_memory_reserved(device)/(1024**3),1)}GB'
     logging.info(msg)
 
@@ -85,4 +85,106 @@ def fill_holes(mask_np, labels=None):
             mask[labeled != largest_label] = 0
             np.invert(mask, out=mask)
             mask_framed[mask] = label
-    mask_np[:] = mask_framed[1:-1, 1:-1, 1:-1]
\ No newline at end of file
+    mask_np[:] = mask_framed[1:-1, 1:-1, 1:-1]
+
+# slabs along the last axis: [z0, z1) of `size` slices
+def slab_bounds(n, size):
+    return [(z0, min(z0 + size, n)) for z0 in range(0, n, size)]
+
+
+# runs of selected slices [z0, z1), split into slabs of `size` slices (None = not split)
+def selection_bounds(selected, size=None):
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], np.asarray(selected, dtype=np.int8), [0]])))
+    bounds = []
+    for z0, z1 in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        bounds.extend([(z0, z1)] if size is None else [(z, min(z + size, z1)) for z in range(z0, z1, size)])
+    return bounds
+
+
+class SlabComponents():
+    """
+    Connected components (as scipy.ndimage.label, 6-connectivity) of a boolean volume provided in slabs along the last
+    axis, `get_mask(i)` returns the mask of slab i (`bounds[i]`) of the volume of size `shape`. Slabs are labeled
+    separately, components touching across slab borders are merged (union-find). Only labels of one slab are held at a
+    time, `mask` labels the slab again.
+    """
+
+    def __init__(self, get_mask, shape, bounds):
+        self.get_mask = get_mask
+        self.offsets = [] # global id of first component per slab - 1
+        nx, ny, nz = shape
+        parent, sizes, keys = [0], [0], [0]
+        previous, offset = None, 0
+        for i, (z0, z1) in enumerate(bounds):
+            labeled, n = ndi_label(get_mask(i))
+            self.offsets.append(offset)
+            flat = labeled.ravel()
+            position = np.flatnonzero(flat)
+            ids = flat[position]
+            sizes.extend(np.bincount(ids, minlength=n + 1)[1:].tolist())
+            # first voxel of each component in C order of the volume, orders components as scipy.ndimage.label
+            first = np.full(n + 1, flat.size, dtype=np.int64)
+            np.minimum.at(first, ids, position)
+            x, y, z = np.unravel_index(np.minimum(first[1:], flat.size - 1), labeled.shape)
+            keys.extend(((x.astype(np.int64) * ny + y) * nz + z0 + z).tolist())
+            parent.extend(range(offset + 1, offset + n + 1))
+            # merge components of adjacent slices of neighbouring slabs
+            if previous is not None:
+                current = labeled[:, :, 0].astype(np.int64) + offset
+                touching = (previous > 0) & (labeled[:, :, 0] > 0)
+                for a, b in np.unique(np.stack([previous[touching], current[touching]], axis=1), axis=0):
+                    root_a, root_b = self._find(parent, int(a)), self._find(parent, int(b))
+                    if root_a != root_b:
+                        parent[max(root_a, root_b)] = min(root_a, root_b)
+            previous = np.where(labeled[:, :, -1] > 0, labeled[:, :, -1].astype(np.int64) + offset, 0)
+            offset += n
+            del labeled, flat, position, ids
+        self.roots = np.array([self._find(parent, i) for i in range(offset + 1)], dtype=np.int64)
+        self.sizes = np.bincount(self.roots, weights=sizes, minlength=offset + 1)
+        self.keys = np.full(offset + 1, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(self.keys, self.roots, np.array(keys, dtype=np.int64))
+        self.count = int(np.count_nonzero(self.sizes[1:]))
+
+    @staticmethod
+    def _find(parent, a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def largest(self):
+        """Id of the largest component (ties: first in C order, as argmax of sizes), None without components."""
+        if not self.count:
+            return None
+        candidates = np.flatnonzero(self.sizes[1:] == self.sizes[1:].max()) + 1
+        return int(candidates[np.argmin(self.keys[candidates])])
+
+    def mask(self, i, component):
+        """Mask of component in slab i."""
+        labeled, n = ndi_label(self.get_mask(i))
+        lookup = np.zeros(n + 1, dtype=bool)
+        lookup[1:] = self.roots[self.offsets[i] + 1:self.offsets[i] + n + 1] == component
+        return lookup[labeled]
+
+
+# function to keep the largest object and fill its holes (as filter_keep_largest and fill_holes), in slabs
+# - get_mask(z0, z1) returns the boolean mask of slices z0:z1, yields the result per slab of `bounds`
+# - identical results, temporary memory bounded by the slab size
+def filter_keep_largest_fill_holes_slabs(get_mask, shape, bounds):
+    nx, ny, nz = shape
+    last = len(bounds) - 1
+    largest = SlabComponents(lambda i: get_mask(*bounds[i]), shape, bounds)
+    component = largest.largest()
+    kept = lambda i: largest.mask(i, component) if component is not None else get_mask(*bounds[i])
+
+    # fill holes: inverted mask padded by one voxel, largest component = surrounding
+    bounds_framed = [(z0 + (i > 0), z1 + 1 + (i == last)) for i, (z0, z1) in enumerate(bounds)]
+    def inverted(i):
+        z0, z1 = bounds[i]
+        framed = np.ones((nx + 2, ny + 2, bounds_framed[i][1] - bounds_framed[i][0]), dtype=bool)
+        np.logical_not(kept(i), out=framed[1:-1, 1:-1, int(i == 0):int(i == 0) + z1 - z0])
+        return framed
+    surrounding = SlabComponents(inverted, (nx + 2, ny + 2, nz + 2), bounds_framed)
+    component_surrounding = surrounding.largest()
+    for i, (z0, z1) in enumerate(bounds):
+        yield ~surrounding.mask(i, component_surrounding)[1:-1, 1:-1, int(i == 0):int(i == 0) + z1 - z0]
@@ -1,8 +1,33 @@
 from typing import Union
 from pathlib import Path
-from nibabel import Nifti1Image, load as nib_load, save as nib_save, as_closest_canonical
+from nibabel import Nifti1Image
+from nibabel.orientations import io_orientation, inv_ornt_aff, apply_orientation
+from nibabel.affines import voxel_sizes
+from functools import lru_cache
+from BodyComposition.utils.shared import SharedVolume, create_shared, attach_shared, release_shared
+from BodyComposition.utils.writer import save_atomic
+from BodyComposition.utils.codecs import NiftiCodec
+from BodyComposition.utils.labelmap import CompactLabelMap
 import numpy as np
 
+
+@lru_cache(maxsize=32)
+def _lookup_table(mapping: tuple, dtype: str) -> np.ndarray:
+    """Lookup table for remapping labels, covering all values of an unsigned dtype (read-only, cached)."""
+    lookup_table = np.zeros(np.iinfo(dtype).max + 1, dtype=dtype)
+    for key, value in mapping:
+        if key < lookup_table.size:
+            lookup_table[key] = value
+    lookup_table.flags.writeable = False
+    return lookup_table
+
+def _apply_lookup_table(data: np.ndarray, lookup_table: np.ndarray, chunk: int = 2**22):
+    """Apply lookup table in place, in slabs along first axis (temporary memory limited to ~chunk voxels)."""
+    step = max(1, chunk // max(1, data[0].size))
+    for i in range(0, data.shape[0], step):
+        data[i:i+step] = lookup_table[data[i:i+step]]
+
+
 class NiftiDataContainer():
     """
     Class for loading and handling the Nifti data.
@@ -11,6 +36,13 @@ class NiftiDataContainer():
     - orientation is as in original file
     - metadata stored separetely, and used to for exports and imports (especially to bbox)
     - data are not loaded upon initialization, but only when needed; some actions only require file path.
+    - data are not copied if not necessary: dtype conversions only if dtype differs (`set_data(copy=False)`), containers
+      derived from others (`derive`) share the data read-only until they are written (copy-on-write).
+    - data can be backed by shared memory (`share`), containers are then pickled as handle and attached zero-copy by
+      other processes (`from_shared`). Changes of data are visible to all processes. The creating process owns the
+      segment, which must be released explicitly (`release_shared`).
+    - label volumes can be held compactly (`compact`, runs of labels), queried without densifying (`labelmap`), and
+      are densified when data_np is accessed.
     """
     
     def __init__(self, path: Union[str, Path]):
@@ -24,6 +56,11 @@ class NiftiDataContainer():
         self._shape = None
         self._spacing = None
         self._bbox = None
+        self._modified = False # data changed since loaded from or saved to file
+        self._shm = None # shared memory segment backing data, if shared
+        self._shm_owner = False
+        self._cow = False # data shared read-only with other containers, copied before writing
+        self._labelmap = None # compact data (CompactLabelMap), replaces _data_np if set
 
         # set datatype
         if any(keyword in path.parent.name for keyword in ['label', 'mask']):
@@ -47,6 +84,8 @@ class NiftiDataContainer():
     
     @property
     def shape(self):
+        if self._labelmap is not None and self._bbox is None:
+            return self._labelmap.shape
         if self.data_np is None:
             return None
         else:
@@ -68,12 +107,91 @@ class NiftiDataContainer():
             return affine_cropped
         
     
+    @property
+    def nbytes(self):
+        """Size of loaded data in bytes (dense or compact), does not trigger loading."""
+        if self._labelmap is not None:
+            return self._labelmap.nbytes
+        return 0 if self._data_np is None else self._data_np.nbytes
+
+    @property
+    def loaded(self):
+        """True if data are in memory (dense or compact), does not trigger loading."""
+        return self._data_np is not None or self._labelmap is not None
+
+    @property
+    def modified(self):
+        """True if data were set or changed in memory since loaded from or saved to file."""
+        return self._modified
+
     def exists(self):
-        return self._data_np is not None or self.path.exists()
+        return self.loaded or self.path.exists()
         
     def clear(self):
         """Clears data_np, usefull for making some space, keeps metadata."""
         self._data_np = None
+        self._labelmap = None
+        self._cow = False
+        self.release_shared(copy=False)
+
+
+
+    @property
+    def shared(self):
+        """Handle (SharedVolume) if data are backed by shared memory, otherwise None."""
+        if self._shm is None:
+            return None
+        return SharedVolume(self._shm.name, self._data_np.shape, self._data_np.dtype.str, self._path,
+                            self._affine, self._spacing, self._bbox, self._modified)
+
+    def share(self) -> SharedVolume:
+        """Move data to shared memory (one copy), owned by this container. Returns handle for other processes."""
+        if self._shm is None:
+            self._densify()
+            if self._data_np is None:
+                if not self.path.exists():
+                    raise ValueError(f'No data available for sharing.')
+                self.load_from_file()
+            self._shm, self._data_np = create_shared(self._data_np)
+            self._shm_owner = True
+            self._cow = False
+        return self.shared
+
+    @classmethod
+    def from_shared(cls, handle: SharedVolume):
+        """Container attached to data in shared memory (zero-copy), with metadata of handle."""
+        container = cls(handle.path)
+        container._attach(handle)
+        return container
+
+    def _attach(self, handle: SharedVolume):
+        self._shm, self._data_np = attach_shared(handle.name, handle.shape, handle.dtype)
+        self._shm_owner = False
+        self.dtype = self._data_np.dtype.type
+        self._affine, self._shape, self._spacing = handle.affine, handle.shape, handle.spacing
+        self._bbox, self._modified = handle.bbox, handle.modified
+
+    def release_shared(self, copy: bool = True):
+        """Detach from shared memory: keep a private copy of data (or clear), unlink segment if owner."""
+        if self._shm is None:
+            return
+        self._data_np = np.array(self._data_np) if copy and self._data_np is not None else None
+        release_shared(self._shm, unlink=self._shm_owner)
+        self._shm, self._shm_owner = None, False
+
+    def __getstate__(self):
+        """Pickle shared containers as handle only."""
+        state = self.__dict__.copy()
+        if self._shm is not None:
+            state['_shared'] = self.shared
+            state['_data_np'], state['_shm'], state['_shm_owner'] = None, None, False
+        return state
+
+    def __setstate__(self, state):
+        handle = state.pop('_shared', None)
+        self.__dict__.update(state)
+        if handle is not None:
+            self._attach(handle)
 
 
 
@@ -106,7 +224,7 @@ class NiftiDataContainer():
             # save data & metadata
             self._affine = value.affine
             self._spacing = value.header.get_zooms()
-            self.data_np = value.get_fdata()
+            self._set_data_nib(value)
         
         else:
 
@@ -119,7 +237,18 @@ class NiftiDataContainer():
         
             # save data
             # metadata are already available (requirement of bbox)
-            self.data_np = value.get_fdata()
+            self._set_data_nib(value)
+
+    def _set_data_nib(self, value: Nifti1Image):
+        """Set data of nibabel: integer data without scaling as stored (no float64 copy, no second copy of file data)."""
+        dataobj = value.dataobj
+        if np.dtype(dataobj.dtype).kind in 'iu' and getattr(dataobj, 'slope', 1) == 1 and getattr(dataobj, 'inter', 0) == 0:
+            data = np.asanyarray(dataobj)
+            if isinstance(data, np.memmap):
+                data = np.array(data) # not backed by file, which might be replaced
+            self.set_data(data, copy=data is dataobj) # in-memory arrays of nibabel objects are copied
+        else:
+            self.set_data(value.get_fdata(), copy=False)
 
 
 
@@ -127,6 +256,7 @@ class NiftiDataContainer():
     def data_np(self):
         """Get numpy: if no bbox: all. if bbox: only inside."""
 
+        self._densify()
         if self._data_np is None:
             if self.path.exists():
                 self.load_from_file()
@@ -143,21 +273,93 @@ class NiftiDataContainer():
 
     @data_np.setter
     def data_np(self, value: np.ndarray):
-        """Set numpy: check shape. if no bbox: all. if bbox: only inside."""
+        """Set numpy: check shape. if no bbox: all. if bbox: only inside. Value is copied."""
+        self.set_data(value)
+
+    def set_data(self, value: np.ndarray, copy: bool = True):
+        """Set numpy as setter of data_np. copy=False: value is used without copy if dtype matches (if no bbox),
+        it must not be used by the caller afterwards."""
 
         bbox = self._bbox
         if bbox is None:
+            self._labelmap = None # replaced
             if self._shape is None:
                 self._shape = value.shape
             elif self._shape != value.shape:
                 raise ValueError(f'Numpy shapes do not match: {self._shape} != {value.shape}')
-            self._data_np = value.astype(self.dtype)
+            if self._shm is not None:
+                self._data_np[...] = value # in place, stays shared
+            else:
+                self._data_np = value.astype(self.dtype, copy=copy)
+                self._cow = False
+            self._modified = True
 
         else:
             bbox_shape = (bbox[1]-bbox[0], bbox[3]-bbox[2], bbox[5]-bbox[4]) # RAS+
             if bbox_shape != value.shape:
                 raise ValueError(f'Numpy shapes do not match: {bbox_shape} != {value.shape}')
-            self._data_np[bbox[0]:bbox[1], bbox[2]:bbox[3], bbox[4]:bbox[5]] = value.astype(self.dtype)
+            self.materialize()
+            self._data_np[bbox[0]:bbox[1], bbox[2]:bbox[3], bbox[4]:bbox[5]] = value # cast on assignment
+            self._modified = True
+
+    def materialize(self):
+        """Own copy of data if shared copy-on-write with other containers, required before writing data_np in place."""
+        self._densify()
+        if self._cow:
+            self._data_np = self._data_np.copy()
+            self._cow = False
+
+    def derive(self, path: Union[str, Path]):
+        """New container with metadata, bbox and data of this container. Data are shared read-only (copy-on-write):
+        each container copies data before it is written by setter or remap, writing data_np in place raises an error
+        (call `materialize` before)."""
+        container = NiftiDataContainer(path)
+        self._densify()
+        if self._data_np is None and self.path.exists():
+            self.load_from_file()
+        container._affine, container._shape, container._spacing = self._affine, self._shape, self._spacing
+        container._bbox = self._bbox
+        if self._data_np is not None:
+            if container.dtype != self._data_np.dtype or self._shm is not None:
+                container._data_np = self._data_np.astype(container.dtype) # no read-only view of other dtype or shared memory
+            else:
+                self._data_np.flags.writeable = False
+                self._cow = container._cow = True
+                container._data_np = self._data_np.view()
+            container._modified = True
+        return container
+
+    @property
+    def labelmap(self):
+        """Compact label data (CompactLabelMap) for queries, e.g. voxels per slice and label or bounding boxes. Data
+        held compactly are returned as they are, otherwise created from data_np (within bbox) and not stored."""
+        if self._labelmap is not None and self._bbox is None:
+            return self._labelmap
+        data_np = self.data_np
+        if data_np is None:
+            return None
+        return CompactLabelMap.from_dense(data_np)
+
+    def compact(self) -> bool:
+        """Hold label data compactly instead of dense (e.g. until queried by later actions), densified when data_np is
+        accessed. Only loaded label data (unsigned integers) without bbox, not shared, and if at least half the size.
+        Returns True if data are compact."""
+        if self._labelmap is not None:
+            return True
+        data_np = self._data_np
+        if data_np is None or self._bbox is not None or self._shm is not None or data_np.dtype.kind != 'u' or data_np.ndim != 3:
+            return False
+        labelmap = CompactLabelMap.from_dense(data_np)
+        if labelmap.nbytes > data_np.nbytes // 2:
+            return False
+        self._labelmap, self._data_np, self._cow = labelmap, None, False
+        return True
+
+    def _densify(self):
+        """Dense data from compact data, if held compactly."""
+        if self._labelmap is not None:
+            self._data_np = self._labelmap.to_dense()
+            self._labelmap = None
 
 
 
@@ -198,59 +400,93 @@ class NiftiDataContainer():
 
 
 
-    def save_to_file(self):
-        """Save data to nifti file: if NA, error. if AV, use nib getter."""
+    def save_to_file(self, writer=None):
+        """Save data to nifti file: if NA, error. if AV, use nib getter. Saved atomically (temporary file, renamed).
+        With writer (BackgroundWriter): compressed by its codec; if in background, a snapshot of data is saved and errors
+        are raised by writer.flush()."""
         data_nib = self.data_nib
         if data_nib is None:
             raise ValueError(f'Nothing to save.')  
         else:
             self.path.parent.mkdir(parents=True, exist_ok=True)
-            nib_save(data_nib, self.path)
+            if writer is None:
+                save_atomic(data_nib, self.path)
+            elif not writer.background:
+                writer.submit(data_nib, self.path)
+            else:
+                writer.submit(Nifti1Image(np.array(data_nib.dataobj), data_nib.affine), self.path)
+            if self._bbox is None: # file contains data within bbox only
+                self._modified = False
 
     def load_from_file(self):
         """Load data from nifti file: if NA, error. if AV, use nib setter"""
         if not self.path.exists():
             raise FileNotFoundError(f'File not available at {self.path}.')
         else:       
-            self.data_nib = nib_load(self.path)
+            self.data_nib = NiftiCodec.load(self.path)
+            self._modified = False
 
 
 
     def remap(self, mapping: dict):
-        """Remap labels: replace values in data_np usimg mapping dictionary."""
+        """Remap labels in place: replace values in data_np using mapping dictionary, not mapped labels are set to 0."""
         tmp_data_np = self.data_np # load np
         if tmp_data_np is None:
             raise ValueError(f'No data available for remapping.')
+        self.materialize()
+        tmp_data_np = self.data_np
+        if tmp_data_np.dtype in (np.uint8, np.uint16):
+            relabel_array = _lookup_table(tuple(sorted(mapping.items())), tmp_data_np.dtype.str) # covers all values, cached
         else:
-            # create mapping array for relabeling, not existing labels are replaced with 0, then fancy indexing
+            # create mapping array sized by max label
             labels_max = max(max(mapping.keys()), np.max(tmp_data_np))
-            relabel_array = np.zeros(labels_max+1, dtype=np.uint8)
+            relabel_array = np.zeros(labels_max+1, dtype=tmp_data_np.dtype)
             for key, value in mapping.items():
                 relabel_array[key] = value
-            self.data_np = relabel_array[tmp_data_np]
+        _apply_lookup_table(tmp_data_np, relabel_array)
+        self._modified = True
 
 
 
     def as_closest_canonical(self):
-        """Transform data within bbox to canonical orientation.
+        """Transform data within bbox to canonical orientation (RAS+).
+        Flips and transposes of the axes are applied as strided numpy view (no copy), the affine is updated analytically.
+        Data are materialized only if they are backed by shared memory, or when a contiguous buffer is required later.
         Currently one way function, all changes to data are permanently.
         Multiple reorientations should be avoided to reduce affine inaccuracies that are caused by rounding."""
 
-        # load nib
-        if self._data_np is not None and self._affine is not None:
-            data_nib = self.data_nib
-        elif self.path.exists():
-            data_nib = nib_load(self.path)
-        else:
+        # compact data: mapping of axes of labelmap is changed
+        if self._labelmap is not None and self._bbox is None:
+            ornt = io_orientation(self._affine)
+            self._affine = self._affine.dot(inv_ornt_aff(ornt, self._labelmap.shape))
+            self._spacing = tuple(np.float32(z) for z in voxel_sizes(self._affine))
+            self._labelmap = self._labelmap.reoriented(ornt)
+            self._shape = self._labelmap.shape
+            self._modified = True
+            return
+
+        # data and affine within bbox, loaded from file if necessary
+        if not self.loaded and not self.path.exists():
+            raise ValueError(f'Data not complete, can not reorientate')
+        data_np, affine = self.data_np, self.affine
+        if affine is None:
             raise ValueError(f'Data not complete, can not reorientate')
 
-        # reorientate nib
-        data_reoriented_nib = as_closest_canonical(data_nib)
-        data_reoriented_np = data_reoriented_nib.get_fdata().astype(self.dtype)
+        # reorientate: closest canonical axes, as nibabel.as_closest_canonical
+        ornt = io_orientation(affine)
+        data_reoriented_np = apply_orientation(data_np, ornt) # view
+        affine_reoriented = affine.dot(inv_ornt_aff(ornt, data_np.shape))
+        spacing_reoriented = tuple(np.float32(z) for z in voxel_sizes(affine_reoriented)) # as header of nibabel image
+
+        # new layout: detach from shared memory
+        if self._shm is not None:
+            data_reoriented_np = np.array(data_reoriented_np)
+            self.release_shared(copy=False)
 
         # reset existing bbox & metadata, set np
         self.bbox = None
-        self._affine = data_reoriented_nib.affine
+        self._affine = affine_reoriented
         self._shape = data_reoriented_np.shape
-        self._spacing = data_reoriented_nib.header.get_zooms()
-        self._data_np = data_reoriented_np
\ No newline at end of file
+        self._spacing = spacing_reoriented
+        self._data_np = data_reoriented_np
+        self._modified = True
\ No newline at end of file
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Dict, Any
+from psutil import Process
+import numpy as np
+import pandas as pd
+import logging
+import json
+import sys
+
+
+# peak resident set size (high water mark) in bytes
+# linux: VmHWM can be reset per action via /proc/self/clear_refs, otherwise only the process lifetime maximum is available
+def _read_peak_rss():
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# size of arrays in memory, without triggering lazy loading of containers
+def nbytes(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    elif hasattr(value, 'nbytes'):
+        return value.nbytes
+    return 0
+
+
+class ActionProfiler():
+    """
+    Records wall time, cpu time, resident memory, io and output sizes for each action of a case.
+    Records are collected in memory (`tmp/profile`) and appended to a jsonl file in the workspace at the end of each case.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.process = Process()
+        logging.info(f'  profiling active, records saved to {{workspace}}/{file}')
+
+    def _io(self):
+        try:
+            io = self.process.io_counters()
+            return io.read_bytes, io.write_bytes
+        except (AttributeError, NotImplementedError):
+            return None, None # not available on macOS
+
+    @contextmanager
+    def record(self, action, memory: Dict[str, Any]):
+        """Context manager wrapping a single action call."""
+        records = memory.setdefault('tmp/profile', [])
+        peak_resettable = _reset_peak_rss()
+        peak_start = _read_peak_rss()
+        rss_start = self.process.memory_info().rss
+        read_start, write_start = self._io()
+        wall_start, cpu_start = perf_counter(), process_time()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            wall, cpu = perf_counter() - wall_start, process_time() - cpu_start
+            rss_end = self.process.memory_info().rss
+            read_end, write_end = self._io()
+            peak_end = _read_peak_rss()
+            records.append({
+                'case_id': memory['id'],
+                'index': len(records),
+                'action': repr(action),
+                'task': getattr(action, 'task', None),
+                'status': status,
+                'wall_s': round(wall, 4),
+                'cpu_s': round(cpu, 4),
+                'rss_start_mb': round(rss_start / 1024**2, 1),
+                'rss_end_mb': round(rss_end / 1024**2, 1),
+                'peak_rss_delta_mb': round(max(peak_end - (rss_start if peak_resettable else peak_start), 0) / 1024**2, 1),
+                'read_mb': None if read_start is None else round((read_end - read_start) / 1024**2, 2),
+                'write_mb': None if write_start is None else round((write_end - write_start) / 1024**2, 2),
+                'outputs_mb': {key: round(nbytes(memory[key]) / 1024**2, 2) for key in action.io_outputs if key in memory},
+            })
+
+    def flush(self, memory: Dict[str, Any]):
+        """Append records of case to jsonl file, single write to keep lines of concurrent writers intact."""
+        records = memory.get('tmp/profile', [])
+        if not records:
+            return
+        path_output = Path(memory['workspace'], self.file)
+        path_output.parent.mkdir(parents=True, exist_ok=True)
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        with open(path_output, 'a') as f:
+            f.write(lines)
+        logging.info(f' profile: {len(records)} records saved to {path_output}')
@@ -0,0 +1,241 @@
+from pathlib import Path
+from typing import Dict, Set, Union
+from urllib.parse import quote, unquote
+import pandas as pd
+import sqlite3
+import os
+
+
+# column types of results stores (`int`, `float`, `text`), given by the exporting action (e.g. dtype of DataCombine and
+# metadata columns), identical for all cases; columns without given type are derived from the dtype of the first case
+SQL_TYPES = {'int': 'INTEGER', 'float': 'REAL', 'text': 'TEXT'}
+
+def column_types(df: pd.DataFrame, types: Dict[str, str] = None) -> Dict[str, str]:
+    """Types of all columns of df: as given, otherwise by dtype."""
+    types = types or {}
+    result = {}
+    for col in df.columns:
+        if col in types:
+            result[col] = types[col]
+        elif pd.api.types.is_bool_dtype(df[col].dtype) or pd.api.types.is_integer_dtype(df[col].dtype):
+            result[col] = 'int'
+        elif pd.api.types.is_float_dtype(df[col].dtype):
+            result[col] = 'float'
+        else:
+            result[col] = 'text'
+    return result
+
+def _typed(df: pd.DataFrame, types: Dict[str, str]) -> pd.DataFrame:
+    """Columns converted to their types (nullable), missing values (None, NaN) as NA."""
+    converted = {}
+    for col, kind in types.items():
+        if kind == 'text':
+            converted[col] = df[col].astype('string')
+        else:
+            values = pd.to_numeric(df[col], errors='coerce')
+            converted[col] = values.astype('Int64' if kind == 'int' else 'Float64')
+    return pd.DataFrame(converted, index=df.index)
+
+
+class SQLiteStore():
+    """
+    Consolidated results in a single SQLite database (table `results`).
+    - write-ahead logging, concurrent workers can write while others are reading
+    - each case is committed atomically: rows of a case are replaced (delete + insert) in a single transaction
+    """
+
+    def __init__(self, path: Union[str, Path], table: str = 'results', timeout: float = 60):
+        self.path = Path(path)
+        self.table = table
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f'SQLiteStore(path={self.path})'
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _columns(self, connection):
+        return [row[1] for row in connection.execute(f'PRAGMA table_info("{self.table}")')]
+
+    def write(self, case_id: str, df: pd.DataFrame, types: Dict[str, str] = None):
+        """Replace all rows of case in a single transaction, create table from columns of df (types, see `column_types`)
+        if not existing."""
+        columns = list(df.columns)
+        types = column_types(df, types)
+        df = _typed(df, types)
+        rows = df.astype(object).where(df.notna(), None).to_dict('split')['data']
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            columns_store = self._columns(connection)
+            if not columns_store:
+                columns_sql = ', '.join(f'"{col}" {SQL_TYPES[types[col]]}' for col in columns)
+                connection.execute(f'CREATE TABLE "{self.table}" ({columns_sql})')
+                connection.execute(f'CREATE INDEX "{self.table}_case_id" ON "{self.table}" ("case_id")')
+            elif columns_store != columns:
+                raise ValueError(f'Columns do not match schema of {self.path}:\n{columns} vs \n{columns_store}')
+            connection.execute(f'DELETE FROM "{self.table}" WHERE case_id = ?', (case_id,))
+            if rows:
+                placeholders = ', '.join('?' * len(columns))
+                connection.executemany(f'INSERT INTO "{self.table}" VALUES ({placeholders})', rows)
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def case_ids(self) -> Set[str]:
+        """Case ids with rows in the store, empty if not existing."""
+        if not self.path.exists():
+            return set()
+        connection = self._connect()
+        try:
+            if not self._columns(connection):
+                return set()
+            return {str(row[0]) for row in connection.execute(f'SELECT DISTINCT case_id FROM "{self.table}"')}
+        finally:
+            connection.close()
+
+    def read(self, query: str = None) -> pd.DataFrame:
+        """Read all results, or the result of a sql query."""
+        connection = self._connect()
+        try:
+            return pd.read_sql_query(query or f'SELECT * FROM "{self.table}"', connection)
+        finally:
+            connection.close()
+
+
+class ParquetStore():
+    """
+    Consolidated results as hive-partitioned parquet dataset (`<path>/case_id=<id>/part-0.parquet`).
+    - each case is a separate file, written to a temporary file and renamed, so concurrent workers never share a file
+    - re-running a case replaces its partition
+    - read the cohort using `pandas.read_parquet(path)`, which only scans requested columns/partitions
+    Requires pyarrow.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        try:
+            import pyarrow # noqa: F401
+        except ImportError as e:
+            raise ImportError('Results store `parquet` requires pyarrow, e.g. `pip install pyarrow`.') from e
+        self.path = Path(path)
+
+    def __repr__(self):
+        return f'ParquetStore(path={self.path})'
+
+    def write(self, case_id: str, df: pd.DataFrame, types: Dict[str, str] = None):
+        """Write rows of case to its partition (atomic rename), case_id is encoded in the partition path. Columns are
+        written with fixed types (see `column_types`), so partitions are read as one dataset."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        path_partition = self.path / f'case_id={quote(str(case_id), safe="")}'
+        path_partition.mkdir(parents=True, exist_ok=True)
+        file = path_partition / 'part-0.parquet'
+        file_tmp = path_partition / f'.part-0.{os.getpid()}.tmp'
+
+        # fixed schema for all partitions, independent of missing values of the case
+        df = df.drop(columns='case_id', errors='ignore')
+        types = column_types(df, types)
+        pa_types = {'int': pa.int64(), 'float': pa.float64(), 'text': pa.string()}
+        schema = pa.schema([(col, pa_types[kind]) for col, kind in types.items()])
+        pq.write_table(pa.Table.from_pandas(_typed(df, types), schema=schema, preserve_index=False), file_tmp)
+        os.replace(file_tmp, file)
+
+    def case_ids(self) -> Set[str]:
+        """Case ids with a partition in the store, empty if not existing."""
+        if not self.path.is_dir():
+            return set()
+        return {unquote(path.name.partition('=')[2]) for path in self.path.iterdir()
+                if path.name.startswith('case_id=') and (path / 'part-0.parquet').exists()}
+
+    def read(self, **kwargs) -> pd.DataFrame:
+        """Read results, kwargs are passed to `pandas.read_parquet` (e.g. columns, filters)."""
+        return pd.read_parquet(self.path, **kwargs)
+
+
+# results store by name, the file suffix of the csv file is replaced
+valid_stores = ['csv', 'sqlite', 'parquet']
+
+def open_store(store: str, path: Union[str, Path]):
+    """Open results store `sqlite` (<path>.sqlite) or `parquet` (<path>.parquet/), None for `csv`."""
+    if store == 'csv':
+        return None
+    elif store == 'sqlite':
+        return SQLiteStore(Path(path).with_suffix('.sqlite'))
+    elif store == 'parquet':
+        return ParquetStore(Path(path).with_suffix('.parquet'))
+    raise ValueError(f'Unknown results store `{store}`, must be {valid_stores}.')
+
+
+def appended_cases(store: str, path: Union[str, Path]) -> Set[str]:
+    """
+    Case ids with rows in an appended export: `case_id` column of csv, or results store (`sqlite`, `parquet`). Empty if
+    not existing, None if cases can not be identified (csv without `case_id` column).
+    """
+    if store != 'csv':
+        return open_store(store, path).case_ids()
+    path = Path(path)
+    if not path.exists():
+        return set()
+    if 'case_id' not in pd.read_csv(path, nrows=0).columns:
+        return None
+    return set(pd.read_csv(path, usecols=['case_id'], dtype=str)['case_id'])
+
+
+def write_csv(path: Union[str, Path], df: pd.DataFrame):
+    """Write csv atomically: temporary file, replaced when complete."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_name(f'.{path.name}.tmp')
+    df.to_csv(path_tmp, index=False)
+    os.replace(path_tmp, path)
+
+
+def append_csv(path: Union[str, Path], df: pd.DataFrame, case_id: str, interrupted: bool = False) -> bool:
+    """
+    Append rows of a case to csv in a single write, rows are not written partially. A new file is created with header
+    atomically, so concurrent processes can append to the same file.
+    If a previous attempt was interrupted, rows are only appended if not yet present (case_id column, or end of file).
+    Returns False if rows were already present.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # new file: header and rows, linked when complete (fails if created by other process meanwhile)
+    if not path.exists():
+        path_tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        try:
+            df.to_csv(path_tmp, index=False)
+            os.link(path_tmp, path)
+            return True
+        except FileExistsError:
+            pass
+        finally:
+            path_tmp.unlink(missing_ok=True)
+
+    # existing file: check rows of interrupted attempt, append rows
+    rows = df.to_csv(index=False, header=False).encode()
+    if interrupted:
+        if 'case_id' in df.columns:
+            present = (pd.read_csv(path, usecols=['case_id'], dtype=str)['case_id'] == str(case_id)).any()
+        else:
+            with open(path, 'rb') as f:
+                f.seek(max(f.seek(0, os.SEEK_END) - len(rows), 0))
+                present = f.read() == rows
+        if present:
+            return False
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        while rows:
+            rows = rows[os.write(fd, rows):]
+    finally:
+        os.close(fd)
+    return True
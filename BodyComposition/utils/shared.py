@@ -0,0 +1,48 @@
+from collections import namedtuple
+from multiprocessing import shared_memory
+from typing import Tuple
+import numpy as np
+import secrets
+import sys
+import os
+
+
+# handle of a volume in shared memory, picklable: segment name, array layout, and metadata of the NiftiDataContainer
+SharedVolume = namedtuple('SharedVolume', ['name', 'shape', 'dtype', 'path', 'affine', 'spacing', 'bbox', 'modified'])
+
+# prefix of segment names (/dev/shm/bc_{pid}_{token} on linux)
+PREFIX = 'bc_'
+
+
+def create_shared(array: np.ndarray) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """Create shared memory segment, copy array. Returns segment and array backed by it."""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1), name=f'{PREFIX}{os.getpid()}_{secrets.token_hex(6)}')
+    array_shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    array_shared[...] = array
+    return shm, array_shared
+
+
+def attach_shared(name: str, shape: Tuple[int, ...], dtype: str) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Attach to existing segment, zero-copy. The creating process is responsible for unlinking.
+    Before python 3.13, attaching registers the segment with the resource tracker, which is shared with the creating
+    process by spawned and forked children: the registration is kept (unregistering would drop the one of the owner).
+    """
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def release_shared(shm: shared_memory.SharedMemory, unlink: bool = False):
+    """Close mapping (if no views are left, otherwise closed when they are gone), unlink segment if owner."""
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
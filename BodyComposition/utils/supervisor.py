@@ -0,0 +1,205 @@
+from pathlib import Path
+from time import monotonic
+from typing import Dict, Any
+from psutil import Process, Error as PsutilError
+import multiprocessing
+import traceback
+import logging
+import atexit
+import signal
+import sys
+import os
+
+
+# worker process: builds the pipeline once, runs cases received from the supervisor until None or the connection is closed
+def _worker(conn, method: str, config: Dict[str, Any], timestamp: int, pipeline_definition, logging_settings: Dict[str, Any]):
+
+    # own process group, processes spawned by models (e.g. nnU-Net preprocessing) are killed with the worker
+    os.setpgrp()
+
+    # imported in worker only, spawned process
+    from BodyComposition.utils.logging import init_logging
+    from BodyComposition.pipeline_registry import pipeline_registry
+    from BodyComposition.pipeline import PipelineBuilder
+    if logging_settings:
+        init_logging(**logging_settings)
+
+    # build pipeline, definitions registered at runtime are not available in spawned process
+    try:
+        pipeline_registry[method] = pipeline_definition
+        config = {**config, 'run': {**config['run'], 'timeout': None}} # no nested supervisor
+        pipeline = PipelineBuilder(method=method, config=config, timestamp=timestamp)
+    except Exception as e:
+        conn.send(('error', (f'{e}', traceback.format_exc())))
+        return
+    conn.send(('ready', None))
+
+    # run cases, report current action
+    while True:
+        try:
+            memory = conn.recv()
+        except EOFError:
+            break
+        if memory is None:
+            break
+        try:
+            output = pipeline(memory, on_action=lambda name: conn.send(('action', name)))
+            conn.send(('done', (output, memory.get('tmp/timings', []))))
+        except Exception as e:
+            conn.send(('error', (f'{e}', traceback.format_exc())))
+    conn.close()
+
+
+class CaseSupervisor():
+    """
+    Runs cases of a pipeline in a supervised worker process with a deadline per case.
+    Principles:
+    - worker is spawned (safe for CUDA), builds the pipeline once and is reused for subsequent cases.
+    - the worker reports each action before it starts, so the running action is known if the deadline is exceeded.
+    - if the deadline is exceeded, the worker and all its child processes are killed (works for blocking C extensions,
+      e.g. torch or gzip). GPU memory is released with the process, shared memory segments mapped only by the killed
+      processes are removed. A new worker is started for the next case.
+    - timeouts do not rely on signals in the calling process, cases can be run from any thread.
+    """
+
+    def __init__(self, pipeline, timeout: float):
+        self.method = pipeline.method
+        self.config = pipeline.config
+        self.timestamp = pipeline.timestamp
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+
+    def __repr__(self):
+        return f'CaseSupervisor(method={self.method}, timeout={self.timeout})'
+
+    def _start(self):
+        """Start worker process, wait until pipeline is built (not limited by timeout)."""
+        from BodyComposition.pipeline_registry import pipeline_registry
+        from BodyComposition.utils.logging import logging_settings
+        conn, conn_worker = self.context.Pipe()
+        self.process = self.context.Process(target=_worker,
+                                            args=(conn_worker, self.method, self.config, self.timestamp,
+                                                  pipeline_registry.get(self.method), logging_settings()),
+                                            name='bodycomposition-worker')
+        self.process.start()
+        conn_worker.close()
+        self.conn = conn
+        atexit.register(self.close)
+        logging.info(f' supervisor: started worker process {self.process.pid}')
+        try:
+            kind, item = self.conn.recv()
+        except EOFError:
+            kind, item = 'error', (f'worker process exited ({self.process.exitcode})', '')
+        if kind != 'ready':
+            self.kill()
+            raise RuntimeError(f'worker process failed to build pipeline: {item[0]}\n{item[1]}')
+
+    def __call__(self, memory: Dict[str, Any]):
+        """
+        Run pipeline on memory of a case in worker process. Returns `tmp/return` of the case.
+        Sets `tmp/timings` (completed actions), and `tmp/timeout` (running action) before raising TimeoutError.
+        """
+        if self.process is None or not self.process.is_alive():
+            self._start()
+
+        # send case, track actions until result or deadline
+        timings = memory['tmp/timings'] = []
+        action, timer_action = None, monotonic()
+        deadline = monotonic() + self.timeout
+        try:
+            self.conn.send({key: value for key, value in memory.items() if key != 'tmp/timings'})
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    memory['tmp/timeout'] = action
+                    logging.error(f' supervisor: deadline of {self.timeout}s exceeded in action {action}, killing worker process')
+                    self.kill()
+                    raise TimeoutError(action)
+                try:
+                    kind, item = self.conn.recv()
+                except EOFError:
+                    exitcode = self.kill()
+                    raise RuntimeError(f'worker process died (exit code {exitcode}) in action {action}')
+                if kind == 'action':
+                    if action is not None:
+                        timings.append((action, monotonic() - timer_action))
+                    action, timer_action = item, monotonic()
+                elif kind == 'done':
+                    output, timings[:] = item
+                    return output
+                else:
+                    raise RuntimeError(f'{item[0]}\n{item[1]}')
+        except (KeyboardInterrupt, SystemExit):
+            self.kill()
+            raise
+
+    def kill(self):
+        """Kill worker and its child processes, remove shared memory segments mapped only by them. Returns exit code."""
+        if self.process is None:
+            return None
+
+        # collect processes and shared memory segments before killing
+        processes, segments = [], set()
+        try:
+            processes = [Process(self.process.pid)]
+            processes += processes[0].children(recursive=True)
+        except PsutilError:
+            pass
+        for process in processes:
+            try:
+                segments.update(m.path for m in process.memory_maps() if m.path.startswith('/dev/shm/'))
+            except PsutilError:
+                pass
+
+        # kill process group, and children that left the group
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        for process in processes[1:]:
+            try:
+                process.kill()
+            except PsutilError:
+                pass
+        self.process.join()
+        exitcode = self.process.exitcode
+        self.conn.close()
+        self.process, self.conn = None, None
+        atexit.unregister(self.close)
+
+        # remove shared memory segments not used by this process
+        try:
+            segments -= {m.path for m in Process().memory_maps()}
+        except PsutilError:
+            pass
+        for segment in segments:
+            try:
+                Path(segment).unlink()
+                logging.info(f' supervisor: removed shared memory {segment}')
+            except OSError:
+                pass
+
+        # cached gpu memory of this process, if any
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logging.info(f' supervisor: worker process killed (exit code {exitcode})')
+        return exitcode
+
+    def close(self, timeout: float = 30):
+        """Stop worker process after the current case, kill if not stopped within timeout."""
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+            return
+        self.conn.close()
+        self.process, self.conn = None, None
+        atexit.unregister(self.close)
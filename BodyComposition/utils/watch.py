@@ -0,0 +1,183 @@
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from time import time
+import statistics
+import logging
+import select
+import struct
+import ctypes
+import json
+import sys
+import os
+import re
+
+
+# inotify events: file written and closed, moved into directory, created or modified
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x8, 0x80, 0x100
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+class _Inotify():
+    """Minimal inotify watch of a single directory (linux, libc via ctypes)."""
+
+    def __init__(self, path: Path):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+
+    def read(self, timeout: float) -> List[str]:
+        """Names of files with events, waits up to timeout seconds."""
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        names, offset = [], 0
+        while offset < len(buffer):
+            _, _, _, length = _EVENT.unpack_from(buffer, offset)
+            offset += _EVENT.size
+            names.append(os.fsdecode(buffer[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher():
+    """
+    Watches a directory for new input files, returns files once they are completely written.
+    Principles:
+    - inotify (linux) wakes up on changes, polling (`poll` seconds) is used as fallback, e.g. on network filesystems.
+    - the directory is rescanned every `rescan` seconds, in case events were missed.
+    - debouncing: a file is ready when size and modification time did not change for `settle` seconds.
+    - a file is returned again if it is replaced (modification time changed).
+    - files present at start are returned as well.
+    """
+
+    def __init__(self, path: Union[str, Path], input_filter: str = None, settle: float = 2, poll: float = 1,
+                 rescan: float = 60, inotify: bool = True):
+        self.path = Path(path)
+        if not self.path.is_dir():
+            raise NotADirectoryError(f'Watch input must be a directory: {self.path}.')
+        self.filter = re.compile(input_filter) if input_filter else None
+        self.settle = settle
+        self.poll = poll
+        self.rescan = rescan
+        self.pending: Dict[str, Tuple] = {} # name -> (size, mtime, first seen, last change)
+        self.processed: Dict[str, float] = {} # name -> mtime when returned
+        self.inotify = None
+        if inotify and sys.platform.startswith('linux'):
+            try:
+                self.inotify = _Inotify(self.path)
+            except OSError as e:
+                logging.warning(f' watch: inotify not available ({e}), polling every {poll}s')
+        self._time_scan = 0
+        logging.info(f' watch: {self.path} ({"inotify" if self.inotify else "polling"}, settle {settle}s)')
+
+    def __len__(self):
+        """Files detected, not yet ready (being written)."""
+        return len(self.pending)
+
+    def _update(self, name: str, now: float):
+        """Track file: new or changed size / modification time restarts debouncing."""
+        if name.startswith('.') or (self.filter and not self.filter.match(name)):
+            return
+        try:
+            stat = os.stat(self.path/name)
+        except FileNotFoundError:
+            self.pending.pop(name, None)
+            return
+        if self.processed.get(name) == stat.st_mtime:
+            return
+        size, mtime, first_seen, last_change = self.pending.get(name, (None, None, now, now))
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            last_change = now
+        self.pending[name] = (stat.st_size, stat.st_mtime, first_seen, last_change)
+
+    def wait(self, timeout: float = None) -> List[Tuple[Path, float]]:
+        """Wait for files to be ready (at most timeout seconds). Returns list of (path, time first seen)."""
+        time_end = None if timeout is None else time() + timeout
+        while True:
+            now = time()
+
+            # events since last call
+            if self.inotify is not None:
+                for name in self.inotify.read(0):
+                    self._update(name, now)
+
+            # full scan: at start, periodically, or when polling
+            if self.inotify is None or now - self._time_scan >= self.rescan:
+                with os.scandir(self.path) as entries:
+                    names = [entry.name for entry in entries if entry.is_file()]
+                for name in names:
+                    self._update(name, now)
+                self._time_scan = now
+
+            # check debounced files: restat, ready if unchanged for settle seconds
+            ready = []
+            for name in list(self.pending):
+                self._update(name, now)
+                if name in self.pending and now - self.pending[name][3] >= self.settle:
+                    size, mtime, first_seen, _ = self.pending.pop(name)
+                    self.processed[name] = mtime
+                    ready.append((self.path/name, first_seen))
+            if ready:
+                return sorted(ready, key=lambda item: item[1])
+
+            # wait for events (or next debounce check / poll)
+            delay = self.poll if not self.pending else min(self.poll, self.settle / 4)
+            if time_end is not None:
+                delay = min(delay, time_end - time())
+                if delay <= 0:
+                    return []
+            if self.inotify is not None:
+                for name in self.inotify.read(delay):
+                    self._update(name, time())
+            else:
+                select.select([], [], [], delay)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class WatchStatus():
+    """Queue depth and latency (file arrival to result) of watch mode, logged and optionally written as json."""
+
+    def __init__(self, path: Union[str, Path] = None, window: int = 100):
+        self.path = None if str(path) in ('None', '') else Path(path)
+        self.window = window
+        self.latencies = []
+        self.n_processed = 0
+        self.n_failed = 0
+
+    def update(self, caseid: str, success: bool, latency: float, queue_depth: int):
+        self.n_processed += 1
+        self.n_failed += not success
+        self.latencies = (self.latencies + [latency])[-self.window:]
+        status = {
+            'updated': time(),
+            'last_case': caseid,
+            'queue_depth': queue_depth,
+            'processed': self.n_processed,
+            'failed': self.n_failed,
+            'latency_last_s': round(latency, 2),
+            'latency_median_s': round(statistics.median(self.latencies), 2),
+            'latency_max_s': round(max(self.latencies), 2),
+        }
+        logging.info(f' watch: {caseid} latency {latency:.1f}s, queue depth {queue_depth}, '
+                     f'{self.n_processed} processed ({self.n_failed} failed)')
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            path_tmp = self.path.with_name(f'.{self.path.name}.tmp')
+            path_tmp.write_text(json.dumps(status, indent=2))
+            os.replace(path_tmp, self.path)
+        return status
@@ -0,0 +1,178 @@
+from pathlib import Path
+from typing import Iterator, Tuple, Union
+from time import time, sleep
+import threading
+import hashlib
+import logging
+import random
+import socket
+import json
+import os
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parse shard `i/n` (0 <= i < n)."""
+    try:
+        index, count = (int(value) for value in str(shard).split('/'))
+    except ValueError:
+        raise ValueError(f'Shard must be given as `i/n`, got `{shard}`.')
+    if not 0 <= index < count:
+        raise ValueError(f'Shard index must be in [0, {count}), got {index}.')
+    return index, count
+
+
+def shard_of(caseid: str, count: int) -> int:
+    """Deterministic shard of case id, identical on all nodes (independent of PYTHONHASHSEED)."""
+    return int.from_bytes(hashlib.sha1(caseid.encode()).digest()[:8], 'big') % count
+
+
+class WorkQueue():
+    """
+    Lock-free, file-based queue of cases in a shared directory, for multiple nodes or processes.
+    Principles:
+    - each case is a file in exactly one of `pending/`, `leased/`, `done/`, `failed/`, moved by atomic rename.
+    - a node claims a case by renaming `pending/{caseid}` to `leased/{caseid}@{node}`, only one rename succeeds.
+    - leases are renewed (mtime) while the case is processed. Leases not renewed within `lease` seconds (node died)
+      are moved back to `pending/` by any node and processed again.
+    - nodes can join or leave at any time, cases are added only if not yet in the queue.
+    """
+
+    states = ['pending', 'leased', 'done', 'failed']
+
+    def __init__(self, path: Union[str, Path], lease: float = 600, poll: float = 10, node: str = None):
+        self.path = Path(path)
+        self.lease = lease
+        self.poll = min(poll, lease / 4)
+        self.node = node or f'{socket.gethostname()}-{os.getpid()}'
+        self.held = {} # caseid -> lease file
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        for state in self.states:
+            (self.path/state).mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f'WorkQueue(path={self.path}, node={self.node})'
+
+    def __len__(self):
+        return len(self._listing('pending')) + len(self.held)
+
+    def _listing(self, state: str):
+        return [name for name in os.listdir(self.path/state) if not name.startswith('.')]
+
+    def _queued(self):
+        """Case ids in any state (listed in order of the lifecycle, a case moving meanwhile is found in the next state)."""
+        caseids = set()
+        for state in self.states:
+            caseids.update(name.rpartition('@')[0] or name for name in self._listing(state))
+        return caseids
+
+    def add(self, cases) -> int:
+        """Add cases (caseid, input_file, workspace) that are not yet queued. Returns number of added cases."""
+        queued = self._queued()
+        n_added = 0
+        for caseid, input_file, workspace in cases:
+            if caseid in queued:
+                continue
+            path_case = self.path/'pending'/caseid
+            try:
+                # exclusive create, entry is written completely before it becomes visible
+                path_tmp = self.path/'pending'/f'.{caseid}.{self.node}.tmp'
+                path_tmp.write_text(json.dumps([caseid, str(input_file), str(workspace)]))
+                os.link(path_tmp, path_case)
+                n_added += 1
+            except FileExistsError:
+                pass
+            finally:
+                path_tmp.unlink(missing_ok=True)
+        logging.info(f' queue: added {n_added} case(s) to {self.path}, {len(self._listing("pending"))} pending')
+        return n_added
+
+    def requeue_expired(self) -> int:
+        """Move leases that were not renewed within `lease` seconds back to pending."""
+        n_requeued = 0
+        for name in self._listing('leased'):
+            path_lease = self.path/'leased'/name
+            try:
+                if time() - path_lease.stat().st_mtime < self.lease:
+                    continue
+                os.rename(path_lease, self.path/'pending'/name.rpartition('@')[0])
+                n_requeued += 1
+                logging.warning(f' queue: lease {name} expired, case requeued')
+            except FileNotFoundError:
+                pass # renewed, completed or requeued by other node
+        return n_requeued
+
+    def claim(self, candidates=None):
+        """Claim a pending case. Returns (caseid, input_file, workspace), or None if no case could be claimed."""
+        candidates = self._listing('pending') if candidates is None else candidates
+        while candidates:
+            caseid = candidates.pop()
+            path_lease = self.path/'leased'/f'{caseid}@{self.node}'
+            try:
+                os.utime(self.path/'pending'/caseid) # lease starts now, mtime is kept by rename
+                os.rename(self.path/'pending'/caseid, path_lease)
+            except FileNotFoundError:
+                continue # claimed by other node
+            with self._lock:
+                self.held[caseid] = path_lease
+            caseid, input_file, workspace = json.loads(path_lease.read_text())
+            return caseid, Path(input_file), Path(workspace)
+        return None
+
+    def complete(self, caseid: str, success: bool = True):
+        """Move claimed case to done (or failed)."""
+        with self._lock:
+            path_lease = self.held.pop(caseid)
+        try:
+            os.rename(path_lease, self.path/('done' if success else 'failed')/caseid)
+        except FileNotFoundError:
+            logging.warning(f' queue: lease of {caseid} was lost (expired), case may be processed again by another node')
+
+    def release(self, caseid: str):
+        """Move claimed case back to pending, e.g. if processing was interrupted."""
+        with self._lock:
+            path_lease = self.held.pop(caseid)
+        try:
+            os.rename(path_lease, self.path/'pending'/caseid)
+        except FileNotFoundError:
+            pass
+
+    def _renew(self):
+        while not self._stop.wait(self.lease / 4):
+            with self._lock:
+                held = list(self.held.items())
+            for caseid, path_lease in held:
+                try:
+                    os.utime(path_lease)
+                except FileNotFoundError:
+                    logging.warning(f' queue: lease of {caseid} was lost (expired)')
+
+    def __iter__(self) -> Iterator[Tuple[str, Path, Path]]:
+        """
+        Claim and yield cases until the queue is drained: no pending cases, and no leases of other nodes left that
+        might expire. Yielded cases are completed by the consumer (`complete`), otherwise released when stopped.
+        """
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew, name='bodycomposition-lease', daemon=True)
+        self._heartbeat.start()
+        rng = random.Random(self.node) # different order per node, less contention
+        try:
+            candidates = []
+            while True:
+                if not candidates:
+                    self.requeue_expired()
+                    candidates = self._listing('pending')
+                    rng.shuffle(candidates)
+                case = self.claim(candidates)
+                if case is not None:
+                    yield case
+                    continue
+                if not self._listing('leased'):
+                    break
+                sleep(self.poll) # wait for leases of other nodes: completed or expired
+        finally:
+            self._stop.set()
+            self._heartbeat.join()
+            for caseid in list(self.held):
+                self.release(caseid)
@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List
+from nibabel import Nifti1Image
+from BodyComposition.utils.codecs import NiftiCodec, nifti_suffix
+import threading
+import logging
+import os
+
+
+_DEFAULT_CODEC = NiftiCodec()
+
+
+def save_atomic(image: Nifti1Image, path: Path, codec: NiftiCodec = None):
+    """Save nibabel image to temporary file in target directory, then rename: file is complete or not available."""
+    path = Path(path)
+    suffix = nifti_suffix(path) # format chosen by codec from suffix
+    path_tmp = path.with_name(f'.{path.name}.{os.getpid()}-{threading.get_ident()}.tmp{suffix}')
+    try:
+        (codec or _DEFAULT_CODEC).save(image, path_tmp)
+        os.replace(path_tmp, path)
+    except BaseException:
+        path_tmp.unlink(missing_ok=True)
+        raise
+
+
+class BackgroundWriter():
+    """
+    Saves nifti files in background threads (gzip compression releases the GIL), the pipeline continues meanwhile.
+    Principles:
+    - images are snapshots of the data at submission, later changes of the containers are not written.
+    - at most `max_pending` saves are queued or running, submission blocks if exceeded (bounds memory of snapshots).
+    - files are saved atomically (`save_atomic`), skip checks and other processes never see partially written files.
+    - saves of the same path are written in order of submission.
+    - errors are collected and raised by `flush`, at the end of each case.
+    - files are compressed by `codec` (NiftiCodec). Without workers, files are saved synchronously by `submit`.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 4, codec: NiftiCodec = None):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bodycomposition-writer') if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.pending: Dict[Path, List[object]] = {} # path -> futures of submitted saves, in order
+        self.codec = codec or _DEFAULT_CODEC
+
+    def __repr__(self):
+        return f'BackgroundWriter(workers={self.workers}, codec={self.codec})'
+
+    @property
+    def background(self) -> bool:
+        """Saves run in background: submitted images must not be changed afterwards (snapshots)."""
+        return self.executor is not None
+
+    def submit(self, image: Nifti1Image, path: Path):
+        """Queue save of image, blocks while `max_pending` saves are pending. Saved synchronously without workers."""
+        if self.executor is None:
+            save_atomic(image, path, self.codec)
+            return
+        previous = self.pending.setdefault(path, [])
+        if previous:
+            wait(previous[-1:]) # same path: keep order
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(save_atomic, image, path, self.codec)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        previous.append(future) # earlier saves are kept, their errors are raised by flush
+
+    def flush(self, raise_errors: bool = True):
+        """Wait for all pending saves. Raises error naming the files that could not be saved."""
+        pending, self.pending = self.pending, {}
+        wait([future for futures in pending.values() for future in futures])
+        errors = [(path, future.exception()) for path, futures in pending.items() for future in futures if future.exception() is not None]
+        for path, error in errors:
+            logging.error(f' writer: saving {path} failed: {error}')
+        if errors and raise_errors:
+            raise RuntimeError(f'Saving failed: ' + ', '.join(f'{path} ({error})' for path, error in errors)) from errors[0][1]
+
+    def close(self):
+        self.flush(raise_errors=False)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.codec is not _DEFAULT_CODEC:
+            self.codec.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import json
+import logging
+import sys
+import tempfile
+from pathlib import Path
+from BodyComposition.pipeline import PipelineBuilder
+from BodyComposition.utils.config import update_config
+from BodyComposition.utils.nifti import NiftiDataContainer
+from phantoms import make_phantom, parse_size
+from phantom_pipeline import register
+
+# config: defaults, recompute everything, profile all actions
+path_config = Path(__file__).resolve().parents[1] / 'config'
+config_benchmark = {
+    'run': {'skip': False, 'reset': False},
+    'cache': {'path': None},
+    'segmentation': {'save_label': False},
+    'vertebrae': {'save_mask': False},
+    'tissue': {'save_mask': False},
+    'profiling': {'active': True, 'file': 'logs/profile.jsonl'},
+}
+
+
+def load_config(config: dict = None):
+    config_dict = update_config({}, path_config / 'config.yaml')
+    config_dict = update_config(config_dict, path_config / 'labels.yaml')
+    config_dict = update_config(config_dict, config_benchmark)
+    if config is not None:
+        config_dict = update_config(config_dict, config)
+    return config_dict
+
+
+def run_phantom(pipeline, phantom, workspace: Path):
+    """Run pipeline on phantom, return profile records."""
+    memory = {'id': 'phantom',
+              'workspace': workspace,
+              'phantom': phantom,
+              'tmp/index': NiftiDataContainer(workspace/'images/phantom.nii.gz')}
+    memory['tmp/index'].data_nib = phantom['image']
+    pipeline(memory)
+    return memory['tmp/profile']
+
+
+def benchmark(method: str, sizes: list, spacing: tuple, orientation: str, repeats: int, config: dict = None):
+    """Returns {size: {action: {'wall_s', 'peak_mb'}}}, best wall time and max peak memory over repeats."""
+    register()
+    pipeline = PipelineBuilder(method=method, config=load_config(config), timestamp=0)
+    results = {}
+    for size in sizes:
+        phantom = make_phantom(parse_size(size), spacing, orientation)
+        results[size] = {}
+        for _ in range(repeats):
+            with tempfile.TemporaryDirectory(prefix='bench_actions_') as tmp:
+                for record in run_phantom(pipeline, phantom, Path(tmp)):
+                    name = f"{record['index']:02d} {record['action']}" + (f"/{record['task']}" if record['task'] else '')
+                    best = results[size].setdefault(name, {'wall_s': float('inf'), 'peak_mb': 0.0})
+                    best['wall_s'] = min(best['wall_s'], record['wall_s'])
+                    best['peak_mb'] = max(best['peak_mb'], record['peak_rss_delta_mb'])
+        results[size]['total'] = {'wall_s': round(sum(r['wall_s'] for r in results[size].values()), 4),
+                                  'peak_mb': max(r['peak_mb'] for r in results[size].values())}
+    return results
+
+
+def print_results(results: dict):
+    sizes = list(results)
+    actions = list(results[sizes[0]])
+    width = max(len(action) for action in actions) + 2
+    print('action'.ljust(width) + ''.join(f'{size:>26}' for size in sizes))
+    print(''.ljust(width) + ''.join(f'{"wall [s]":>14}{"peak [MB]":>12}' for _ in sizes))
+    for action in actions:
+        print(action.ljust(width) + ''.join(f"{results[size][action]['wall_s']:>14.3f}{results[size][action]['peak_mb']:>12.1f}" for size in sizes))
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_wall: float = 0.05, min_peak: float = 10.0):
+    """Return list of regressions compared to baseline: relative increase > tolerance, ignoring small absolute values."""
+    regressions = []
+    for size, actions in results.items():
+        for action, values in actions.items():
+            reference = baseline.get(size, {}).get(action)
+            if reference is None:
+                continue
+            if values['wall_s'] > max(reference['wall_s'] * (1 + tolerance), min_wall):
+                regressions.append(f"{size} {action}: wall {reference['wall_s']:.3f}s -> {values['wall_s']:.3f}s")
+            if values['peak_mb'] > max(reference['peak_mb'] * (1 + tolerance), min_peak):
+                regressions.append(f"{size} {action}: peak {reference['peak_mb']:.1f}MB -> {values['peak_mb']:.1f}MB")
+    return regressions
+
+
+def main():
+    """
+    Benchmark the non-ML actions on synthetic CT phantoms, segmentations are replaced by stub actions.
+    Usage: PYTHONPATH=. python benchmarks/bench_actions.py -m PhantomBodyCompositionFast -s 256x256x100 512x512x200 -o results.json
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark non-ML actions on synthetic CT phantoms.')
+    parser.add_argument('--method', '-m', type=str, default='PhantomBodyComposition',
+                        choices=['PhantomBodyComposition', 'PhantomBodyCompositionFast'], help='Phantom pipeline to be run.')
+    parser.add_argument('--sizes', '-s', type=str, nargs='+', default=['256x256x100', '512x512x200'],
+                        help='Volume sizes (voxels), e.g. 512x512x200.')
+    parser.add_argument('--spacing', type=float, nargs=3, default=[0.8, 0.8, 3.0], help='Voxel spacing in mm.')
+    parser.add_argument('--orientation', type=str, default='RAS', choices=['RAS', 'LPS'], help='Orientation of phantom.')
+    parser.add_argument('--repeats', '-r', type=int, default=3, help='Repetitions per size, best wall time is reported.')
+    parser.add_argument('--config', '-c', type=str, default=None, help='Dictionary updating the benchmark configuration.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Save results as json, e.g. as baseline.')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline json, exit with error if regressions are found.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative tolerance for regressions.')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    # run benchmark, print
+    results = benchmark(args.method, args.sizes, tuple(args.spacing), args.orientation, args.repeats,
+                        config=None if args.config is None else json.loads(args.config))
+    print_results(results)
+
+    # save results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    # compare to baseline
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
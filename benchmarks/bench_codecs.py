@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import statistics
+import tempfile
+from pathlib import Path
+from time import perf_counter
+import nibabel as nib
+import numpy as np
+from BodyComposition.utils.codecs import NiftiCodec
+from phantoms import make_phantom, parse_size
+
+
+def parse_codec(definition: str):
+    """Codec definition `<format>:<level>:<threads>`, e.g. gzip:1:0, gzip:6:4, zstd:3:0, raw."""
+    format, level, threads = (definition.split(':') + ['1', '0'])[:3]
+    if format == 'zstd':
+        return '.nii.zst', NiftiCodec(threads=int(threads), zstd_level=int(level))
+    return {'gzip': '.nii.gz', 'raw': '.nii'}[format], NiftiCodec(level=int(level), threads=int(threads))
+
+
+def main():
+    """
+    Benchmark of nifti codecs: write and read throughput (MB/s of uncompressed data) and compressed size, for a label
+    volume (uint8) and a CT volume (int16) of the phantom. Reading includes decompression of all voxels.
+    Codecs that are not available (zstd: requires zstandard) are skipped.
+    Run from the repository root.
+    Usage: PYTHONPATH=. python benchmarks/bench_codecs.py -s 512x512x400 -c gzip:1:0,gzip:6:0,gzip:1:4,zstd:3:0
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark write/read throughput and size of nifti codecs.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x400', help='Volume size (voxels) of the phantom.')
+    parser.add_argument('--codecs', '-c', type=str, default='raw,gzip:1:0,gzip:6:0,gzip:1:2,gzip:1:4,zstd:3:0,zstd:3:4',
+                        help='Codecs <format>:<level>:<threads>, comma separated.')
+    parser.add_argument('--repeats', '-n', type=int, default=3, help='Repeats per codec and volume (median is reported).')
+    args = parser.parse_args()
+
+    # fortran order, as volumes loaded by nibabel (C order: transposed while writing, which dominates the write time)
+    phantom = make_phantom(parse_size(args.size))
+    volumes = {'label (uint8)': nib.Nifti1Image(np.asfortranarray(phantom['tissue'].dataobj, dtype=np.uint8), phantom['tissue'].affine),
+               'CT (int16)': nib.Nifti1Image(np.asfortranarray(phantom['image'].dataobj, dtype=np.int16), phantom['image'].affine)}
+
+    with tempfile.TemporaryDirectory(prefix='bench_codecs_') as tmp:
+        for name, image in volumes.items():
+            data = np.asanyarray(image.dataobj)
+            nbytes = data.nbytes / 1024**2
+            print(f'{name}, {args.size}, {nbytes:.0f} MB')
+            print(f' {"codec":<12}{"write [MB/s]":>14}{"read [MB/s]":>14}{"size [MB]":>12}{"ratio":>8}')
+            for definition in args.codecs.split(','):
+                suffix, codec = parse_codec(definition)
+                path = Path(tmp, f'volume{suffix}')
+                time_write, time_read = [], []
+                try:
+                    for _ in range(args.repeats):
+                        time_start = perf_counter()
+                        codec.save(image, path)
+                        time_write.append(perf_counter() - time_start)
+                        time_start = perf_counter()
+                        loaded = np.asanyarray(codec.load(path).dataobj)
+                        time_read.append(perf_counter() - time_start)
+                        assert np.array_equal(loaded, data), f'{definition}: data changed'
+                except ImportError as e:
+                    print(f' {definition:<12} skipped: {e}')
+                    continue
+                finally:
+                    codec.close()
+                size = path.stat().st_size / 1024**2
+                print(f' {definition:<12}{nbytes / statistics.median(time_write):>14.0f}{nbytes / statistics.median(time_read):>14.0f}'
+                      f'{size:>12.1f}{nbytes / size:>8.1f}')
+
+if __name__ == "__main__":
+    main()
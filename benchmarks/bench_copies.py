@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+import nibabel as nib
+import numpy as np
+from BodyComposition.utils.nifti import NiftiDataContainer
+from phantoms import make_phantom, parse_size
+
+
+def traced(function) -> int:
+    """Peak of memory allocated (bytes) while running function, numpy allocations are traced."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    """
+    Allocation audit of NiftiDataContainer: bytes allocated by each operation, as multiple of the volume size
+    (uint8 label volume). Exits with error if an operation allocates more than its budget.
+    Run from the repository root.
+    Usage: PYTHONPATH=. python benchmarks/bench_copies.py -s 512x512x400
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Allocation audit of NiftiDataContainer operations.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x400', help='Volume size (voxels) of the phantom.')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='Allowed allocation above budget (multiple of volume size).')
+    args = parser.parse_args()
+
+    phantom = make_phantom(parse_size(args.size), orientation='LPS')
+    label = phantom['tissue']
+    with tempfile.TemporaryDirectory(prefix='bench_copies_') as tmp:
+        path = Path(tmp, 'labels/label.nii')
+        path.parent.mkdir()
+        data = np.asanyarray(label.dataobj).astype(np.uint8) % 20
+        nib.save(nib.Nifti1Image(data, label.affine), path)
+        nbytes = data.nbytes
+        bbox = [s // 4 for s in data.shape for _ in range(2)]
+        bbox[1::2] = [3 * s // 4 for s in data.shape]
+
+        # operations: (name, setup, operation, budget as multiple of volume size)
+        c = {}
+        def setup_loaded():
+            c['label'] = NiftiDataContainer(path)
+            c['label'].load_from_file()
+            c['value'] = data.copy()
+        chunk = 2**22 / nbytes # remap: temporary memory of one slab
+        operations = [
+            ('load_from_file (uint8 .nii)', lambda: None, lambda: NiftiDataContainer(path).load_from_file(), 1),
+            ('data_np getter', setup_loaded, lambda: c['label'].data_np, 0),
+            ('data_np setter (copy)', setup_loaded, lambda: setattr(c['label'], 'data_np', data), 1),
+            ('set_data (copy=False)', setup_loaded, lambda: c['label'].set_data(c.pop('value'), copy=False), 0),
+            ('remap (lookup table)', setup_loaded, lambda: c['label'].remap({i: i % 7 for i in range(20)}), round(chunk, 2)),
+            ('derive (copy-on-write)', setup_loaded, lambda: c.update(derived=c['label'].derive(Path(tmp, 'labels/derived.nii'))), 0),
+            ('derive + bbox', setup_loaded, lambda: setattr(c['label'].derive(Path(tmp, 'labels/derived.nii')), 'bbox', bbox), 0),
+            ('as_closest_canonical', setup_loaded, lambda: c['label'].as_closest_canonical(), 0),
+        ]
+
+        print(f'{args.size} uint8, {nbytes / 1024**2:.0f} MB')
+        failed = []
+        for name, setup, operation, budget in operations:
+            setup()
+            allocated = traced(operation) / nbytes
+            status = 'ok' if allocated <= budget + args.tolerance else 'OVER BUDGET'
+            if status != 'ok':
+                failed.append(name)
+            print(f' {name:<30} {allocated:6.2f}x (budget {budget}x) {status}')
+
+        # copy-on-write: derived containers are independent after writing
+        setup_loaded()
+        derived = c['label'].derive(Path(tmp, 'labels/derived.nii'))
+        derived.remap({1: 2})
+        assert np.array_equal(c['label'].data_np, data), 'copy-on-write: source changed by derived container'
+        c['label'].data_np = np.zeros_like(data)
+        assert derived.data_np.any(), 'copy-on-write: derived container changed by source'
+
+    if failed:
+        print(f'over budget: {", ".join(failed)}')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import logging
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from BodyComposition.utils.datalist import DatalistBuilder
+
+# io definition of BodyCompositionFast, w/ labels and masks saved
+io_inputs = []
+io_outputs = ['labels/{caseid}_int-vertebrae.nii.gz',
+              'labels/{caseid}_tseg-tissue.nii.gz',
+              'masks/{caseid}_tseg-tissue.nii.gz',
+              'exports/{caseid}_bc_raw.csv']
+
+
+# synthetic workspace: empty images, outputs for a fraction of the cases
+def create_tree(root: Path, n_cases: int, completed: float):
+    for subdir in ['images'] + sorted({str(Path(io).parent) for io in io_outputs}):
+        (root/subdir).mkdir(parents=True, exist_ok=True)
+    for i in range(n_cases):
+        caseid = f'ct_{i:06d}'
+        (root/'images'/f'{caseid}.nii.gz').touch()
+        if i < n_cases * completed:
+            for io_output in io_outputs:
+                (root/io_output.format(caseid=caseid)).touch()
+
+
+# sequential scan as used before: is_file() per entry, exists() per case and requirement
+def legacy_scan(input_path: Path, workspace: Path):
+    case_paths = [file for file in input_path.iterdir() if file.is_file() and not file.name.startswith('.')]
+    cases = [(file.name.split('.')[0], file, workspace) for file in case_paths]
+    cases = [case for case in cases if all((case[2]/io.format(caseid=case[0])).exists() for io in io_inputs)]
+    completed = {case[0] for case in cases if all((case[2]/io.format(caseid=case[0])).exists() for io in io_outputs)}
+    return [case for case in cases if case[0] not in completed]
+
+
+def main():
+    """
+    Benchmark datalist construction (listing, requirement checks, skip of completed cases) on a synthetic directory tree.
+    Usage: PYTHONPATH=. python benchmarks/bench_datalist.py --cases 100000 --workers 8
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark datalist construction on a synthetic directory tree.')
+    parser.add_argument('--cases', '-n', type=int, default=100000, help='Number of synthetic cases.')
+    parser.add_argument('--completed', type=float, default=0.5, help='Fraction of cases with all outputs available.')
+    parser.add_argument('--workers', '-w', type=int, default=8, help='Threads used by the scanner.')
+    parser.add_argument('--root', type=str, default=None, help='Directory for the synthetic tree, e.g. on a network filesystem. Default: temporary directory.')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix='bench_datalist_', dir=args.root) as tmp:
+        root = Path(tmp)
+        time_start = perf_counter()
+        create_tree(root, args.cases, args.completed)
+        print(f'created tree: {args.cases} cases in {root} ({perf_counter()-time_start:.1f}s)')
+
+        # legacy, sequential
+        time_start = perf_counter()
+        cases_legacy = legacy_scan(root/'images', root)
+        print(f'legacy scan:           {len(cases_legacy)} cases ({perf_counter()-time_start:.2f}s)')
+
+        # directory index, sequential and threaded
+        for workers in sorted({0, args.workers}):
+            time_start = perf_counter()
+            datalist = DatalistBuilder(input_path=root/'images', input_filter=r'.*\.nii\.gz$', workspace=root,
+                                       io_inputs=io_inputs, io_outputs=io_outputs, scan_workers=workers)
+            datalist.skip_completed()
+            print(f'index scan, workers={workers}: {len(datalist)} cases ({perf_counter()-time_start:.2f}s)')
+
+            if sorted(datalist.cases) != sorted(cases_legacy):
+                raise AssertionError('datalists differ between legacy and index scan')
+
+if __name__ == "__main__":
+    main()
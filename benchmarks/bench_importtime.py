@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import subprocess
+import sys
+
+# entry points: module, startup budget (ms, cumulative import time)
+entry_points = {
+    'BodyComposition.bin.run_batch': 250,
+    'BodyComposition.pipeline': 1500,
+    'BodyComposition.python_api': 1500,
+}
+
+# heavy libraries, only to be imported when a pipeline is built
+deferred = ['torch', 'nnunet', 'nnunetv2', 'totalsegmentator']
+
+
+def import_time(module: str):
+    """Cumulative import time (ms) of module in a fresh interpreter (`python -X importtime`), and deferred libraries loaded."""
+    code = f'import sys, {module}; print(",".join(m for m in {deferred!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import of {module} failed:\n{result.stderr[-2000:]}')
+    cumulative = None
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, time_cumulative, name = line.split('|')
+        if not time_cumulative.strip().isdigit():
+            continue # header
+        imports.append((int(time_cumulative) / 1000, name.rstrip()))
+        if name.strip() == module:
+            cumulative = int(time_cumulative) / 1000
+    loaded = [m for m in result.stdout.strip().split(',') if m]
+    return cumulative, loaded, imports
+
+
+def main():
+    """
+    Guard the startup budget of the CLI and API entry points, based on `python -X importtime`.
+    Exits with error if an entry point exceeds its budget or imports torch/nnU-Net/TotalSegmentator at import.
+    Usage: PYTHONPATH=. python benchmarks/bench_importtime.py --repeats 5 --top 10
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Import-time benchmark of entry points.')
+    parser.add_argument('--repeats', '-r', type=int, default=3, help='Repetitions, minimum is reported.')
+    parser.add_argument('--top', type=int, default=0, help='Show heaviest imports of each entry point.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale budgets, e.g. for slow machines.')
+    args = parser.parse_args()
+
+    failures = []
+    for module, budget in entry_points.items():
+        runs = [import_time(module) for _ in range(args.repeats)]
+        cumulative, loaded, imports = min(runs, key=lambda run: run[0])
+        status = 'ok'
+        if cumulative > budget * args.scale:
+            status = 'OVER BUDGET'
+            failures.append(f'{module}: {cumulative:.0f}ms > {budget * args.scale:.0f}ms')
+        if loaded:
+            status = 'DEFERRED IMPORTED'
+            failures.append(f'{module}: imports {loaded}')
+        print(f'{module:<50} {cumulative:8.0f}ms  (budget {budget * args.scale:.0f}ms)  {status}')
+        for time_cumulative, name in sorted(imports, reverse=True)[1:args.top + 1]:
+            print(f'    {time_cumulative:8.0f}ms {name.strip()}')
+
+    if failures:
+        print('\n'.join(['FAILED:'] + failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
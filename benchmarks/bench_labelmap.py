@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+from time import perf_counter
+import numpy as np
+from BodyComposition.utils.labelmap import CompactLabelMap
+from phantoms import make_phantom, parse_size
+
+
+def main():
+    """
+    Compact label volumes (CompactLabelMap) of the phantom labels: memory compared to dense uint8 arrays, time to
+    compact and densify, and queries (voxels per slice and label, bounding box) compared to numpy on dense arrays.
+    Exits with error if results differ.
+    Run from the repository root.
+    Usage: PYTHONPATH=. python benchmarks/bench_labelmap.py -s 512x512x400
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark compact label volumes.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x400', help='Volume size (voxels) of the phantom.')
+    args = parser.parse_args()
+
+    phantom = make_phantom(parse_size(args.size))
+    print(f'{args.size} uint8')
+    print(f' {"label":<11}{"dense [MB]":>12}{"compact [MB]":>14}{"ratio":>8}{"compact [s]":>13}{"dense [s]":>11}'
+          f'{"counts numpy [s]":>18}{"counts compact [s]":>20}')
+    for name in ['vertebrae', 'tissue', 'bodytrunk']:
+        data = np.asanyarray(phantom[name].dataobj).astype(np.uint8)
+
+        time_start = perf_counter()
+        labelmap = CompactLabelMap.from_dense(data)
+        time_compact = perf_counter() - time_start
+        time_start = perf_counter()
+        dense = labelmap.to_dense()
+        time_dense = perf_counter() - time_start
+        assert np.array_equal(dense, data), f'{name}: dense volume differs'
+
+        # voxels per slice and label (as CalcCSA), bounding box of labels (as CreateBoundingBox)
+        time_start = perf_counter()
+        counts_numpy = np.stack([np.sum(data == label, axis=(0, 1)) for label in labelmap.labels], axis=1)
+        time_numpy = perf_counter() - time_start
+        time_start = perf_counter()
+        counts = CompactLabelMap.from_dense(data).slice_counts(axis=2) # without cached counts
+        time_counts = perf_counter() - time_start
+        assert np.array_equal(counts, counts_numpy), f'{name}: voxels per slice differ'
+        roi = np.isin(data, labelmap.labels[:2])
+        bbox = [int(f(np.where(np.any(roi, axis=tuple(i for i in range(3) if i != dim)))[0])) + offset
+                for dim in range(3) for f, offset in ((np.min, 0), (np.max, 1))]
+        assert labelmap.bbox(labelmap.labels[:2]) == bbox, f'{name}: bounding box differs'
+
+        print(f' {name:<11}{data.nbytes / 1024**2:>12.1f}{labelmap.nbytes / 1024**2:>14.2f}{data.nbytes / labelmap.nbytes:>8.0f}'
+              f'{time_compact:>13.2f}{time_dense:>11.2f}{time_numpy:>18.2f}{time_counts:>20.2f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import io
+import logging
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from BodyComposition.actions.data_postprocessing import DataCombine, DataSubset, DataAggregate, results_to_df
+from BodyComposition.utils.config import update_config
+
+# labels and metadata
+path_config = Path(__file__).resolve().parents[1] / 'config'
+metadata = {'pat_id': '123', 'pat_prefix': '', 'pat_suffix': '', 'pat_sex': 'F', 'pat_size': 1.7, 'pat_weight': None, 'scan_date': '20200101'}
+variants = {
+    'fast: subset L3, mean by Level': [('subset', dict(ref='Level', level=['L3'])), ('aggregate', dict(method='mean', ref='Level'))],
+    'subset L, median by Level': [('subset', dict(ref='Level', level='L')), ('aggregate', dict(method='median', ref='Level'))],
+    'subset ALL, sum by Center': [('subset', dict(ref='Level', level='ALL')), ('aggregate', dict(method='sum', ref='Center'))],
+    'tag L3/L4, mean by Level': [('aggregate', dict(method='mean', ref='Level', tag_mapping={'L3': 'L34', 'L4': 'L34'}))],
+    'mean, no group': [('aggregate', dict(method='mean'))],
+    'raw': [],
+}
+
+
+# synthetic results of CalcVertebralLevel and CalcCSA: stacked vertebrae (inferior -> superior), undefined slices in between
+def make_case(n_slices: int, n_tissue: int, rng):
+    vertebrae = np.zeros((n_slices, 4), dtype=np.uint16)
+    vertebrae[:, 0] = np.arange(n_slices)
+    z = 0
+    for label in [19, 17, 16, 15, 14, 13, 12, 11, 10, 9]:
+        length = int(rng.integers(8, 12))
+        vertebrae[z:z+length, 1] = label
+        vertebrae[z + length//2, 2] = label
+        vertebrae[z + length//2 + int(rng.integers(-1, 2)), 3] = label
+        z += length + int(rng.integers(0, 3))
+        if z >= n_slices:
+            break
+    tissue = rng.integers(0, 40000, size=(n_slices, n_tissue)).astype(np.uint32)
+    return {'tmp/vertebrae_values': vertebrae, 'tmp/tissue_values': tissue,
+            'tmp/vertebrae_meta': (np.eye(4), (512, 512, n_slices), (0.8, 0.8, 3.0)), 'tmp/tissue_meta': (np.eye(4), (512, 512, n_slices), (0.8, 0.8, 3.0))}
+
+
+# pandas implementation as used before (DataCombine, DataSubset, DataAggregate, DataExport w/ metadata)
+def legacy(memory, config, steps):
+    vertebrae_df = pd.DataFrame(memory['tmp/vertebrae_values'], columns=["Slice", "Level", "Center", "Centroid"])
+    vertebrae_df["Tag"] = None
+    tissue_df = pd.DataFrame(memory['tmp/tissue_values'], columns=["CSA_" + col for col in config['LBL_TISSUE'].values()]) / 100
+    df = pd.concat([vertebrae_df, tissue_df], axis=1).iloc[::-1].reset_index(drop=True)
+    for col in ['Level', 'Center', 'Centroid']:
+        df[col] = df[col].replace(config['LBL_VERTEBRALBODIES'])
+    for step, kwargs in steps:
+        if step == 'subset':
+            level = kwargs['level']
+            valid_levels = list(config['LBL_VERTEBRALBODIES'].values())
+            level = valid_levels if level == 'ALL' else [x for x in valid_levels if x.startswith('L')] if level == 'L' else level
+            df = df[df[kwargs['ref']].isin(level)]
+        elif step == 'aggregate':
+            for key, value in (kwargs.get('tag_mapping') or {}).items():
+                df.loc[df[kwargs['ref']] == key, 'Tag'] = value
+            def single_or_none(x):
+                return x.iloc[0] if x.nunique() == 1 else None
+            agg_dict = {col: single_or_none if col in ['Slice', 'Center', 'Level', 'Centroid', 'Tag'] else kwargs['method'] for col in df.columns}
+            df = df.agg(agg_dict).to_frame().T if not kwargs.get('ref') else df.groupby(kwargs['ref']).agg(agg_dict).reset_index(drop=True)
+            df = df.round(2)
+    n_rows = df.shape[0]
+    patients_df = pd.DataFrame({'case_id': ['case']*n_rows, 'case_timestamp': [0]*n_rows, **{key: [value]*n_rows for key, value in metadata.items()}})
+    return pd.concat([patients_df, df], axis=1)
+
+
+# numpy implementation: actions, pandas only at export
+def current(memory, actions, config):
+    for action in actions:
+        action(memory)
+    df = results_to_df(memory['tmp/bodycomposition'], config['LBL_VERTEBRALBODIES'])
+    patients_df = pd.DataFrame({'case_id': 'case', 'case_timestamp': 0, **metadata}, index=pd.RangeIndex(df.shape[0]))
+    return pd.concat([patients_df, df], axis=1)
+
+
+def to_csv(df):
+    buffer = io.StringIO()
+    df[sorted(df.columns)].to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def main():
+    """
+    Benchmark per-case overhead of combine -> subset -> aggregate -> dataframe for export, compared to the pandas implementation.
+    Usage: PYTHONPATH=. python benchmarks/bench_postprocessing.py --cases 200 --slices 300
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark postprocessing of results (combine, subset, aggregate).')
+    parser.add_argument('--cases', '-n', type=int, default=200, help='Number of synthetic cases.')
+    parser.add_argument('--slices', '-s', type=int, default=300, help='Number of slices per case.')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    config = update_config({}, path_config / 'labels.yaml')
+    pipeline = SimpleNamespace(config=config, timestamp=0)
+    rng = np.random.default_rng(0)
+    cases = [make_case(args.slices, len(config['LBL_TISSUE']), rng) for _ in range(args.cases)]
+
+    for name, steps in variants.items():
+        actions = [DataCombine(pipeline)]
+        actions += [DataSubset(pipeline, **kwargs) if step == 'subset' else DataAggregate(pipeline, **kwargs) for step, kwargs in steps]
+
+        # run both implementations, outputs must be identical
+        time_legacy = time_current = 0.0
+        for case in cases:
+            time_start = perf_counter()
+            df_legacy = legacy(dict(case), config, steps)
+            time_legacy += perf_counter() - time_start
+            time_start = perf_counter()
+            df_current = current(dict(case), actions, config)
+            time_current += perf_counter() - time_start
+            if to_csv(df_legacy) != to_csv(df_current):
+                raise AssertionError(f'{name}: exports differ\n{to_csv(df_legacy)}\nvs\n{to_csv(df_current)}')
+        print(f'{name:<34} pandas {1000*time_legacy/len(cases):6.2f}ms/case   numpy {1000*time_current/len(cases):6.2f}ms/case')
+
+if __name__ == "__main__":
+    main()
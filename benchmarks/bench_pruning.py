@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import logging
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from BodyComposition.pipeline import PipelineBuilder
+from bench_actions import load_config, run_phantom
+from phantom_pipeline import register
+from phantoms import make_phantom, parse_size
+
+# requested outputs per pipeline
+requested = {'PhantomBodyCompositionFast': ['exports/all_L3Mean.csv'],
+             'PhantomBodyComposition': ['exports/all.csv']}
+
+
+def run(method: str, phantom, outputs, config: dict, repeats: int):
+    """Run pipeline on phantom, returns best wall time, files written (name: bytes) and requested exports (name: content)."""
+    pipeline = PipelineBuilder(method=method, config=load_config(config), timestamp=0, outputs=outputs)
+    wall = float('inf')
+    try:
+        for _ in range(repeats):
+            with tempfile.TemporaryDirectory(prefix='bench_pruning_') as tmp:
+                time_start = perf_counter()
+                run_phantom(pipeline, phantom, Path(tmp))
+                wall = min(wall, perf_counter() - time_start)
+                files = {str(path.relative_to(tmp)): path.stat().st_size for path in sorted(Path(tmp).rglob('*'))
+                         if path.is_file() and not path.is_relative_to(Path(tmp, 'logs'))}
+                exports = {name: Path(tmp, name).read_text() for name in requested[method]}
+    finally:
+        pipeline.close()
+    return pipeline, wall, files, exports
+
+
+def main():
+    """
+    Output-driven pruning (`run/outputs`) of the phantom pipelines: actions, files written and wall time of the full
+    pipeline compared to the pipeline pruned to its final export (Fast: exports/all_L3Mean.csv), without and with the
+    restriction to the slices of exported levels (`run/target_levels`). Labels and masks are saved as configured by
+    default (`save_label`, `save_mask`). Exits with error if the requested exports differ.
+    Run from the repository root.
+    Usage: PYTHONPATH=. python benchmarks/bench_pruning.py -s 512x512x200
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark output-driven pruning of the phantom pipelines.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x200', help='Volume size (voxels) of the phantom.')
+    parser.add_argument('--methods', '-m', type=str, nargs='+', default=list(requested), choices=list(requested), help='Phantom pipelines.')
+    parser.add_argument('--repeats', '-r', type=int, default=3, help='Repetitions, best wall time is reported.')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    register()
+    config = {'segmentation': {'save_label': True}, 'vertebrae': {'save_mask': True}, 'tissue': {'save_mask': True}}
+    phantom = make_phantom(parse_size(args.size))
+    for method in args.methods:
+        print(f'{method}, {args.size}, requested: {requested[method]}')
+        print(f' {"outputs":<10}{"actions":>9}{"files":>7}{"written [MB]":>14}{"wall [s]":>10}')
+        reference = None
+        for name, outputs, target_levels in [('all', None, False), ('requested', requested[method], False),
+                                             ('+ levels', requested[method], True)]:
+            config_run = {**config, 'run': {'target_levels': target_levels}}
+            pipeline, wall, files, exports = run(method, phantom, outputs, config_run, args.repeats)
+            print(f' {name:<10}{len(pipeline.actions):>9}{len(files):>7}{sum(files.values()) / 1024**2:>14.2f}{wall:>10.2f}'
+                  f'{"  restricted to " + str(pipeline.levels) if pipeline.levels else ""}')
+            if reference is None:
+                reference = exports
+            elif exports != reference:
+                raise AssertionError(f'{method}: requested exports differ')
+        print(f' pruned actions: {pipeline.pruned["actions"]}')
+        print(f' pruned writes: {pipeline.pruned["writes"]}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import tracemalloc
+from pathlib import Path
+from BodyComposition.utils.nifti import NiftiDataContainer
+from phantoms import make_phantom, parse_size
+
+
+def case_memory(method: str, size: str, release: bool, compact: bool, queue):
+    """Runs one phantom case (spawned process), reports peak of traced allocations, resident volumes and max RSS."""
+    import sys
+    sys.path.insert(0, str(Path(__file__).parent)) # spawned: phantom pipelines
+    from bench_actions import load_config
+    from phantom_pipeline import register
+    from BodyComposition.pipeline import PipelineBuilder
+    register()
+    config = load_config({'run': {'release_memory': release, 'compact_labels': compact}, 'profiling': {'active': False}})
+    pipeline = PipelineBuilder(method=method, config=config, timestamp=0)
+    phantom = make_phantom(parse_size(size))
+
+    with tempfile.TemporaryDirectory(prefix='bench_release_') as tmp:
+        memory = {'id': 'phantom',
+                  'workspace': Path(tmp),
+                  'phantom': phantom,
+                  'tmp/index': NiftiDataContainer(Path(tmp, 'images/phantom.nii.gz'))}
+        memory['tmp/index'].data_nib = phantom['image']
+
+        # volumes held by memory before each action
+        resident = []
+        def on_action(name):
+            resident.append(sum(value.nbytes for value in memory.values() if isinstance(value, NiftiDataContainer)))
+
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        pipeline(memory, on_action=on_action)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    queue.put({'peak_mb': peak / 1024**2,
+               'resident_max_mb': max(resident) / 1024**2,
+               'resident_end_mb': sum(value.nbytes for value in memory.values() if isinstance(value, NiftiDataContainer)) / 1024**2,
+               'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+
+def main():
+    """
+    Peak memory per case with and without releasing volumes after their last use (`run.release_memory`), and holding
+    labels compactly (`run.compact_labels`).
+    Each mode runs in a fresh process: traced peak (numpy allocations), volumes held by the case memory, max RSS.
+    Run from the repository root (configs are loaded from ./config).
+    Usage: PYTHONPATH=. python benchmarks/bench_release.py -m PhantomBodyComposition -s 512x512x200
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark peak memory per case with release and compaction of volumes.')
+    parser.add_argument('--method', '-m', type=str, default='PhantomBodyComposition', help='Pipeline method.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x200', help='Volume size (voxels) of the phantom.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print(f'{args.method}, {args.size}')
+    print(f'{"release_memory":<16}{"compact_labels":<16}{"traced peak [MB]":>18}{"volumes max [MB]":>18}{"volumes end [MB]":>18}{"max RSS [MB]":>14}')
+    for release, compact in [(False, False), (True, False), (True, True)]:
+        queue = context.Queue()
+        process = context.Process(target=case_memory, args=(args.method, args.size, release, compact, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        print(f'{str(release):<16}{str(compact):<16}{result["peak_mb"]:>18.0f}{result["resident_max_mb"]:>18.0f}'
+              f'{result["resident_end_mb"]:>18.0f}{result["maxrss_mb"]:>14.0f}')
+
+if __name__ == "__main__":
+    main()
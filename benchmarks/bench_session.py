@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import logging
+import statistics
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from BodyComposition.python_api import BodyCompositionSession, bodycomposition_images
+from phantoms import make_phantom, parse_size
+from phantom_pipeline import register
+
+
+def main():
+    """
+    Benchmark first-call vs. steady-state latency: repeated API calls (pipeline built per call) vs. a single session.
+    Run from the repository root (configs are loaded from ./config).
+    Usage: PYTHONPATH=. python benchmarks/bench_session.py -m PhantomBodyCompositionFast -s 256x256x100 -n 10
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark latency of repeated API calls vs. a pipeline session.')
+    parser.add_argument('--method', '-m', type=str, default='PhantomBodyCompositionFast',
+                        help='Pipeline method, e.g. a phantom pipeline, or a real pipeline (requires models).')
+    parser.add_argument('--size', '-s', type=str, default='256x256x100', help='Volume size (voxels) of the phantom.')
+    parser.add_argument('--calls', '-n', type=int, default=10, help='Number of calls (one image per call).')
+    args = parser.parse_args()
+    register()
+
+    image = make_phantom(parse_size(args.size))['image']
+    with tempfile.TemporaryDirectory(prefix='bench_session_') as tmp:
+        config = {'paths': {'logs': Path(tmp, 'logs/session.log')}}
+        n_handlers = len(logging.getLogger().handlers)
+
+        # functional api: pipeline built per call
+        latency_api = []
+        for _ in range(args.calls):
+            time_start = perf_counter()
+            bodycomposition_images([image], method=args.method, config=config)
+            latency_api.append(perf_counter() - time_start)
+        n_handlers_api = len(logging.getLogger().handlers) - n_handlers
+
+        # session: pipeline built once
+        latency_session = []
+        time_start = perf_counter()
+        with BodyCompositionSession(args.method, config, in_memory=True) as session:
+            time_build = perf_counter() - time_start
+            for _ in range(args.calls):
+                time_start = perf_counter()
+                session.run_images([image])
+                latency_session.append(perf_counter() - time_start)
+        n_handlers_session = len(logging.getLogger().handlers) - n_handlers
+
+    print(f'{args.method}, {args.size}, {args.calls} calls')
+    print(f'api:     first call {latency_api[0]:.3f}s, steady-state median {statistics.median(latency_api[1:] or latency_api):.3f}s/call')
+    print(f'session: build {time_build:.3f}s, first call {time_build + latency_session[0]:.3f}s (incl. build), '
+          f'steady-state median {statistics.median(latency_session[1:] or latency_session):.3f}s/call')
+    print(f'logging handlers left after calls: api {n_handlers_api}, session {n_handlers_session}')
+
+if __name__ == "__main__":
+    main()
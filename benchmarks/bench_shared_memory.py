@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import multiprocessing
+import statistics
+import tempfile
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+from psutil import Process
+from BodyComposition.utils.nifti import NiftiDataContainer
+from phantoms import make_phantom, parse_size
+
+
+def worker(conn):
+    """Receives containers (or paths), touches all voxels, replies with checksum and unique memory (USS) of process."""
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        container = NiftiDataContainer(item) if isinstance(item, Path) else item
+        checksum = int(container.data_np.sum(dtype=np.int64))
+        conn.send((checksum, Process().memory_full_info().uss))
+        del container
+
+
+def main():
+    """
+    Benchmark hand-off of a volume to a worker process: pickled NiftiDataContainer over a pipe (as done by the
+    supervisor without shared memory), nii.gz written and loaded again, and container backed by shared memory.
+    Run from the repository root.
+    Usage: PYTHONPATH=. python benchmarks/bench_shared_memory.py -s 512x512x1000 -n 3
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark hand-off of volumes between processes.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x1000', help='Volume size (voxels) of the phantom, int16.')
+    parser.add_argument('--repeats', '-n', type=int, default=3, help='Hand-offs per method.')
+    parser.add_argument('--methods', type=str, default='pickle,file,shared', help='Methods, comma separated.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    conn, conn_worker = context.Pipe()
+    process = context.Process(target=worker, args=(conn_worker,))
+    process.start()
+
+    with tempfile.TemporaryDirectory(prefix='bench_shared_memory_') as tmp:
+        container = NiftiDataContainer(Path(tmp, 'images/case.nii.gz'))
+        container.data_nib = make_phantom(parse_size(args.size))['image']
+        checksum_expected = int(container.data_np.sum(dtype=np.int64))
+        print(f'{args.size} int16, {container.data_np.nbytes / 1024**2:.0f} MB, {args.repeats} hand-offs per method')
+
+        for method in args.methods.split(','):
+            latencies, uss = [], []
+            for _ in range(args.repeats):
+                time_start = perf_counter()
+                if method == 'pickle':
+                    conn.send(container)
+                elif method == 'file':
+                    container.save_to_file()
+                    conn.send(container.path)
+                elif method == 'shared':
+                    container.share()
+                    conn.send(container)
+                checksum, uss_worker = conn.recv()
+                latencies.append(perf_counter() - time_start)
+                uss.append(uss_worker)
+                container.release_shared()
+                assert checksum == checksum_expected, f'{method}: checksum mismatch'
+            print(f' {method:<7} median {statistics.median(latencies):.3f}s/hand-off, '
+                  f'worker unique memory (USS) {max(uss) / 1024**2:.0f} MB')
+
+    conn.send(None)
+    process.join()
+
+if __name__ == "__main__":
+    main()
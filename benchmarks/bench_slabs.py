@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import copy
+import logging
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+import numpy as np
+from BodyComposition.actions.masks_totalsegmentator import MasksTotalSegmentatorTissue
+from BodyComposition.utils.config import update_config
+from BodyComposition.utils.nifti import NiftiDataContainer
+from phantoms import make_phantom, parse_size
+
+# configurations of the tissue postprocessing
+path_config = Path(__file__).resolve().parents[1] / 'config'
+filters_3d = {tissue: {f'{size}': True, f'{size}_version': '3D'}
+              for tissue, size in [('imat', 'filter_size'), ('sm', 'filter_hu_size'), ('vat', 'filter_hu_size'), ('sat', 'filter_hu_size')]}
+variants = {
+    'default': {},
+    'median 3x3x3': {'hu_denoise': {'filter_outliers': True, 'filter_median': True, 'filter_median_kernel': [3, 3, 3]}},
+    'median, 2D filters': {'hu_denoise': {'filter_median': True, 'filter_median_kernel': [3, 3, 3]},
+                           **{tissue: {key: True} for tissue, key in [('imat', 'filter_size'), ('sm', 'filter_hu_size'),
+                                                                      ('vat', 'filter_hu_size'), ('sat', 'filter_hu_size')]}},
+    'median, 3D filters': {'hu_denoise': {'filter_median': True, 'filter_median_kernel': [3, 3, 3]}, **filters_3d},
+}
+
+
+def run(phantom, config, workspace: Path):
+    """Run MasksTotalSegmentatorTissue on phantom, returns mask, wall time and peak of traced memory (MB)."""
+    pipeline = SimpleNamespace(config=config, timestamp=0)
+    action = MasksTotalSegmentatorTissue(pipeline, image='tmp/index', iliopsoas=True, bodytrunk=True)
+    memory = {'id': 'phantom', 'workspace': workspace}
+    for name, key in [('tmp/index', 'image'), (action.input_label_tissue_name, 'tissue'),
+                      (action.input_label_iliopsoas_name, 'iliopsoas'), (action.input_label_bodytrunk_name, 'bodytrunk')]:
+        memory[name] = NiftiDataContainer(workspace / name.format(caseid='phantom'))
+        memory[name].data_nib = phantom[key]
+    tracemalloc.start()
+    time_start = perf_counter()
+    action(memory)
+    wall = perf_counter() - time_start
+    peak = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+    return memory[action.output_mask_name].data_np, wall, peak
+
+
+def main():
+    """
+    Tissue postprocessing (MasksTotalSegmentatorTissue) of the full volume compared to slabs (`tissue/slab_slices`):
+    wall time and peak memory of temporaries (traced numpy allocations, inputs excluded), for several filter
+    configurations. Exits with error if masks differ.
+    Run from the repository root.
+    Usage: PYTHONPATH=. python benchmarks/bench_slabs.py -s 512x512x400 --slabs 16 64
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark tissue postprocessing in slabs.')
+    parser.add_argument('--size', '-s', type=str, default='512x512x400', help='Volume size (voxels) of the phantom.')
+    parser.add_argument('--slabs', type=int, nargs='+', default=[16, 64], help='Slab sizes (slices).')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    # phantom with separate iliopsoas label (muscle of the left half)
+    phantom = make_phantom(parse_size(args.size))
+    tissue = np.asanyarray(phantom['tissue'].dataobj)
+    iliopsoas = np.zeros(tissue.shape, dtype=np.uint8)
+    iliopsoas[:tissue.shape[0] // 2][tissue[:tissue.shape[0] // 2] == 2] = 88
+    phantom['iliopsoas'] = type(phantom['tissue'])(iliopsoas, phantom['tissue'].affine)
+
+    config_base = update_config({}, path_config / 'config.yaml')
+    config_base = update_config(config_base, path_config / 'labels.yaml')
+    print(f'{args.size}')
+    print(f' {"filters":<22}{"slabs":>8}{"wall [s]":>10}{"peak [MB]":>11}')
+    with tempfile.TemporaryDirectory(prefix='bench_slabs_') as tmp:
+        for name, variant in variants.items():
+            reference = None
+            for slab_slices in [None] + args.slabs:
+                config = update_config(copy.deepcopy(config_base), {'tissue': {**copy.deepcopy(variant), 'save_mask': False, 'slab_slices': slab_slices}})
+                mask, wall, peak = run(phantom, config, Path(tmp))
+                if reference is None:
+                    reference = mask
+                elif not np.array_equal(mask, reference):
+                    raise AssertionError(f'{name}, slabs of {slab_slices}: mask differs from full volume')
+                print(f' {name:<22}{str(slab_slices):>8}{wall:>10.2f}{peak:>11.0f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# import libraries
+import argparse
+import multiprocessing
+import tempfile
+import sys
+from collections import Counter
+from pathlib import Path
+from time import perf_counter, sleep
+import nibabel as nib
+import pandas as pd
+from phantoms import make_phantom, parse_size
+from phantom_pipeline import register
+
+
+def node(path_images: str, path_workspace: str, path_queue: str, method: str, lease: float, path_logs: str, shard: str = None):
+    """Process running the batch as a node, using the work queue (or a shard)."""
+    sys.path.insert(0, str(Path(__file__).parent)) # spawned: phantom pipelines
+    register()
+    from BodyComposition.python_api import bodycomposition
+    config = {'paths': {'logs': path_logs},
+              'run': {'skip': False, 'timeout': None, 'queue_lease': lease},
+              'profiling': {'active': False}}
+    bodycomposition(Path(path_images), workspace=path_workspace, method=method, config=config, shard=shard, queue=path_queue)
+
+
+def main():
+    """
+    Local test of multi-node execution: several processes share a workspace and a work queue, one node is killed
+    during the run (its case is processed again after the lease expired). Checks that each case is exported exactly once.
+    Run from the repository root (configs are loaded from ./config).
+    Usage: PYTHONPATH=. python benchmarks/bench_workqueue.py --cases 24 --nodes 4 --kill 3
+    """
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Local multi-process test of the work queue.')
+    parser.add_argument('--method', '-m', type=str, default='PhantomBodyCompositionFast', help='Pipeline method.')
+    parser.add_argument('--size', '-s', type=str, default='128x128x100', help='Volume size (voxels) of the phantoms.')
+    parser.add_argument('--cases', '-n', type=int, default=24, help='Number of cases.')
+    parser.add_argument('--nodes', type=int, default=4, help='Number of node processes.')
+    parser.add_argument('--kill', type=float, default=3, help='Kill first node after seconds (0 = no kill).')
+    parser.add_argument('--lease', type=float, default=5, help='Lease duration in seconds.')
+    parser.add_argument('--mode', type=str, default='queue', choices=['queue', 'shard'], help='Work queue, or static shards.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench_workqueue_') as tmp:
+        path_images, path_queue = Path(tmp, 'images'), Path(tmp, 'queue')
+        path_images.mkdir()
+        for i in range(args.cases):
+            nib.save(make_phantom(parse_size(args.size), seed=i)['image'], path_images/f'case{i:04d}.nii.gz')
+
+        # nodes
+        context = multiprocessing.get_context('spawn')
+        nodes = [context.Process(target=node, args=(str(path_images), tmp, str(path_queue) if args.mode == 'queue' else None,
+                                                    args.method, args.lease, str(Path(tmp, f'logs/node{i}.log')),
+                                                    f'{i}/{args.nodes}' if args.mode == 'shard' else None))
+                 for i in range(args.nodes)]
+        time_start = perf_counter()
+        for process in nodes:
+            process.start()
+        if args.kill:
+            sleep(args.kill)
+            nodes[0].kill()
+            print(f'killed node 0 after {args.kill}s')
+        for process in nodes:
+            process.join()
+        time_total = perf_counter() - time_start
+
+        # check: each case exported exactly once
+        exports = pd.read_csv(Path(tmp, 'exports/all_L3Mean.csv'))
+        counts = Counter(exports['case_id'])
+        missing = [f'case{i:04d}' for i in range(args.cases) if f'case{i:04d}' not in counts]
+        duplicates = {case: n for case, n in counts.items() if n > 1}
+        print(f'{args.mode}: {args.cases} cases, {args.nodes} nodes, {time_total:.1f}s ({args.cases / time_total:.2f} cases/s)')
+        if args.mode == 'queue':
+            print(' queue: ' + ', '.join(f'{state} {len(list(Path(path_queue, state).iterdir()))}' for state in ['pending', 'leased', 'done', 'failed']))
+        print(f' exported {len(counts)} cases, missing {missing or "none"}, duplicates {duplicates or "none"}')
+        if missing or duplicates:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
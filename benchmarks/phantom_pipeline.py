@@ -0,0 +1,175 @@
+# libraries
+import logging
+import numpy as np
+from time import time
+from BodyComposition.pipeline import PipelineAction
+from BodyComposition.pipeline_registry import pipeline_registry
+from BodyComposition.utils.nifti import NiftiDataContainer
+from nibabel import aff2axcodes
+from phantoms import make_phantom
+
+
+# stub action class
+class PhantomLabels(PipelineAction):
+    """Creates the phantom (`memory['phantom']`) matching the input image, if not provided with the case (e.g. via python API)."""
+
+    def __init__(self, pipeline, image: str):
+        super().__init__(pipeline)
+        self.input_image_name = image
+        self.io_inputs = [image]
+        self.io_outputs = [] # memory['phantom'] is not a file, excluded from io-checks
+
+    def __call__(self, memory):
+        super().__call__(memory)
+        if 'phantom' in memory:
+            return
+        input_image = memory[self.input_image_name]
+        orientation = 'LPS' if aff2axcodes(input_image.affine)[:2] == ('L', 'P') else 'RAS'
+        memory['phantom'] = make_phantom(input_image.shape, tuple(float(i) for i in input_image.spacing), orientation)
+        logging.info(f' output: memory:phantom ({orientation})')
+
+
+# stub action class
+class StubSegmentation(PipelineAction):
+    """
+    Replaces segmentation actions for benchmarks: returns the phantom's label (`memory['phantom'][task]`).
+    Uses the same output names as the segmentation actions, respects the bounding box of the input image.
+    """
+
+    outputs = {'int-vertebrae': ('vertebrae', 'labels/{caseid}_int-vertebrae.nii.gz'),
+               'tissue': ('tissue', 'labels/{caseid}_tseg-tissue.nii.gz'),
+               'bodytrunk': ('bodytrunk', 'labels/{caseid}_tseg-bodytrunk.nii.gz')}
+
+    def __init__(self, pipeline, image: str, task: str):
+        super().__init__(pipeline, task)
+
+        # define io
+        self.task = task
+        self.phantom_key, self.output_label_name = self.outputs[task]
+        self.input_image_name = image
+        self.io_inputs = [image]
+        self.io_outputs = [self.output_label_name]
+
+    def __call__(self, memory):
+        super().__call__(memory, task=self.task)
+
+        # create output container, metadata from input
+        input_image = memory[self.input_image_name]
+        output_label_path = memory['workspace']/self.output_label_name.format(caseid=memory['id'])
+        output_label = memory[self.output_label_name] = NiftiDataContainer(output_label_path)
+        output_label.meta = input_image.meta
+
+        # copy phantom label, crop to bounding box of input
+        data = np.asanyarray(memory['phantom'][self.phantom_key].dataobj)
+        bbox = input_image.bbox
+        if bbox is not None:
+            data = data[bbox[0]:bbox[1], bbox[2]:bbox[3], bbox[4]:bbox[5]]
+        output_label.data_np = data
+        logging.info(f' output: memory:{output_label.path}')
+
+        # saving, as segmentation actions
+        if self.config['segmentation']['save_label'] and self.writes(self.output_label_name):
+            output_label.save_to_file(writer=self.writer)
+
+
+# stub action class
+class NiftiRoundtrip(PipelineAction):
+    """Saves a container to the workspace (`mode=save`), or loads it again into a new container (`mode=load`)."""
+
+    def __init__(self, pipeline, input: str, mode: str):
+        super().__init__(pipeline, mode)
+        if mode not in ['save', 'load']:
+            raise ValueError(f'Unknown mode: {mode}')
+        self.task = f'{mode}:{input.split("/")[0]}'
+        self.input_name = input
+        self.mode = mode
+        self.io_inputs = [input]
+        self.io_outputs = [input] if mode == 'load' else []
+
+    def __call__(self, memory):
+        super().__call__(memory, task=self.task)
+        time_start = time()
+        input = memory[self.input_name]
+        if self.mode == 'save':
+            input.save_to_file()
+        else:
+            output = memory[self.input_name] = NiftiDataContainer(input.path)
+            output.load_from_file()
+        logging.info(f' {self.mode}: {input.path} ({time()-time_start:.2f}s)')
+
+
+def PhantomBodyComposition(pipeline):
+    """Non-ML actions of BodyComposition, segmentations replaced by phantom labels."""
+    from BodyComposition.actions.calc_vertebrallevel import CalcVertebralLevel
+    from BodyComposition.actions.calc_csa import CalcCSA
+    from BodyComposition.actions.data_postprocessing import DataCombine, DataExport
+    from BodyComposition.actions.masks_totalsegmentator import MasksTotalSegmentatorTissue
+    from BodyComposition.actions.data_loading import LoadMetadata
+
+    pipeline_definition = [
+        # segmentations, stubs
+        PhantomLabels(pipeline, image='tmp/index'),
+        StubSegmentation(pipeline, image='tmp/index', task='int-vertebrae'),
+        StubSegmentation(pipeline, image='tmp/index', task='bodytrunk'),
+        StubSegmentation(pipeline, image='tmp/index', task='tissue'),
+
+        # nifti io
+        NiftiRoundtrip(pipeline, input='tmp/index', mode='save'),
+        NiftiRoundtrip(pipeline, input='labels/{caseid}_tseg-tissue.nii.gz', mode='save'),
+        NiftiRoundtrip(pipeline, input='tmp/index', mode='load'),
+        NiftiRoundtrip(pipeline, input='labels/{caseid}_tseg-tissue.nii.gz', mode='load'),
+
+        # postprocessing, calculations
+        MasksTotalSegmentatorTissue(pipeline, image='tmp/index', iliopsoas=False, bodytrunk=True),
+        CalcVertebralLevel(pipeline, mask='labels/{caseid}_int-vertebrae.nii.gz'),
+        CalcCSA(pipeline, mask='masks/{caseid}_tseg-tissue.nii.gz'),
+
+        # postprocessing and export
+        LoadMetadata(pipeline, input='metadata/{caseid}.csv'),
+        DataCombine(pipeline),
+        DataExport(pipeline, file='exports/{caseid}.csv', append=False, add_metadata=True),
+        DataExport(pipeline, file='exports/all.csv', append=True, add_metadata=True),
+    ]
+    return pipeline_definition
+
+
+def PhantomBodyCompositionFast(pipeline):
+    """Non-ML actions of BodyCompositionFast, segmentations replaced by phantom labels."""
+    from BodyComposition.actions.crop import CreateBoundingBox, ApplyBoundingBox
+    from BodyComposition.actions.calc_vertebrallevel import CalcVertebralLevel
+    from BodyComposition.actions.calc_csa import CalcCSA
+    from BodyComposition.actions.data_postprocessing import DataCombine, DataSubset, DataAggregate, DataExport
+    from BodyComposition.actions.masks_totalsegmentator import MasksTotalSegmentatorTissue
+    from BodyComposition.actions.data_loading import LoadMetadata
+
+    pipeline_definition = [
+        # localization, crop
+        PhantomLabels(pipeline, image='tmp/index'),
+        StubSegmentation(pipeline, image='tmp/index', task='int-vertebrae'),
+        CreateBoundingBox(pipeline, label='labels/{caseid}_int-vertebrae.nii.gz', task='L234CranioCaudal'),
+        ApplyBoundingBox(pipeline, input='tmp/index'),
+        ApplyBoundingBox(pipeline, input='labels/{caseid}_int-vertebrae.nii.gz'),
+
+        # segmentation area, stub
+        StubSegmentation(pipeline, image='tmp/index', task='tissue'),
+
+        # postprocessing, calculations; levels first, postprocessing restricted to exported levels if possible
+        CalcVertebralLevel(pipeline, mask='labels/{caseid}_int-vertebrae.nii.gz'),
+        MasksTotalSegmentatorTissue(pipeline, image='tmp/index', iliopsoas=False, bodytrunk=False),
+        CalcCSA(pipeline, mask='masks/{caseid}_tseg-tissue.nii.gz'),
+
+        # postprocessing and export
+        LoadMetadata(pipeline, input='metadata/{caseid}.csv'),
+        DataCombine(pipeline),
+        DataExport(pipeline),
+        DataSubset(pipeline, ref='Level', level=['L3']),
+        DataAggregate(pipeline, method='mean', ref='Level'),
+        DataExport(pipeline, file='exports/all_L3Mean.csv', append=True, add_metadata=True),
+    ]
+    return pipeline_definition
+
+
+def register():
+    """Add phantom pipelines to the pipeline registry."""
+    pipeline_registry['PhantomBodyComposition'] = PhantomBodyComposition
+    pipeline_registry['PhantomBodyCompositionFast'] = PhantomBodyCompositionFast
@@ -0,0 +1,95 @@
+# libraries
+from typing import Dict, Tuple
+from nibabel import Nifti1Image
+import numpy as np
+
+# internal vertebrae labels (config/labels.yaml: LBL_VERTEBRALBODIES), inferior to superior
+LBL_SACRUM = 19
+LBL_VERTEBRAE = [17, 16, 15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1] # L5 ... T1
+
+# TotalSegmentator labels (config/labels.yaml: LBL_TISSUE_TSEG; task body: 1 = trunk)
+LBL_TSEG_SAT = 1
+LBL_TSEG_VAT = 2
+LBL_TSEG_SM = 3
+LBL_BODYTRUNK = 1
+
+
+def parse_size(size: str) -> Tuple[int, int, int]:
+    """Parse size string, e.g. `512x512x200`."""
+    return tuple(int(i) for i in size.lower().split('x'))
+
+
+def make_phantom(shape: Tuple[int, int, int] = (256, 256, 100),
+                 spacing: Tuple[float, float, float] = (0.8, 0.8, 3.0),
+                 orientation: str = 'RAS',
+                 seed: int = 0) -> Dict[str, Nifti1Image]:
+    """
+    Synthetic abdominal CT phantom with matching labels.
+    - body ellipse, subcutaneous fat ring, muscle ring (w/ small fat inclusions = IMAT), visceral compartment (fat and organs)
+    - vertebral bodies stacked in cranio-caudal direction (sacrum, L5, L4, ...), separated by discs
+    Returns nibabel images for `image` (int16, HU), `vertebrae` (internal labels), `tissue` (TotalSegmentator tissue_types)
+    and `bodytrunk` (TotalSegmentator body). Orientation `RAS` or `LPS` (flipped x/y axes, to exercise reorientation).
+    """
+    rng = np.random.default_rng(seed)
+    nx, ny, nz = shape
+    sx, sy, sz = spacing
+
+    # 2d geometry in mm, RAS+: x = left -> right, y = posterior -> anterior
+    x = (np.arange(nx) - nx / 2) * sx
+    y = (np.arange(ny) - ny / 2) * sy
+    xx, yy = np.meshgrid(x, y, indexing='ij')
+    a, b = 0.42 * nx * sx, 0.32 * ny * sy
+    def ellipse(scale):
+        return (xx / (a * scale))**2 + (yy / (b * scale))**2 <= 1
+    body = ellipse(1.0)
+    muscle_outer = ellipse(0.88)
+    visceral = ellipse(0.75)
+    vertebra = (xx**2 + (yy + 0.55 * b)**2) <= 20.0**2
+
+    # tissue compartments (2d), muscle ring with fat inclusions, visceral mixture of fat and organs
+    tissue_2d = np.zeros((nx, ny), dtype=np.uint8)
+    tissue_2d[body] = LBL_TSEG_SAT
+    tissue_2d[muscle_outer] = LBL_TSEG_SM
+    tissue_2d[visceral] = LBL_TSEG_VAT
+    tissue_2d[vertebra] = 0
+    imat_2d = muscle_outer & ~visceral & (np.sin(xx / 3.0) * np.sin(yy / 3.0) > 0.9)
+    organs_2d = visceral & (np.sin(xx / 25.0) + np.cos(yy / 20.0) > 0.5)
+
+    # hounsfield units (2d)
+    hu_2d = np.full((nx, ny), -1000, dtype=np.int16)
+    hu_2d[body] = -100
+    hu_2d[muscle_outer] = 45
+    hu_2d[imat_2d] = -80
+    hu_2d[visceral] = -90
+    hu_2d[organs_2d] = 40
+    hu_2d[vertebra] = 400
+
+    # extrude to 3d, add noise
+    image = np.repeat(hu_2d[:, :, None], nz, axis=2)
+    image += rng.normal(0, 15, size=shape).astype(np.int16)
+    tissue = np.repeat(tissue_2d[:, :, None], nz, axis=2)
+    bodytrunk = np.repeat(body[:, :, None], nz, axis=2).astype(np.uint8) * LBL_BODYTRUNK
+
+    # vertebrae: sacrum (40mm), then vertebral bodies (28mm) separated by discs (6mm), inferior to superior
+    vertebrae = np.zeros(shape, dtype=np.uint8)
+    z_levels = np.zeros(nz, dtype=np.uint8)
+    z_mm = np.arange(nz) * sz
+    z_levels[z_mm < 40] = LBL_SACRUM
+    for i, label in enumerate(LBL_VERTEBRAE):
+        z_start = 40 + 6 + i * 34
+        z_levels[(z_mm >= z_start) & (z_mm < z_start + 28)] = label
+    vertebrae[vertebra] = z_levels
+
+    # affine, optionally flipped to LPS
+    affine = np.diag([sx, sy, sz, 1.0])
+    affine[:3, 3] = [-nx / 2 * sx, -ny / 2 * sy, 0]
+    arrays = {'image': image, 'vertebrae': vertebrae, 'tissue': tissue, 'bodytrunk': bodytrunk}
+    if orientation == 'LPS':
+        flip = np.diag([-1.0, -1.0, 1.0, 1.0])
+        flip[:3, 3] = [nx - 1, ny - 1, 0]
+        affine = affine @ flip
+        arrays = {key: np.ascontiguousarray(value[::-1, ::-1, :]) for key, value in arrays.items()}
+    elif orientation != 'RAS':
+        raise ValueError(f'Unknown orientation: {orientation}')
+
+    return {key: Nifti1Image(value, affine) for key, value in arrays.items()}